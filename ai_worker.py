@@ -1,6 +1,16 @@
 # ai_worker.py
 from PyQt6.QtCore import QThread, pyqtSignal
-from openai import OpenAI
+from llm_client import LLMSession, AdaptiveLimiter, run_with_limiter, cached_prompt_tokens, continuation_messages, \
+    describe_error
+from correction_state import CorrectionProgress, PatchLog, SettingScanState, content_hash
+from context_builder import HistoryBuilder, format_chapter_line, estimate_tokens, DETAILED_VOLUMES
+from retrieval import RetrievalIndex, format_passages, RETRIEVAL_TOP_K
+from entity_index import EntityIndex
+from job_queue import (JobQueue, KIND_CHAPTER, STATE_PENDING, STATE_STREAMING, STATE_GENERATED, STATE_SUMMARISED,
+                       STATE_DONE, FLUSH_CHARS)
+from text_patch import (split_paragraphs, make_windows, number_paragraphs, paragraph_offsets, parse_snippet_edits,
+                        apply_snippet_edits)
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 
 class AIWorker(QThread):
@@ -9,7 +19,8 @@ class AIWorker(QThread):
     finished_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
 
-    def __init__(self, api_key, base_url, model, temperature, max_tokens, system_prompt, user_prompt):
+    def __init__(self, api_key, base_url, model, temperature, max_tokens, system_prompt, user_prompt, chapter=None):
+        """chapter 为正在撰写的 (卷名, 章名)，用于用量台账"""
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
@@ -19,27 +30,25 @@ class AIWorker(QThread):
         self.system_prompt = system_prompt
         self.user_prompt = user_prompt
         self._is_cancelled = False
+        self.llm = LLMSession(api_key, base_url, model, temperature, worker="write", chapter=chapter)
+        # 网络抖动等自动重试的提示显示在思考过程区
+        self.llm.on_retry = lambda msg: self.reasoning_signal.emit(f"\n{msg}\n")
 
     def cancel(self):
         self._is_cancelled = True
+        self.llm.cancel()
 
     def run(self):
         try:
-            client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-            response = client.chat.completions.create(
-                model=self.model,
-                temperature=self.temperature,
+            response = self.llm.stream_chat(
                 max_tokens=self.max_tokens,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
                     {"role": "user", "content": self.user_prompt}
-                ],
-                stream=True
+                ]
             )
 
             for chunk in response:
-                if self._is_cancelled:
-                    break
                 delta = chunk.choices[0].delta
                 reasoning = getattr(delta, "reasoning_content", None)
                 if reasoning:
@@ -64,17 +73,23 @@ class AutoPilotWorker(QThread):
     # 结构操作信号 (让主线程去操作数据，避免跨线程读写冲突)
     add_volume_signal = pyqtSignal(str, str)  # vol_name, synopsis
     add_chapter_signal = pyqtSignal(int, str, str)  # v_idx, chap_name, ai_synopsis
-    save_content_signal = pyqtSignal(int, int, str, str)  # v_idx, c_idx, content, ai_summary
+    save_content_signal = pyqtSignal(int, int, str)  # v_idx, c_idx, content
+    save_summary_signal = pyqtSignal(int, int, str)  # v_idx, c_idx, ai_summary
 
     # 【新增】专门用于更新“已有章节”和“已有卷宗”的梗概
     update_chapter_signal = pyqtSignal(int, int, str)
     update_volume_signal = pyqtSignal(int, str)  # <--- 新增这行：传递 v_idx, synopsis
+    update_volume_digest_signal = pyqtSignal(int, str)  # v_idx, 卷级摘要
 
     finished_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
 
+    # 多卷并行起草后，对卷首章开头这么多段（不计空行）按真实的上一章末尾做衔接修补
+    SEAM_PARAGRAPHS = 8
+
     # 修改 __init__，加入 mode 和 target_v_idx 参数
-    def __init__(self, api_key, base_url, model, temperature, project_meta, mode="full", target_v_idx=-1):
+    def __init__(self, api_key, base_url, model, temperature, project_meta, mode="full", target_v_idx=-1,
+                 history=None, retrieval=None, parallel_volumes=1, jobs=None):
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
@@ -84,22 +99,33 @@ class AutoPilotWorker(QThread):
         self.meta = project_meta.meta
         self.mode = mode  # "full" 或 "volume"
         self.target_v_idx = target_v_idx  # 指定的一键卷索引
+        # 全书模式下同时起草的卷数；大于 1 时各卷按细纲并行写，卷首章先写后对衔接
+        self.parallel_volumes = max(1, int(parallel_volumes))
+        self._chain_failed = False
+        # 过往剧情轨迹的增量缓存；主界面会传入共用的那一份，单独使用时自建
+        self.history = history or HistoryBuilder(project_meta)
+        # 检索索引：主界面传入的那一份由后台线程负责首次建索引，建好之前本线程不等它；单独使用时自建，首次查询时就地建
+        self.retrieval = retrieval or RetrievalIndex(project_meta)
+        self._wait_for_retrieval = retrieval is None
+        # 挂机任务队列：记录本轮各单元的进度，中断后从断点继续
+        self.jobs = jobs or JobQueue(project_meta.root_path)
+        self._chapter_states = {}
         self._is_cancelled = False
+        self.llm = LLMSession(api_key, base_url, model, temperature, worker="autopilot")
+        self.llm.on_retry = self.log_signal.emit
 
     def cancel(self):
         self._is_cancelled = True
-        # 【新增】强制关闭 OpenAI 客户端，打断可能正在阻塞的网络请求
-        if hasattr(self, 'client'):
-            try:
-                self.client.close()
-            except Exception:
-                pass
+        # 只打断本任务正在进行的网络请求，共享连接池保持可用
+        self.llm.cancel()
 
     # 修改 run 方法，加入前置判断跳过逻辑
     def run(self):
         try:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-
+            remaining, streaming = self.jobs.unfinished_count()
+            if remaining:
+                self.log_signal.emit(f"♻️ 发现上次中断的挂机记录：还有 {remaining} 章未完成（其中 {streaming} 章写到一半），"
+                                     f"将从断点继续。")
             if self.mode == "full":
                 # 阶段 1：规划后续所有卷宗
                 self.status_signal.emit("🔄 阶段 1/3: 正在统筹全局，规划后续卷宗...")
@@ -124,7 +150,10 @@ class AutoPilotWorker(QThread):
                         break
 
                 skip_planning = False
-                if len(existing_chaps) >= 20 and not has_blank_chapters:
+                if self.jobs.is_plan_done(vol["name"]):
+                    self.log_signal.emit(f"⏭️ {vol['name']} 的细纲已在本轮挂机中规划过，跳过细纲规划。")
+                    skip_planning = True
+                elif len(existing_chaps) >= 20 and not has_blank_chapters:
                     self.log_signal.emit(f"⏭️ {vol['name']} 章节数量充足(>=20)且无空白梗概，跳过细纲规划。")
                     skip_planning = True
                 elif len(existing_chaps) > 0 and not has_blank_chapters:
@@ -145,11 +174,22 @@ class AutoPilotWorker(QThread):
             self._generate_all_contents()
 
             if not self._is_cancelled:
+                # 整轮顺利完成，清空任务队列；下次挂机重新开始一轮
+                self.jobs.clear()
                 self.status_signal.emit("✅ 挂机生成完毕！")
+            hit_rate = self.llm.cache_hit_rate()
+            if hit_rate is not None:
+                totals = self.llm.usage_totals
+                self.log_signal.emit(f"📊 本次挂机共 {totals['calls']} 次请求，prompt {totals['prompt_tokens']} tokens，"
+                                     f"其中前缀缓存命中 {totals['cached_tokens']} tokens（{hit_rate:.0%}）")
             self.finished_signal.emit()
 
         except Exception as e:
-            self.error_signal.emit(str(e))
+            # 并行起草中某一卷出错时其余各卷是被主动取消的，仍按出错处理
+            if self._is_cancelled and not self._chain_failed:
+                self.finished_signal.emit()
+            else:
+                self.error_signal.emit(str(e))
 
     # 【新增方法】轻量级 AI 判断本卷是否已在现有章节中完结
     def _is_volume_concluded(self, target_v_idx):
@@ -179,23 +219,24 @@ class AutoPilotWorker(QThread):
     "is_concluded": true/false
 }}"""
         try:
-            result = self._call_llm_for_json(sys_prompt, user_prompt)
+            with self.llm.usage_scope(vol["name"]):
+                result = self._call_llm_for_json(sys_prompt, user_prompt)
             return result.get("is_concluded", False)
         except Exception:
             return False
 
     def _call_llm_for_json(self, system_prompt, user_prompt):
         """请求 LLM 并强制返回 JSON 格式"""
-        response = self.client.chat.completions.create(
-            model=self.model,
-            temperature=self.temperature,
+        content = self.llm.complete(
             response_format={"type": "json_object"},  # 强制JSON输出
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ]
         )
-        return json.loads(response.choices[0].message.content)
+        if self._is_cancelled:
+            return {}
+        return json.loads(content)
 
     # 【新增方法】专属单卷规划逻辑，重写 Prompt 分布
     def _plan_single_volume_chapters(self, target_v_idx):
@@ -211,16 +252,7 @@ class AutoPilotWorker(QThread):
         char_setting = "\n".join(char_texts) if char_texts else "未提供明确人物。"
 
         # 获取历史轨迹
-        history_str = ""
-        for i in range(target_v_idx):
-            temp_v = self.meta["volumes"][i]
-            history_str += f"▶ {temp_v['name']} (本卷梗概: {temp_v.get('synopsis', '无')})\n"
-            for temp_c in temp_v.get("chapters", []):
-                temp_ai_syn = temp_c.get("ai_synopsis", "")
-                temp_user_syn = temp_c.get("synopsis", "")
-                display_syn = temp_ai_syn if temp_ai_syn.strip() else (
-                    temp_user_syn if temp_user_syn.strip() else "暂无梗概")
-                history_str += f"  - {temp_c['name']}: {display_syn}\n"
+        history_str = self.history.budgeted(target_v_idx)
 
         if not history_str.strip():
             history_str = "前面暂无卷宗历史。"
@@ -261,7 +293,8 @@ class AutoPilotWorker(QThread):
         {"name": "新章节名", "ai_synopsis": "新规划的详细梗概"}
     ]
 }"""
-        result = self._call_llm_for_json(sys_prompt, user_prompt)
+        with self.llm.usage_scope(vol["name"]):
+            result = self._call_llm_for_json(sys_prompt, user_prompt)
 
         for updated_chap in result.get("updated_existing_chapters", []):
             if self._is_cancelled: break
@@ -279,7 +312,10 @@ class AutoPilotWorker(QThread):
             if chap["name"] in existing_names:
                 continue
             self.add_chapter_signal.emit(target_v_idx, chap["name"], chap["ai_synopsis"])
+            self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_PENDING)
             self.log_signal.emit(f"📄 自动规划补齐新章节：{vol['name']} - {chap['name']}")
+        if not self._is_cancelled:
+            self.jobs.mark_plan_done(vol["name"])
 
     def _plan_volumes(self):
         existing_vols_info = []
@@ -356,46 +392,60 @@ class AutoPilotWorker(QThread):
             self.log_signal.emit(f"📚 自动创建新卷：{vol['name']}")
 
     def _plan_chapters(self):
+        if self.parallel_volumes > 1:
+            self._plan_chapters_in_parallel()
+            return
+
         for v_idx, vol in enumerate(self.meta["volumes"]):
             if self._is_cancelled: break
 
-            existing_chaps = vol.get("chapters", [])
-            current_chap_count = len(existing_chaps)
-            has_blank_chapters = False
-            existing_chaps_info = []
-
-            for c in existing_chaps:
-                ai_syn = c.get("ai_synopsis", "")
-                user_syn = c.get("synopsis", "")
-                if len(ai_syn.strip()) < 10 and len(user_syn.strip()) < 10:
-                    has_blank_chapters = True
-
-                existing_chaps_info.append({
-                    "name": c["name"],
-                    "user_synopsis": user_syn,
-                    "ai_synopsis": ai_syn
-                })
-
-            if current_chap_count >= 20 and not has_blank_chapters:
-                self.log_signal.emit(f"⏭️ {vol['name']} 章节数已达标(>=20)且无空白梗概，跳过细纲规划。")
+            existing_chaps_info = self._chapter_plan_info(v_idx)
+            if existing_chaps_info is None:
                 continue
 
             # 【新增逻辑】：在每一次规划当前卷的章节前，重新获取一遍整本书的最新全局上下文
             # 这样不仅能看到以前的卷，还能实时看到刚刚（在本轮循环中）被 AI 扩写或新建出来的章节！
-            all_context_str = "【全书全局卷章概览（包含最新剧情动态）】\n"
-            for temp_v in self.meta["volumes"]:
-                all_context_str += f"▶ {temp_v['name']} (本卷梗概: {temp_v.get('synopsis', '无')})\n"
-                for temp_c in temp_v.get("chapters", []):
-                    # 优先读取 AI 之前生成的详细梗概，如果没有则降级读取用户的细纲
-                    temp_ai_syn = temp_c.get("ai_synopsis", "")
-                    temp_user_syn = temp_c.get("synopsis", "")
-                    display_syn = temp_ai_syn if temp_ai_syn.strip() else (
-                        temp_user_syn if temp_user_syn.strip() else "暂无梗概")
-                    all_context_str += f"  - {temp_c['name']}: {display_syn}\n"
-                all_context_str += "\n"
-
-            sys_prompt = "你是一个专业且注重伏笔与逻辑连贯的顶级网文写手。必须返回严格的JSON对象。"
-            user_prompt = f"""
+            # 增量缓存只会重建本轮被修改过的那部分；超出上限时近详远略地压缩
+            all_context_str = "【全书全局卷章概览（包含最新剧情动态）】\n" + \
+                              self.history.budgeted(len(self.meta["volumes"]))
+
+            sys_prompt, user_prompt = self._chapter_plan_prompt(all_context_str, vol, existing_chaps_info)
+            with self.llm.usage_scope(vol["name"]):
+                result = self._call_llm_for_json(sys_prompt, user_prompt)
+            self._merge_chapter_plan(v_idx, result)
+
+    def _chapter_plan_info(self, v_idx):
+        """本卷已有章节信息；章节数已达标且没有空白梗概、无需规划时返回 None"""
+        vol = self.meta["volumes"][v_idx]
+        if self.jobs.is_plan_done(vol["name"]):
+            self.log_signal.emit(f"⏭️ {vol['name']} 的细纲已在本轮挂机中规划过，跳过细纲规划。")
+            return None
+        existing_chaps = vol.get("chapters", [])
+        current_chap_count = len(existing_chaps)
+        has_blank_chapters = False
+        existing_chaps_info = []
+
+        for c in existing_chaps:
+            ai_syn = c.get("ai_synopsis", "")
+            user_syn = c.get("synopsis", "")
+            if len(ai_syn.strip()) < 10 and len(user_syn.strip()) < 10:
+                has_blank_chapters = True
+
+            existing_chaps_info.append({
+                "name": c["name"],
+                "user_synopsis": user_syn,
+                "ai_synopsis": ai_syn
+            })
+
+        if current_chap_count >= 20 and not has_blank_chapters:
+            self.log_signal.emit(f"⏭️ {vol['name']} 章节数已达标(>=20)且无空白梗概，跳过细纲规划。")
+            return None
+        return existing_chaps_info
+
+    @staticmethod
+    def _chapter_plan_prompt(all_context_str, vol, existing_chaps_info):
+        sys_prompt = "你是一个专业且注重伏笔与逻辑连贯的顶级网文写手。必须返回严格的JSON对象。"
+        user_prompt = f"""
 {all_context_str}
 
 【当前任务目标】：{vol['name']}
@@ -417,92 +467,232 @@ class AutoPilotWorker(QThread):
     ]
 }}
 """
-            result = self._call_llm_for_json(sys_prompt, user_prompt)
+        return sys_prompt, user_prompt
 
-            for updated_chap in result.get("updated_existing_chapters", []):
-                if self._is_cancelled: break
-                for c_idx, c in enumerate(vol["chapters"]):
-                    if c["name"] == updated_chap["name"]:
-                        # 只有当原先确实偏短，或者更新内容更长时才更新，保护心血
-                        if len(c.get("ai_synopsis", "")) < len(updated_chap["ai_synopsis"]):
-                            self.update_chapter_signal.emit(v_idx, c_idx, updated_chap["ai_synopsis"])
-                            c["ai_synopsis"] = updated_chap["ai_synopsis"]
-                        self.log_signal.emit(f"📝 补充空白章节细纲：{vol['name']} - {c['name']}")
-                        break
+    def _merge_chapter_plan(self, v_idx, result):
+        """把一卷的规划结果经信号写回主线程，返回本次由 AI 扩写或新建的章节名"""
+        vol = self.meta["volumes"][v_idx]
+        planned = []
+        for updated_chap in result.get("updated_existing_chapters", []):
+            if self._is_cancelled: break
+            for c_idx, c in enumerate(vol["chapters"]):
+                if c["name"] == updated_chap["name"]:
+                    # 只有当原先确实偏短，或者更新内容更长时才更新，保护心血
+                    if len(c.get("ai_synopsis", "")) < len(updated_chap["ai_synopsis"]):
+                        self.update_chapter_signal.emit(v_idx, c_idx, updated_chap["ai_synopsis"])
+                        c["ai_synopsis"] = updated_chap["ai_synopsis"]
+                        planned.append(c["name"])
+                    self.log_signal.emit(f"📝 补充空白章节细纲：{vol['name']} - {c['name']}")
+                    break
 
-            for chap in result.get("new_chapters", []):
-                if self._is_cancelled: break
+        for chap in result.get("new_chapters", []):
+            if self._is_cancelled: break
 
-                # 防重机制
-                existing_names = [c["name"] for c in vol["chapters"]]
-                if chap["name"] in existing_names:
-                    self.log_signal.emit(f"⚠️ 拦截到 AI 重复生成的章节：{chap['name']}，已自动跳过。")
-                    continue
+            # 防重机制
+            existing_names = [c["name"] for c in vol["chapters"]]
+            if chap["name"] in existing_names:
+                self.log_signal.emit(f"⚠️ 拦截到 AI 重复生成的章节：{chap['name']}，已自动跳过。")
+                continue
 
-                self.add_chapter_signal.emit(v_idx, chap["name"], chap["ai_synopsis"])
-                # 【修复说明】：删除了 vol["chapters"].append 代码，因为主线程已经通过信号处理了
-                self.log_signal.emit(f"📄 自动规划补齐新章节：{vol['name']} - {chap['name']}")
+            self.add_chapter_signal.emit(v_idx, chap["name"], chap["ai_synopsis"])
+            # 【修复说明】：删除了 vol["chapters"].append 代码，因为主线程已经通过信号处理了
+            self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_PENDING)
+            self.log_signal.emit(f"📄 自动规划补齐新章节：{vol['name']} - {chap['name']}")
+            planned.append(chap["name"])
+        if not self._is_cancelled:
+            self.jobs.mark_plan_done(vol["name"])
+        return planned
 
-    def _generate_all_contents(self):
-        # 遍历所有卷和章，寻找没有内容（或者还没写）的章节开始写
+    def _plan_chapters_in_parallel(self):
+        """
+        多卷并行规划细纲：卷梗概已由 _plan_volumes 定下，各卷对照同一份冻结的全书概览同时规划，
+        最多 parallel_volumes 卷同时在途。结果严格按卷序写回，与逐卷规划得到的章节顺序一致。
+        各卷规划时看不到彼此新增的章节，全部写回后再做一次跨卷一致性检查。
+        """
+        # 冻结快照：本轮开始前的全书概览，所有卷共用同一份（prompt 前缀相同，也更容易命中前缀缓存）
+        all_context_str = "【全书全局卷章概览（包含最新剧情动态）】\n" + \
+                          self.history.budgeted(len(self.meta["volumes"]))
+        jobs = []
         for v_idx, vol in enumerate(self.meta["volumes"]):
-            for c_idx, chap in enumerate(vol["chapters"]):
-                if self.mode == "volume" and v_idx != self.target_v_idx:
-                    continue  # 如果是“一键成卷”模式，跳过其他卷
+            existing_chaps_info = self._chapter_plan_info(v_idx)
+            if existing_chaps_info is not None:
+                jobs.append((v_idx, self._chapter_plan_prompt(all_context_str, vol, existing_chaps_info)))
+        if not jobs:
+            return
+        self.log_signal.emit(f"⚡ 并行规划 {len(jobs)} 卷细纲，最多同时 {self.parallel_volumes} 卷")
+
+        def plan(job):
+            v_idx, (sys_prompt, user_prompt) = job
+            with self.llm.usage_scope(self.meta["volumes"][v_idx]["name"]):
+                return self._call_llm_for_json(sys_prompt, user_prompt)
+
+        limiter = AdaptiveLimiter(self.parallel_volumes)
+        planned = {}
+        pool = ThreadPoolExecutor(max_workers=limiter.max_limit)
+        try:
+            futures = [pool.submit(run_with_limiter, limiter, lambda job=job: plan(job),
+                                   lambda: self._is_cancelled, on_throttled=self._on_throttled,
+                                   policy=self.llm.retry_policy)
+                       for job in jobs]
+            # 按卷序依次等待并写回：前面的卷写回期间，后面的卷仍在并行规划
+            for (v_idx, _), future in zip(jobs, futures):
+                result = future.result()
+                if self._is_cancelled or result is None: return
+                planned[v_idx] = self._merge_chapter_plan(v_idx, result)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        self._check_plan_consistency(planned)
+
+    def _check_plan_consistency(self, planned):
+        """
+        并行规划后的跨卷一致性检查：各卷互相看不到对方新增的章节，可能出现情节重复、卷与卷之间接不上、
+        人物或物品状态前后矛盾。把写回后的全书细纲整体过一遍，只修正本轮由 AI 规划的章节梗概。
+        planned 为 {v_idx: [本轮规划的章节名, ...]}。
+        """
+        planned = {v_idx: names for v_idx, names in planned.items() if names}
+        if not planned or self._is_cancelled:
+            return
+        self.status_signal.emit("🔍 正在检查各卷细纲之间的衔接与一致性...")
+        outline = self.history.budgeted(len(self.meta["volumes"]))
+        editable = "\n".join(f"{self.meta['volumes'][v_idx]['name']}：{'、'.join(names)}"
+                             for v_idx, names in sorted(planned.items()))
+        sys_prompt = "你是一个专业的小说主编，擅长把控长篇剧情的前后一致性。必须返回严格的JSON对象。"
+        user_prompt = f"""【全书卷章细纲】
+{outline}
+
+【本轮新规划的章节（只允许修改这些章节）】
+{editable}
+
+任务指令：
+以上各卷的章节细纲是分别独立规划的，规划某一卷时看不到其他卷新规划的章节。请通读全书细纲，找出以下问题：
+1. 不同卷里重复发生的同一事件或名场面；
+2. 上一卷结尾与下一卷开头接不上（人物所在位置、处境、时间线断裂）；
+3. 人物关系、能力、物品归属在前后卷之间互相矛盾。
+只修改必须修改的章节，给出修改后的完整梗概（用户手写过梗概的章节不得改变其原意）；没有问题的章节不要返回。
+
+返回格式（严格JSON）：
+{{
+    "updated_chapters": [
+        {{"volume": "卷名", "name": "章节名", "ai_synopsis": "修改后的详细梗概"}}
+    ],
+    "logs": ["发现问题：...，已修改..."]
+}}
+如果没有问题，两个列表都返回空数组。"""
+        result = self._call_llm_for_json(sys_prompt, user_prompt)
+
+        for log in result.get("logs", []):
+            self.log_signal.emit(f"🔍 [细纲一致性] {log}")
+        for item in result.get("updated_chapters", []):
+            if self._is_cancelled: break
+            for v_idx, names in planned.items():
+                vol = self.meta["volumes"][v_idx]
+                if vol["name"] != item.get("volume") or item.get("name") not in names:
+                    continue
+                for c_idx, c in enumerate(vol["chapters"]):
+                    if c["name"] == item["name"] and item.get("ai_synopsis", "").strip():
+                        self.update_chapter_signal.emit(v_idx, c_idx, item["ai_synopsis"])
+                        c["ai_synopsis"] = item["ai_synopsis"]
+                        self.log_signal.emit(f"🔧 按一致性检查修正细纲：{vol['name']} - {c['name']}")
+                        break
+
+    def _on_throttled(self, new_limit, wait):
+        self.log_signal.emit(f"⚠️ 触发接口限流，并发已降为 {new_limit} 路，{wait:.0f} 秒后重试。")
 
+    def _ensure_volume_digests(self, upto_v_idx, start=0):
+        """
+        为第 start ~ upto_v_idx-1 卷中已完结、但还没有卷级摘要（或摘要已因章节梗概变动而作废）的卷生成摘要。
+        每卷只生成一次，之后的 prompt 用这段摘要代替整卷的逐章梗概。
+        摘要只是压缩前情的优化：某卷生成失败时记下日志跳过，该卷继续使用逐章梗概，不中断挂机。
+        """
+        for v_idx in range(start, upto_v_idx):
+            if self._is_cancelled: return
+            vol = self.meta["volumes"][v_idx]
+            if vol.get("digest") or not vol["chapters"]:
+                continue
+            self.status_signal.emit(f"🗜️ 正在为已完结的 {vol['name']} 生成卷级摘要...")
+            chaps_info = "".join(format_chapter_line(c) for c in vol["chapters"])
+            sys_prompt = "你是一个专业的小说主编，擅长提炼剧情。必须返回严格的JSON对象。"
+            user_prompt = f"""【卷名】{vol['name']}
+【本卷梗概】{vol.get('synopsis', '无')}
+【本卷各章剧情概要】
+{chaps_info}
+任务指令：
+请把本卷压缩成一段约300字的卷级摘要，供后续章节写作时回顾前情使用。
+必须保留：主线推进到了哪一步、主要人物的处境与关系变化、关键物品/能力的归属、尚未回收的伏笔。
+不要逐章复述，不要评价。
+返回格式（严格JSON）：
+{{
+    "digest": "卷级摘要"
+}}"""
+            try:
+                with self.llm.usage_scope(vol["name"]):
+                    result = self._call_llm_for_json(sys_prompt, user_prompt)
+            except Exception as e:
                 if self._is_cancelled: return
+                self.log_signal.emit(f"⚠️ {vol['name']} 的卷级摘要生成失败，暂以逐章梗概代替：{describe_error(e)}")
+                continue
+            digest = str(result.get("digest", "")).strip()
+            if digest and not self._is_cancelled:
+                self.update_volume_digest_signal.emit(v_idx, digest)
+                self.log_signal.emit(f"🗜️ 已生成卷级摘要：{vol['name']}")
+
+    def _previous_chapter(self, v_idx, c_idx):
+        """(v_idx, c_idx) 的上一章；本卷第一章时去前面的卷找最后一章，没有时返回 None"""
+        if c_idx > 0:
+            return v_idx, c_idx - 1
+        for i in range(v_idx - 1, -1, -1):
+            if len(self.meta["volumes"][i]["chapters"]) > 0:
+                return i, len(self.meta["volumes"][i]["chapters"]) - 1
+        return None
+
+    @staticmethod
+    def _chapter_tail(content):
+        # 截断太长的上一章内容 (保留后1500字左右即可，节省Token并保证承接)
+        # 【修复1】缩短上一章上下文，防止注意力劫持 (改为1500字)
+        if len(content) > 1500:
+            content = "...(前文省略)...\n" + content[-1500:]
+        return content
+
+    def _prepare_chapter(self, v_idx, c_idx, generating=None):
+        """
+        组装 (v_idx, c_idx) 的写作上下文中不依赖上一章生成结果的部分，供流水线在上一章生成期间预先准备。
+        generating 为此时正在生成的章节：上一章正是它时，末尾内容留到它写完后从内存里取（prev_pending）。
+        上一章由别的卷并行起草、此时还没有正文的，本章只能照细纲先写，标记为 speculative 留待衔接修补。
+        上次挂机中断时写到一半的章节，已收到的部分放在 resume 里接着写。
+        章节已有正文时返回 None。
+        """
+        vol = self.meta["volumes"][v_idx]
+        chap = vol["chapters"][c_idx]
+        # 任务队列里有记录的章节直接按记录判断，不必读盘解析正文
+        unit = self._chapter_states.get((vol["name"], chap["name"]))
+        if unit is None:
+            existing_content = self.project.read_chapter_content(vol["name"], chap["name"])
+            if len(existing_content.strip()) > 100:
+                self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_DONE)
+                return None  # 已经有内容了，直接跳过生成，保护用户的心血！
+            self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_PENDING)
+        elif unit[0] == STATE_DONE:
+            return None
+        resume = (unit[1] or "") if unit is not None and unit[0] == STATE_STREAMING else ""
+
+        prev = self._previous_chapter(v_idx, c_idx)
+        prev_key = None
+        prev_chapter_content = ""
+        speculative = False
+        if prev is not None:
+            prev_vol = self.meta["volumes"][prev[0]]
+            prev_key = (prev_vol["name"], prev_vol["chapters"][prev[1]]["name"])
+            if prev != generating:
+                prev_chapter_content = self._chapter_tail(self.project.read_chapter_content(*prev_key))
+                speculative = len(prev_chapter_content.strip()) <= 100
+
+        # 【修复2】提取缺失的人物设定
+        char_texts = [f"【{c['name']}】 性别:{c['gender']} 性格:{c['personality']} 经历:{c['experience']}" for c
+                      in self.meta.get("characters", [])]
+        char_setting = "\n".join(char_texts) if char_texts else "未提供明确人物。"
 
-                # 这里假设如果章节还没有内容，我们就自动写它
-                # 为了简便，我们每次生成都会把正文传回主线程
-                existing_content = self.project.read_chapter_content(vol["name"], chap["name"])
-                if len(existing_content.strip()) > 100:
-                    self.status_signal.emit(f"⏭️ 跳过已写章节：{vol['name']} - {chap['name']}")
-                    continue  # 已经有内容了，直接跳过生成，保护用户的心血！
-
-                self.status_signal.emit(f"✍️ 正在挂机生成：{vol['name']} - {chap['name']}")
-                self.log_signal.emit(f"开始撰写：{chap['name']}...")
-
-                self.start_chapter_signal.emit(v_idx, c_idx)
-
-                # 构建 prompt (使用与你之前类似的方法，但在 Worker 内组装)
-                prev_v_idx, prev_c_idx = -1, -1
-
-                history_str = ""  # 组装过往 ai_synopsis
-                for i in range(v_idx + 1):
-                    v = self.meta["volumes"][i]
-                    limit = c_idx if i == v_idx else len(v["chapters"])
-                    for j in range(limit):
-                        history_str += f" - {v['chapters'][j]['name']}: {v['chapters'][j].get('ai_synopsis', '')}\n"
-
-                        # 【新增】寻找并读取上一章的正文内容
-                        prev_v_idx, prev_c_idx = -1, -1
-                        if c_idx > 0:
-                            prev_v_idx, prev_c_idx = v_idx, c_idx - 1
-                        elif v_idx > 0:
-                            # 去上一卷找最后一章
-                            for i in range(v_idx - 1, -1, -1):
-                                if len(self.meta["volumes"][i]["chapters"]) > 0:
-                                    prev_v_idx = i
-                                    prev_c_idx = len(self.meta["volumes"][i]["chapters"]) - 1
-                                    break
-
-                prev_chapter_content = ""
-                if prev_v_idx != -1 and prev_c_idx != -1:
-                    pv_name = self.meta["volumes"][prev_v_idx]["name"]
-                    pc_name = self.meta["volumes"][prev_v_idx]["chapters"][prev_c_idx]["name"]
-                    # 直接调用 project 的读取方法
-                    prev_chapter_content = self.project.read_chapter_content(pv_name, pc_name)
-                    # 截断太长的上一章内容 (保留后1500字左右即可，节省Token并保证承接)
-                    # 【修复1】缩短上一章上下文，防止注意力劫持 (改为1500字)
-                    if len(prev_chapter_content) > 1500:
-                        prev_chapter_content = "...(前文省略)...\n" + prev_chapter_content[-1500:]
-
-                    # 【修复2】提取缺失的人物设定
-                char_texts = [f"【{c['name']}】 性别:{c['gender']} 性格:{c['personality']} 经历:{c['experience']}" for c
-                              in self.meta.get("characters", [])]
-                char_setting = "\n".join(char_texts) if char_texts else "未提供明确人物。"
-
-                sys_prompt = f"""你是一位经验丰富的网文大神作家。
+        sys_prompt = f"""你是一位经验丰富的网文大神作家。
                     【全局大纲】：{self.meta.get('global_synopsis', '')}
                     【核心人物设定】：\n{char_setting}
                     【要求】：
@@ -516,57 +706,324 @@ class AutoPilotWorker(QThread):
                     3. 物品设定更新：记录本章所有物品状态
 """
 
-                # 【修复3】强制优先使用用户手写的 synopsis (如果为空才退回使用 ai_synopsis)
-                user_syn = chap.get("synopsis", "").strip()
-                ai_syn = chap.get("ai_synopsis", "").strip()
-                target_synopsis = user_syn if user_syn else (ai_syn if ai_syn else "无")
+        # 【修复3】强制优先使用用户手写的 synopsis (如果为空才退回使用 ai_synopsis)
+        user_syn = chap.get("synopsis", "").strip()
+        ai_syn = chap.get("ai_synopsis", "").strip()
+        target_synopsis = user_syn if user_syn else (ai_syn if ai_syn else "无")
+
+        # 按本章要求检索前文相关片段（人物、物品、伏笔），上一章已经单独附上，不再重复
+        # 共用索引还在后台首次建立时先不附带检索片段，不让开头几章等全书读完
+        exclude = {prev_key} if prev_key else set()
+        related = format_passages(self.retrieval.search(
+            f"{chap['name']} {target_synopsis}", k=RETRIEVAL_TOP_K, before=(v_idx, c_idx), exclude=exclude,
+            wait=self._wait_for_retrieval))
 
-                user_prompt = f"【过往剧情轨迹参考】\n{history_str}\n\n"
-                if prev_chapter_content.strip():
-                    user_prompt += f"【紧接上一章的末尾内容】(参考此段过渡，但不要深陷其中)\n{prev_chapter_content.strip()}\n\n"
+        return {"prev_pending": prev is not None and prev == generating, "prev_tail": prev_chapter_content,
+                "speculative": speculative, "sys_prompt": sys_prompt, "target_synopsis": target_synopsis,
+                "related": related, "resume": resume}
 
-                # 【修复4】在末尾强调用叹号提升“本章要求”的权重
-                user_prompt += f"""【本次写作核心任务 (最高优先级)】
+    def _write_chapter(self, v_idx, c_idx, ctx, stream_ui=True):
+        """
+        按预先准备好的上下文流式生成一章，返回 (正文, AI 概要)；被取消时返回 None。
+        stream_ui 为 False 时（多卷并行起草）不往编辑区推送正文流，几路输出混在一起没法看。
+        """
+        vol = self.meta["volumes"][v_idx]
+        chap = vol["chapters"][c_idx]
+        self.status_signal.emit(f"✍️ 正在挂机生成：{vol['name']} - {chap['name']}")
+        # 并行起草时几卷的日志交错输出，带上卷名才分得清
+        label = chap['name'] if stream_ui else f"{vol['name']} - {chap['name']}"
+        self.log_signal.emit(f"开始撰写：{label}...")
+
+        if stream_ui:
+            self.start_chapter_signal.emit(v_idx, c_idx)
+
+        # 过往梗概来自增量缓存：上一章的概要写回后只追加了一行，无需从头拼接；
+        # 全书写长之后按 token 上限分层压缩，prompt 大小不再随章节数增长
+        history_str = self.history.budgeted(v_idx, c_idx)
+        target_synopsis = ctx["target_synopsis"]
+
+        user_prompt = f"【过往剧情轨迹参考】\n{history_str}\n\n"
+        if ctx["related"]:
+            user_prompt += f"【相关前文片段（按本章要求检索）】\n{ctx['related']}\n"
+
+        prev_chapter_content = ctx["prev_tail"]
+        if prev_chapter_content.strip():
+            user_prompt += f"【紧接上一章的末尾内容】(参考此段过渡，但不要深陷其中)\n{prev_chapter_content.strip()}\n\n"
+
+        # 【修复4】在末尾强调用叹号提升“本章要求”的权重
+        user_prompt += f"""【本次写作核心任务 (最高优先级)】
                 当前撰写：{vol['name']} - {chap['name']}
                 本章必须实现的情节要求：{target_synopsis}
 
                 【行动指令】
                 请务必将剧情向【本章必须实现的情节要求】推进！不要被上一章的末尾内容困住，必须在本文中落实本章要求里的所有核心情节和名场面！扩写为文笔流畅的完整正文！"""
 
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=self.temperature,
-                    messages=[
-                        {"role": "system", "content": sys_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    stream=True
-                )
-
-                content_buffer = ""
+        messages = [
+            {"role": "system", "content": ctx["sys_prompt"]},
+            {"role": "user", "content": user_prompt}
+        ]
+        # 上次中断时写到一半的章节：先把已有部分推给界面，再只请求剩下的内容
+        content_buffer = ctx["resume"]
+        if content_buffer:
+            self.log_signal.emit(f"♻️ {chap['name']}: 从上次中断处接着写（已有 {len(content_buffer)} 字）")
+            messages = continuation_messages(messages, content_buffer)
+            if stream_ui:
+                self.content_signal.emit(content_buffer)
+        self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_STREAMING, content_buffer)
+        flushed = len(content_buffer)
+        completed = False
+        try:
+            with self.llm.usage_scope(vol["name"], chap["name"]):
+                response = self.llm.stream_chat(messages=messages)
                 for chunk in response:
-                    if self._is_cancelled: break
                     delta = chunk.choices[0].delta
                     # 【新增】提取并发送 AI 的思考过程
                     reasoning = getattr(delta, "reasoning_content", None)
-                    if reasoning:
+                    if reasoning and stream_ui:
                         self.reasoning_signal.emit(reasoning)
                     delta_content = getattr(delta, "content", None)
                     if delta_content:
                         content_buffer += delta_content
-                        self.content_signal.emit(delta_content)  # 实时推送到界面
+                        if stream_ui:
+                            self.content_signal.emit(delta_content)  # 实时推送到界面
+                        # 已收到的部分定期写进任务队列，中断后从这里接着写
+                        if len(content_buffer) - flushed >= FLUSH_CHARS:
+                            self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_STREAMING,
+                                                content_buffer)
+                            flushed = len(content_buffer)
+            completed = not self._is_cancelled
+        finally:
+            # 取消、断网或出错时，把最后收到的部分也记下来
+            if not completed and len(content_buffer) > flushed:
+                self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_STREAMING, content_buffer)
+
+        if not completed:
+            return None
+        self.jobs.set_state(KIND_CHAPTER, vol["name"], chap["name"], STATE_GENERATED, content_buffer)
+
+        usage = self.llm.last_usage
+        if usage is not None and getattr(usage, "prompt_tokens", 0):
+            hit = cached_prompt_tokens(usage)
+            self.log_signal.emit(f"📊 {chap['name']}: prompt {usage.prompt_tokens} tokens，"
+                                 f"前缀缓存命中 {hit}（{hit / usage.prompt_tokens:.0%}）")
+
+        # 拆分正文与总结
+        parts = content_buffer.split("[AI_SUMMARY]")
+        main_content = parts[0].strip()
+        ai_summary = parts[1].strip() if len(parts) > 1 else ""
+        return main_content, ai_summary
+
+    def _save_summary(self, v_idx, c_idx, ai_summary, main_content):
+        vol = self.meta["volumes"][v_idx]
+        self.save_summary_signal.emit(v_idx, c_idx, ai_summary)
+        self.jobs.set_state(KIND_CHAPTER, vol["name"], vol["chapters"][c_idx]["name"], STATE_SUMMARISED, main_content)
 
-                if self._is_cancelled: return
+    def _save_content(self, v_idx, c_idx, main_content):
+        vol = self.meta["volumes"][v_idx]
+        self.save_content_signal.emit(v_idx, c_idx, main_content)
+        self.jobs.set_state(KIND_CHAPTER, vol["name"], vol["chapters"][c_idx]["name"], STATE_DONE)
 
-                # 拆分正文与总结
-                parts = content_buffer.split("[AI_SUMMARY]")
+    def _recover_chapters(self, order):
+        """上次挂机中断时已经生成完、但概要或正文还没写回的章节，直接从任务队列里取出写回，不再重新生成"""
+        for v_idx, c_idx in order:
+            vol = self.meta["volumes"][v_idx]
+            key = (vol["name"], vol["chapters"][c_idx]["name"])
+            unit = self._chapter_states.get(key)
+            if unit is None or unit[0] not in (STATE_GENERATED, STATE_SUMMARISED):
+                continue
+            if unit[0] == STATE_GENERATED:
+                parts = unit[1].split("[AI_SUMMARY]")
                 main_content = parts[0].strip()
-                ai_summary = parts[1].strip() if len(parts) > 1 else ""
+                self._save_summary(v_idx, c_idx, parts[1].strip() if len(parts) > 1 else "", main_content)
+            else:
+                main_content = unit[1]
+            self._save_content(v_idx, c_idx, main_content)
+            self._chapter_states[key] = (STATE_DONE, None)
+            self.log_signal.emit(f"♻️ 已写回上次中断前生成完毕的章节：{key[0]} - {key[1]}")
+
+    def _generate_all_contents(self):
+        """
+        逐章生成正文。全书模式且开启了多卷并行时，各卷各自成一条流水线同时起草，见 _generate_volumes_in_parallel。
+        任务队列里有本轮记录的，按记录从上次中断处继续。
+        """
+        # 遍历所有卷和章，寻找没有内容（或者还没写）的章节开始写
+        order = [(v_idx, c_idx) for v_idx, vol in enumerate(self.meta["volumes"])
+                 if self.mode == "full" or v_idx == self.target_v_idx  # 如果是“一键成卷”模式，跳过其他卷
+                 for c_idx in range(len(vol["chapters"]))]
+        self._chapter_states = self.jobs.states(KIND_CHAPTER)
+        self._recover_chapters(order)
+        if self._is_cancelled: return
+        if self.parallel_volumes > 1 and self.mode == "full":
+            self._generate_volumes_in_parallel(order)
+        else:
+            self._run_chapters(order)
+
+    def _run_chapters(self, order, stream_ui=True, volume_digests=True):
+        """
+        按 order 逐章生成正文，按流水线调度：第 N 章流式输出期间，后台同时预读并组装第 N+1 章的上下文、
+        把第 N 章之前生成的正文交给主线程落盘、为刚写完的卷生成卷级摘要，关键路径上基本只剩模型的流式输出。
+        只有本章的 AI 概要在生成后立即同步写回，下一章的剧情轨迹要用到它。
+        返回 {(v_idx, c_idx): 正文}：其中上一章在生成时还没有正文、只能照细纲先写的章节，供之后修补衔接。
+        """
+        background = ThreadPoolExecutor(max_workers=2)  # 预读下一章、生成卷级摘要
+        saver = ThreadPoolExecutor(max_workers=1)  # 按生成顺序把正文交给主线程落盘
+        digest_future = None
+        save_future = None
+        last_written = None  # 最近生成的一章：((v_idx, c_idx), 正文)
+        speculative = {}
+        try:
+            prepared = background.submit(self._prepare_chapter, *order[0]) if order else None
+            for i, (v_idx, c_idx) in enumerate(order):
+                if self._is_cancelled: return speculative
+
+                if volume_digests and (i == 0 or order[i - 1][0] != v_idx):
+                    # 进入新的一卷：更早的卷此时必须已有卷级摘要；刚写完的上一卷本卷还保留逐章明细，摘要放到后台生成
+                    if digest_future is not None:
+                        digest_future.result()
+                    first_detailed = max(0, v_idx - DETAILED_VOLUMES)
+                    self._ensure_volume_digests(first_detailed)
+                    if self._is_cancelled: return speculative
+                    digest_future = background.submit(self._ensure_volume_digests, v_idx, first_detailed)
+
+                ctx = prepared.result()
+                # 本章开始生成前，先把下一章的准备工作排进后台
+                generating = (v_idx, c_idx) if ctx is not None else None
+                prepared = background.submit(self._prepare_chapter, *order[i + 1], generating) \
+                    if i + 1 < len(order) else None
+                if ctx is None:
+                    vol = self.meta["volumes"][v_idx]
+                    self.status_signal.emit(f"⏭️ 跳过已写章节：{vol['name']} - {vol['chapters'][c_idx]['name']}")
+                    continue
+                if ctx["prev_pending"]:
+                    ctx["prev_tail"] = self._chapter_tail(last_written[1])
+
+                result = self._write_chapter(v_idx, c_idx, ctx, stream_ui=stream_ui)
+                if result is None: return speculative
+                main_content, ai_summary = result
+
+                # 概要同步写回主线程（下一章的剧情轨迹要用到），正文交给后台线程落盘，不阻塞下一章开写
+                self._save_summary(v_idx, c_idx, ai_summary, main_content)
+                if save_future is not None:
+                    save_future.result()
+                save_future = saver.submit(self._save_content, v_idx, c_idx, main_content)
+                last_written = ((v_idx, c_idx), main_content)
+                if ctx["speculative"]:
+                    speculative[(v_idx, c_idx)] = main_content
+
+            if save_future is not None:
+                save_future.result()
+            if digest_future is not None:
+                digest_future.result()
+            return speculative
+        finally:
+            # 已经生成出来的正文一律等它落盘完再退出（包括被取消的情况）
+            saver.shutdown(wait=True)
+            background.shutdown(wait=False, cancel_futures=True)
+
+    def _generate_volumes_in_parallel(self, order):
+        """
+        多卷并行起草：细纲已经把每章要写什么定下来了，后面各卷的开头主要取决于本卷细纲，而不是上一卷的具体文字。
+        每卷一条流水线，最多 parallel_volumes 卷同时在写，按卷序排队（靠前的卷先写完，后面的卷首章就能接上真实的前文）。
+        卷首章起草时上一卷还没写完的，等全部写完后再拿真实的上一章末尾修补开头的衔接。
+        并行期间各卷的章节概要不断变动，卷级摘要统一放到最后生成。
+        """
+        chains = {}
+        for v_idx, c_idx in order:
+            chains.setdefault(v_idx, []).append((v_idx, c_idx))
+        self.log_signal.emit(f"⚡ 多卷并行起草：共 {len(chains)} 卷，最多同时 {self.parallel_volumes} 卷在写")
+
+        speculative = {}
+        with ThreadPoolExecutor(max_workers=self.parallel_volumes) as pool:
+            futures = [pool.submit(self._run_chapters, chain, stream_ui=False, volume_digests=False)
+                       for chain in chains.values()]
+            try:
+                for future in as_completed(futures):
+                    speculative.update(future.result())
+            except Exception:
+                # 一卷出错就停掉其余各卷，错误照常上报
+                self._chain_failed = True
+                self.cancel()
+                raise
+        if self._is_cancelled: return
+
+        for v_idx, c_idx in sorted(speculative):
+            if self._is_cancelled: return
+            self._reconcile_seam(v_idx, c_idx, speculative[(v_idx, c_idx)])
+        if order:
+            self._ensure_volume_digests(order[-1][0])
+
+    def _reconcile_seam(self, v_idx, c_idx, content):
+        """按真实的上一章末尾，修补先行起草的一章开头处的衔接（人物位置、时间、情绪、刚发生的事），只做最小改动"""
+        vol = self.meta["volumes"][v_idx]
+        chap = vol["chapters"][c_idx]
+        prev = self._previous_chapter(v_idx, c_idx)
+        prev_vol = self.meta["volumes"][prev[0]]
+        prev_tail = self._chapter_tail(
+            self.project.read_chapter_content(prev_vol["name"], prev_vol["chapters"][prev[1]]["name"])).strip()
+        if not prev_tail:
+            return
 
-                # 告诉主线程保存数据
-                self.save_content_signal.emit(v_idx, c_idx, main_content, ai_summary)
+        paragraphs = split_paragraphs(content)
+        end = len(paragraphs)
+        seen = 0
+        for i, para in enumerate(paragraphs):
+            if para.strip():
+                seen += 1
+                if seen == self.SEAM_PARAGRAPHS:
+                    end = i + 1
+                    break
+        numbered = number_paragraphs(paragraphs, 0, end)
+
+        self.status_signal.emit(f"🧵 正在修补衔接：{vol['name']} - {chap['name']}")
+        sys_prompt = "你是一位严谨的小说主编，负责检查相邻两章的衔接。必须返回严格的JSON。"
+        user_prompt = f"""下面这一章是在上一章写完之前，仅凭本章细纲先行起草的。请对照上一章的真实结尾，检查本章开头的衔接。
+【上一章末尾】
+{prev_tail}
+
+【本章开头】（{chap['name']}，每段开头的 [数字] 是段号）
+{numbered}
+
+要求：
+1. 只修正与上一章结尾矛盾或接不上的地方：人物所在位置、在场人物、时间、伤势与情绪、刚刚发生的事、物品归属等。
+2. 不改动本章的情节走向，不做润色，能接上的地方一律不动。
+3. original 从原文一字不差地摘取需要改的短句（够定位即可，不要整段照抄），replacement 为修改后的写法。
+
+返回格式（严格JSON）：
+{{
+    "edits": [{{"p": 所在段号(整数), "original": "原文中的短句", "replacement": "修改后的短句"}}],
+    "logs": ["衔接问题：...，修改为..."]
+}}
+如果衔接没有问题，"edits" 和 "logs" 返回空数组。"""
+        with self.llm.usage_scope(vol["name"], chap["name"]):
+            result = self._call_llm_for_json(sys_prompt, user_prompt)
+        if self._is_cancelled:
+            return
+
+        for log in result.get("logs", []):
+            self.log_signal.emit(f"🧵 [衔接|{chap['name']}] {log}")
+        edits = parse_snippet_edits(result.get("edits"), paragraph_offsets(paragraphs), allowed=(0, end))
+        new_content, patches, failed = apply_snippet_edits(content, edits)
+        for edit in failed:
+            self.log_signal.emit(f"⚠️ [{chap['name']}] 未能在正文中定位片段，已跳过该处修改: '{edit['original'][:30]}'")
+        if patches:
+            PatchLog(self.project.root_path).record(vol["name"], chap["name"], "seam", patches)
+            self.save_content_signal.emit(v_idx, c_idx, new_content)
+            self.log_signal.emit(f"🧵 {chap['name']}: 已按上一章结尾修补 {len(patches)} 处衔接")
 
 class CorrectionWorker(QThread):
+    # 错别字校对逻辑的版本号；校对 prompt 有实质改动时加一，全书章节会重新校对一遍
+    TYPO_CHECK_VERSION = 1
+    # 全书设定复核每轮最多送审的候选章节数，其余留到下一轮
+    SETTING_SCAN_TOP_K = 30
+    # 某章改动后，紧随其后的这么多章也要复核与它的衔接
+    SETTING_DOWNSTREAM_CHAPTERS = 2
+    # 候选章节的打分权重
+    SETTING_SCORE_ENTITY = 3
+    SETTING_SCORE_NEW = 2
+    SETTING_SCORE_SUMMARY = 2
+    SETTING_SCORE_BODY = 1
+    SETTING_SCORE_DOWNSTREAM = 1
+
     # 信号定义
     status_signal = pyqtSignal(str)
     log_signal = pyqtSignal(str)  # 用于输出到右侧边栏的记录
@@ -575,7 +1032,8 @@ class CorrectionWorker(QThread):
     error_signal = pyqtSignal(str)
     reasoning_signal = pyqtSignal(str)
 
-    def __init__(self, api_key, base_url, model, temperature, project, scope, mode):
+    def __init__(self, api_key, base_url, model, temperature, project, scope, mode, max_concurrency=1,
+                 history=None, entities=None):
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
@@ -588,7 +1046,17 @@ class CorrectionWorker(QThread):
         # 章节级别纠错的坐标
         self.target_v_idx = -1
         self.target_c_idx = -1
+        # 全书错别字校对时同时在途的章节数（各章校对互不依赖，可并行）
+        self.max_concurrency = max(1, int(max_concurrency))
+        # 本轮已修改但主线程可能尚未落盘的正文，避免后续阶段读到旧内容
+        self._latest_content = {}
+        self.patch_log = PatchLog(project.root_path)
+        self.history = history or HistoryBuilder(project)
+        # 实体登记表与提及索引：设定纠错前先在本地筛出人名写串的可疑章节
+        self.entities = entities or EntityIndex(project)
         self._is_cancelled = False
+        self.llm = LLMSession(api_key, base_url, model, temperature, worker="correction")
+        self.llm.on_retry = self.log_signal.emit
 
     def set_target(self, v_idx, c_idx):
         self.target_v_idx = v_idx
@@ -596,16 +1064,10 @@ class CorrectionWorker(QThread):
 
     def cancel(self):
         self._is_cancelled = True
-        if hasattr(self, 'client'):
-            try:
-                self.client.close()
-            except:
-                pass
+        self.llm.cancel()
 
     def run(self):
         try:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-
             if self.scope == "chapter":
                 self._correct_single_chapter(self.target_v_idx, self.target_c_idx, self.mode)
             elif self.scope == "full":
@@ -620,33 +1082,18 @@ class CorrectionWorker(QThread):
             else:
                 self.error_signal.emit(str(e))
 
-    def _call_llm_json(self, sys_prompt, user_prompt):
-        resp = self.client.chat.completions.create(
-            model=self.model,
-            temperature=self.temperature,
+    def _call_llm_json(self, sys_prompt, user_prompt, stream_reasoning=True, strict=True):
+        # 流式传输以截获思考过程并实时发送到界面，JSON 正文在后台缓冲
+        # 多章并行时各路思考过程会交错在一起，此时不再推送到界面
+        content_buffer = self.llm.complete(
             response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": sys_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            stream=True  # 【修改处】强行开启流式传输以截获思考过程
+            on_reasoning=self.reasoning_signal.emit if stream_reasoning else None
         )
 
-        content_buffer = ""
-        for chunk in resp:
-            if self._is_cancelled: break
-            delta = chunk.choices[0].delta
-
-            # 实时提取并发送思考过程到界面
-            reasoning = getattr(delta, "reasoning_content", None)
-            if reasoning:
-                self.reasoning_signal.emit(reasoning)
-
-            # 缓冲后台的 JSON 正文
-            content = getattr(delta, "content", None)
-            if content:
-                content_buffer += content
-
         if self._is_cancelled:
             return {}
 
@@ -654,7 +1101,11 @@ class CorrectionWorker(QThread):
         try:
             return json.loads(content_buffer)
         except json.JSONDecodeError as e:
-            self.error_signal.emit(f"AI返回的JSON格式有误: {str(e)}")
+            # 分块校对时一块解析失败只影响这一块，记一笔日志即可，不必中断整个任务
+            if strict:
+                self.error_signal.emit(f"AI返回的JSON格式有误: {str(e)}")
+            else:
+                self.log_signal.emit(f"⚠️ AI返回的JSON格式有误，已跳过该片段: {str(e)}")
             return {}
 
     def _correct_single_chapter(self, v_idx, c_idx, mode):
@@ -673,26 +1124,56 @@ class CorrectionWorker(QThread):
 
         if "setting" in modes_to_run and not self._is_cancelled:
             self.status_signal.emit(f"🔍 正在进行【设定纠错】: {chap['name']}...")
+            self.entities.refresh(should_stop=lambda: self._is_cancelled)
+            local_issues = self.entities.suspicious_chapters().get((v_idx, c_idx), [])
+            for issue in local_issues:
+                self.log_signal.emit(f"🔎 [本地排查|{chap['name']}] {issue}")
             current_content, current_summary = self._do_setting_correction(v_idx, c_idx, current_content,
-                                                                           current_summary)
+                                                                           current_summary, local_issues=local_issues)
+            SettingScanState(self.project.root_path).mark_scanned(
+                [(vol["name"], chap["name"], current_summary, content_hash(current_content))])
 
         if "typo" in modes_to_run and not self._is_cancelled:
             self.status_signal.emit(f"📝 正在进行【错别字/语病纠错】: {chap['name']}...")
+            before_typo = current_content
             current_content = self._do_typo_correction(v_idx, c_idx, current_content)
+            SettingScanState(self.project.root_path).carry_over(
+                vol["name"], chap["name"], content_hash(before_typo), content_hash(current_content))
+            if not self._is_cancelled:
+                # 单章校对过的正文，下次全书校对时同样可以跳过
+                CorrectionProgress(self.project.root_path, "typo", version=self.TYPO_CHECK_VERSION).mark_done(
+                    vol["name"], chap["name"], current_content)
 
         # 统一保存
         self.update_text_signal.emit(v_idx, c_idx, current_content, current_summary)
 
     def _correct_full_book(self, mode):
         if mode in ["setting", "all"]:
-            self.status_signal.emit("🕵️ 开启全书扫描模式，正在统筹全局设定...")
-            # 第一阶段：排查有问题的章节
-            problem_list = self._detect_global_setting_conflicts()
+            self.status_signal.emit("🔎 正在本地筛查需要复核设定的章节...")
+            # 第一阶段：本地按可疑程度给章节排序，自上次复核后没改动过的章节不再送审
+            self.entities.refresh(should_stop=lambda: self._is_cancelled)
             if self._is_cancelled: return
-
-            if not problem_list:
-                self.log_signal.emit("✅ 全书设定逻辑严密，未发现吃书或设定矛盾现象！")
+            scan_state = SettingScanState(self.project.root_path)
+            candidates, skipped, skipped_tokens = self._rank_setting_candidates(scan_state)
+            if skipped:
+                self.log_signal.emit(f"⏭️ 设定复核跳过 {skipped} 个自上次复核后未改动的章节（约省 {skipped_tokens} tokens 的概要）。")
+            if not candidates:
+                self.log_signal.emit("✅ 自上次复核以来没有新写或改动过的章节，已跳过 AI 复核。")
+                problem_list = []
             else:
+                top = candidates[:self.SETTING_SCAN_TOP_K]
+                self.log_signal.emit(f"🔎 本地筛查出 {len(candidates)} 个待复核章节，本轮复核可疑度最高的 {len(top)} 个。")
+                suspects = {(v, c): reasons for _, v, c, reasons in top}
+                self.status_signal.emit("🕵️ 正在复核候选章节的设定矛盾...")
+                problem_list = self._detect_global_setting_conflicts(suspects)
+                if self._is_cancelled: return
+                # 复核无误的章节记为已扫描；有问题的章节在修复后按修复结果记录
+                flagged = {(issue.get("v_idx"), issue.get("c_idx")) for issue in problem_list}
+                scan_state.mark_scanned([self._scan_entry(v, c) for v, c in suspects if (v, c) not in flagged])
+
+            if candidates and not problem_list:
+                self.log_signal.emit("✅ 候选章节经复核均无设定矛盾！")
+            elif problem_list:
                 self.log_signal.emit(f"⚠️ 扫描完毕，发现 {len(problem_list)} 个设定矛盾章节，准备逐一修复。")
                 # 第二阶段：遍历修复
                 for issue in problem_list:
@@ -710,44 +1191,216 @@ class CorrectionWorker(QThread):
                     old_summary = self.meta["volumes"][v]["chapters"][c].get("ai_synopsis", "")
                     new_content, new_summary = self._do_setting_correction(v, c, old_content, old_summary,
                                                                            specific_reason=reason)
+                    self._latest_content[(v, c)] = new_content
                     self.update_text_signal.emit(v, c, new_content, new_summary)
+                    scan_state.mark_scanned([(vol_name, chap_name, new_summary, content_hash(new_content))])
 
         if mode in ["typo", "all"]:
-            self.status_signal.emit("📝 开启全书错别字/语病排查...")
-            for v_idx, vol in enumerate(self.meta["volumes"]):
-                for c_idx, chap in enumerate(vol["chapters"]):
-                    if self._is_cancelled: return
-                    self.status_signal.emit(f"📝 正在校对: {vol['name']} - {chap['name']}...")
-                    old_content = self.project.read_chapter_content(vol["name"], chap["name"])
-                    if old_content.strip():
-                        new_content = self._do_typo_correction(v_idx, c_idx, old_content)
-                        summary = chap.get("ai_synopsis", "")
-                        self.update_text_signal.emit(v_idx, c_idx, new_content, summary)
+            self._correct_full_book_typos()
+
+    def _rank_setting_candidates(self, scan_state):
+        """
+        本地给章节打分排序，返回 (候选, 跳过的章数, 跳过的概要 token 估算)。
+        候选为 [(分数, v_idx, c_idx, [理由, ...]), ...]，分数高的在前。
+        实体索引发现的人名疑点权重最高，其次是从未复核过的新章节和概要有改动的章节，正文改动和前文改动最低；
+        自上次复核以来概要和正文都没变、前几章也没改动的章节不进候选，哪怕实体索引仍有疑点（上次已经复核过了）。
+        """
+        suspects = self.entities.suspicious_chapters()
+        candidates = []
+        skipped = 0
+        skipped_tokens = 0
+        upstream = None  # 最近一个有改动的章节名，以及它之后还有几章需要复核衔接
+        for v_idx, vol in enumerate(self.meta["volumes"]):
+            for c_idx, chap in enumerate(vol["chapters"]):
+                summary = chap.get("ai_synopsis", "")
+                body_hash = self.entities.content_digest(vol["name"], chap["name"])
+                changes = scan_state.changes(vol["name"], chap["name"], summary, body_hash)
+                downstream_of = None
+                if upstream and upstream[1] > 0:
+                    downstream_of = upstream[0]
+                    upstream = (upstream[0], upstream[1] - 1)
+                if changes:
+                    upstream = (chap["name"], self.SETTING_DOWNSTREAM_CHAPTERS)
+                elif downstream_of is None:
+                    skipped += 1
+                    skipped_tokens += estimate_tokens(summary)
+                    continue
+                if not summary.strip() and (v_idx, c_idx) not in suspects:
+                    continue  # 没有概要也没有本地疑点，送审也看不出什么
+                reasons = list(suspects.get((v_idx, c_idx), [])) if changes else []
+                score = self.SETTING_SCORE_ENTITY * len(reasons)
+                if "new" in changes:
+                    score += self.SETTING_SCORE_NEW
+                    reasons.append("新写章节，尚未复核过设定")
+                if "summary" in changes:
+                    score += self.SETTING_SCORE_SUMMARY
+                    reasons.append("概要自上次复核后有改动")
+                if "body" in changes:
+                    score += self.SETTING_SCORE_BODY
+                    reasons.append("正文自上次复核后有改动")
+                if downstream_of is not None:
+                    score += self.SETTING_SCORE_DOWNSTREAM
+                    reasons.append(f"前文[{downstream_of}]有改动，需复核与之的衔接")
+                candidates.append((score, v_idx, c_idx, reasons))
+        # 同分时按阅读顺序，靠前的章节先复核
+        candidates.sort(key=lambda item: (-item[0], item[1], item[2]))
+        return candidates, skipped, skipped_tokens
+
+    def _scan_entry(self, v_idx, c_idx):
+        vol = self.meta["volumes"][v_idx]
+        chap = vol["chapters"][c_idx]
+        return (vol["name"], chap["name"], chap.get("ai_synopsis", ""),
+                self.entities.content_digest(vol["name"], chap["name"]))
+
+    def _on_throttled(self, new_limit, wait):
+        self.log_signal.emit(f"⚠️ 触发接口限流，并发已降为 {new_limit} 路，{wait:.0f} 秒后重试。")
+
+    def _run_limited(self, jobs, fn, limiter):
+        """在线程池里并发执行 fn(job)，按完成先后产出 (job, result)；被取消的任务结果为 None"""
+        pool = ThreadPoolExecutor(max_workers=limiter.max_limit)
+        try:
+            futures = {
+                pool.submit(run_with_limiter, limiter, lambda job=job: fn(job), lambda: self._is_cancelled,
+                            on_throttled=self._on_throttled, policy=self.llm.retry_policy): job
+                for job in jobs
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _correct_full_book_typos(self):
+        self.status_signal.emit("📝 开启全书错别字/语病排查...")
+        progress = CorrectionProgress(self.project.root_path, "typo", version=self.TYPO_CHECK_VERSION)
+        scan_state = SettingScanState(self.project.root_path)
+        progress.prune([(v["name"], c["name"]) for v in self.meta["volumes"] for c in v["chapters"]])
+
+        # 每章切成若干段落窗口，全书所有窗口放进同一个池子里并发校对
+        chapters = {}
+        jobs = []
+        skipped = 0
+        skipped_tokens = 0
+        for v_idx, vol in enumerate(self.meta["volumes"]):
+            for c_idx, chap in enumerate(vol["chapters"]):
+                content = self._latest_content.get((v_idx, c_idx))
+                if content is None:
+                    content = self.project.read_chapter_content(vol["name"], chap["name"])
+                if not content.strip():
+                    continue
+                # 校对过且之后没再改动过的章节直接跳过（含上次被中断的那一轮）
+                if progress.is_done(vol["name"], chap["name"], content):
+                    skipped += 1
+                    skipped_tokens += estimate_tokens(content)
+                    continue
+                paragraphs = split_paragraphs(content)
+                windows = make_windows(paragraphs)
+                chapters[(v_idx, c_idx)] = {"content": content, "paragraphs": paragraphs,
+                                            "offsets": paragraph_offsets(paragraphs),
+                                            "remaining": len(windows), "edits": []}
+                jobs.extend((v_idx, c_idx, window) for window in windows)
+
+        if skipped:
+            self.log_signal.emit(f"⏭️ 错别字校对跳过 {skipped} 个自上次校对后未改动的章节（约省 {skipped_tokens} tokens 的正文）。")
+        if not chapters:
+            self.log_signal.emit("✅ 没有新写或改动过的章节，无需校对。")
+            return
+
+        total = len(chapters)
+        limiter = AdaptiveLimiter(self.max_concurrency)
+        stream_reasoning = self.max_concurrency == 1
+
+        def run_job(job):
+            v_idx, c_idx, window = job
+            vol = self.meta["volumes"][v_idx]
+            chap_name = vol["chapters"][c_idx]["name"]
+            state = chapters[(v_idx, c_idx)]
+            with self.llm.usage_scope(vol["name"], chap_name):
+                return self._correct_typo_window(chap_name, state["paragraphs"], state["offsets"], window,
+                                                 stream_reasoning=stream_reasoning)
+
+        self.status_signal.emit(f"📝 正在并行校对 (0/{total})，最多同时 {self.max_concurrency} 路请求...")
+        done = 0
+        # 某一章的所有窗口都校对完就立刻合并回写，不必等全书结束
+        for (v_idx, c_idx, _), edits in self._run_limited(jobs, run_job, limiter):
+            if edits is None or self._is_cancelled:
+                return
+            state = chapters[(v_idx, c_idx)]
+            state["edits"].extend(edits)
+            state["remaining"] -= 1
+            if state["remaining"]:
+                continue
+
+            vol = self.meta["volumes"][v_idx]
+            chap = vol["chapters"][c_idx]
+            new_content = self._apply_edits(v_idx, c_idx, "typo", state["content"], state["edits"])
+            self.update_text_signal.emit(v_idx, c_idx, new_content, chap.get("ai_synopsis", ""))
+            progress.mark_done(vol["name"], chap["name"], new_content)
+            scan_state.carry_over(vol["name"], chap["name"], content_hash(state["content"]), content_hash(new_content))
+            done += 1
+            self.status_signal.emit(f"📝 已校对 ({done}/{total}): {vol['name']} - {chap['name']}")
 
     def _do_typo_correction(self, v_idx, c_idx, content):
+        """单章校对：按段落窗口切分后并发请求，各窗口只返回改动的片段，最后在本地合并"""
+        vol_name = self.meta["volumes"][v_idx]["name"]
+        chap_name = self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
+        paragraphs = split_paragraphs(content)
+        offsets = paragraph_offsets(paragraphs)
+        windows = make_windows(paragraphs)
+        limiter = AdaptiveLimiter(self.max_concurrency)
+        # 只有一路请求时思考过程才不会交错，才推送到界面
+        stream_reasoning = self.max_concurrency == 1 or len(windows) == 1
+
+        def run_window(window):
+            with self.llm.usage_scope(vol_name, chap_name):
+                return self._correct_typo_window(chap_name, paragraphs, offsets, window, stream_reasoning)
+
+        edits = []
+        for _, window_edits in self._run_limited(windows, run_window, limiter):
+            if window_edits is None or self._is_cancelled:
+                return content
+            edits.extend(window_edits)
+        return self._apply_edits(v_idx, c_idx, "typo", content, edits)
+
+    def _apply_edits(self, v_idx, c_idx, mode, content, edits):
+        """在本地把片段修改合并进正文，并把实际生效的补丁记入补丁日志"""
+        vol = self.meta["volumes"][v_idx]
+        chap = vol["chapters"][c_idx]
+        new_content, patches, failed = apply_snippet_edits(content, edits)
+        for edit in failed:
+            self.log_signal.emit(f"⚠️ [{chap['name']}] 未能在正文中定位片段，已跳过该处修改: '{edit['original'][:30]}'")
+        self.patch_log.record(vol["name"], chap["name"], mode, patches)
+        return new_content
+
+    def _correct_typo_window(self, chap_name, paragraphs, offsets, window, stream_reasoning=True):
+        core_start, core_end, ctx_start, ctx_end = window
+        numbered = number_paragraphs(paragraphs, ctx_start, ctx_end, editable=(core_start, core_end))
         sys_prompt = "你是一个火眼金睛的专业小说文字校对。你的任务是找出正文中的错别字和语病，并直接修改。必须返回严格的JSON。"
         user_prompt = f"""
-请校对以下正文。
+请校对以下正文片段，每段开头的 [数字] 是段号。
 要求：
 1. 修正错别字、标点错误、明显不通顺的语病。
 2. 保持原作者的文风和网文特有的爽感表达，不要做不必要的润色和过度修改。
+3. 标注“仅供参考，勿改”的段落只是上下文，不要修改。
+4. 只返回需要修改的地方：original 从原文一字不差地摘取出错的短句（够定位即可，不要整段照抄），replacement 为改正后的写法。
 
-正文内容：
-{content}
+正文片段：
+{numbered}
 
 返回格式（严格JSON）：
 {{
-    "corrected_text": "完整的修正后的正文（必须完整包含所有段落）",
+    "edits": [{{"p": 所在段号(整数), "original": "原文中出错的短句", "replacement": "修改后的短句"}}],
     "logs": ["发现[错别字/语病]：原句'...'，修改为'...'"]
 }}
+如果没有任何问题，"edits" 和 "logs" 返回空数组。
 """
-        result = self._call_llm_json(sys_prompt, user_prompt)
+        result = self._call_llm_json(sys_prompt, user_prompt, stream_reasoning=stream_reasoning, strict=False)
+        if self._is_cancelled:
+            return None
         for log in result.get("logs", []):
-            chap_name = self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
             self.log_signal.emit(f"✍️ [校对|{chap_name}] {log}")
-        return result.get("corrected_text", content)
+        return parse_snippet_edits(result.get("edits"), offsets, allowed=(core_start, core_end))
 
-    def _do_setting_correction(self, v_idx, c_idx, content, summary, specific_reason=None):
+    def _do_setting_correction(self, v_idx, c_idx, content, summary, specific_reason=None, local_issues=()):
         # 组装全局和局部大纲作为标准
         global_synopsis = self.meta.get("global_synopsis", "")
         vol = self.meta["volumes"][v_idx]
@@ -763,6 +1416,9 @@ class CorrectionWorker(QThread):
         if past_summaries.strip():
             user_prompt += f"【过往剧情轨迹(防吃书基准)】：\n{past_summaries}\n\n"
         user_prompt += f"【本卷核心设定】：\n{vol.get('synopsis', '无')}\n\n"
+        if local_issues:
+            # 本地实体索引发现的疑点只是线索，可能是正常的新人物或词语，需要模型结合上下文判断
+            user_prompt += "【本地排查提示(仅供参考，请核实)】：\n" + "\n".join(local_issues) + "\n\n"
 
         if specific_reason:
             # 【升级点2】：全局纠错传入了具体理由，要求结合前文详细扫描并修复
@@ -771,7 +1427,9 @@ class CorrectionWorker(QThread):
             # 单章纠错模式：让 AI 自己找茬并给出详细理由
             user_prompt += "【目标任务】：请仔细比对【过往剧情轨迹】和【全书设定】，检查下方正文中是否存在人物崩塌、前言不搭后语、逻辑矛盾（吃书现象，例如：死人复活未说明原因、物品归属错乱等）。请先给出详细的错误诊断理由，然后在正文中直接修复它们。\n\n"
 
-        user_prompt += f"【当前章节正文】：\n{content}\n\n"
+        # 正文带段号发送，模型只需返回改动过的段落，不必把整章原样抄回来
+        paragraphs = split_paragraphs(content)
+        user_prompt += f"【当前章节正文】(每段开头的 [数字] 是段号)：\n{number_paragraphs(paragraphs)}\n\n"
         user_prompt += f"【当前章原AI概要】：\n{summary}\n\n"
 
         # 【升级点3】：强制要求输出 error_reason 字段
@@ -780,12 +1438,13 @@ class CorrectionWorker(QThread):
 {
     "has_issue": true/false, // 如果没有发现任何逻辑设定错误，返回false
     "error_reason": "详细的错误诊断理由。如果has_issue为true，必须说明正文具体哪里吃书或矛盾了，与前文哪一章冲突。如果为false则填无。",
-    "corrected_text": "修复后的完整正文（如果无错误，原样返回）",
+    "edits": [{"p": 所在段号(整数), "original": "从原文一字不差摘取的需要改动的句子", "replacement": "修复后的文字（需要补写内容时可包含换行拆成多段）"}], // 只列出需要修改的地方，无错误则为空数组
     "new_ai_summary": "如果正文剧情被修改，请同步更新AI概要（约500字，客观纪实结构化记录核心事件和伏笔）。如果无修改则原样返回。",
     "logs": ["发现[逻辑设定问题]：...，因此修改了..."] // 记录简要的纠错动作
 }
 """
-        result = self._call_llm_json(sys_prompt, user_prompt)
+        with self.llm.usage_scope(vol["name"], chap["name"]):
+            result = self._call_llm_json(sys_prompt, user_prompt)
 
         if result.get("has_issue", False):
             # 将详细的诊断理由打印到 UI 的日志侧边栏中
@@ -795,27 +1454,41 @@ class CorrectionWorker(QThread):
 
             for log in result.get("logs", []):
                 self.log_signal.emit(f"🛠️ [设定修复|{chap['name']}] {log}")
-            return result.get("corrected_text", content), result.get("new_ai_summary", summary)
+            edits = parse_snippet_edits(result.get("edits"), paragraph_offsets(paragraphs))
+            new_content = self._apply_edits(v_idx, c_idx, "setting", content, edits)
+            return new_content, result.get("new_ai_summary", summary)
 
         return content, summary
 
-    def _detect_global_setting_conflicts(self):
+    def _detect_global_setting_conflicts(self, suspects):
+        """suspects 为本地筛查出的 {(v_idx, c_idx): [筛查理由, ...]}，只复核这些章节"""
         # 拼接全书梗概和卷章用户设纲
         sys_context = f"【全书全局大纲】\n{self.meta.get('global_synopsis', '')}\n\n"
         char_texts = [f"【{c['name']}】 性别:{c['gender']} 性格:{c['personality']} 经历:{c['experience']}" for c in
                       self.meta.get("characters", [])]
         sys_context += f"【核心人物设定】\n{chr(10).join(char_texts)}\n\n"
 
-        # 拼接AI总结的所有章节概要
+        # 只拼接候选章节的AI概要及本地筛查的理由
         all_summaries = ""
         for v_idx, vol in enumerate(self.meta["volumes"]):
+            chapters = [(c_idx, chap) for c_idx, chap in enumerate(vol["chapters"]) if (v_idx, c_idx) in suspects]
+            if not chapters:
+                continue
             all_summaries += f"\n▶ 第{v_idx + 1}卷: {vol['name']}\n"
-            for c_idx, chap in enumerate(vol["chapters"]):
+            for c_idx, chap in chapters:
                 all_summaries += f"  - 第{c_idx + 1}章 [{chap['name']}]: {chap.get('ai_synopsis', '暂无概要')}\n"
+                all_summaries += f"    本地筛查理由: {'；'.join(suspects[(v_idx, c_idx)])}\n"
+
+        # 候选章节之前的剧情轨迹作为比对基准，受 token 上限约束，不随全书长度增长
+        last_v, last_c = max(suspects)
+        past_summaries = self.history.budgeted(last_v, last_c)
 
         sys_prompt = f"你是一个网文剧情质检专家。这是本书的核心设定基石，请牢记：\n{sys_context}"
-        user_prompt = f"""以下是AI总结的本书目前所有章节的剧情概要。
-请排查是否存在：
+        user_prompt = f"""【过往剧情轨迹(比对基准)】：
+{past_summaries}
+
+以下是本地筛查出的待复核章节的AI剧情概要，附有筛查理由（理由只说明为什么要复核，疑似笔误也可能只是正常的新人物或词语，需要你判断）。
+请结合过往剧情轨迹，排查这些章节是否存在：
 1. 明显偏离【全局大纲】和【核心人物设定】的剧情。
 2. 内部逻辑矛盾（吃书现象，例如：死人复活未说明原因、物品归属错乱、人物性格变化极大、人名串台）。
 
@@ -836,26 +1509,16 @@ class CorrectionWorker(QThread):
 如果完全没有矛盾，"problematic_chapters"返回空数组。
 """
         result = self._call_llm_json(sys_prompt, user_prompt)
-        return result.get("problematic_chapters", [])
+        problems = []
+        for issue in result.get("problematic_chapters", []):
+            # 只认本次复核范围内的章节，防止模型编造越界的索引
+            if isinstance(issue, dict) and (issue.get("v_idx"), issue.get("c_idx")) in suspects:
+                problems.append(issue)
+        return problems
 
     def _get_past_summaries(self, target_v_idx, target_c_idx):
         """获取目标章节之前的所有剧情概要（作为防吃书的记忆基准）"""
-        history_str = ""
-        for v_idx in range(target_v_idx + 1):
-            vol = self.meta["volumes"][v_idx]
-            history_str += f"\n▶ 第{v_idx + 1}卷: {vol['name']} (本卷梗概: {vol.get('synopsis', '无')})\n"
-
-            # 限制章节遍历范围：如果是目标章节所在卷，只遍历到目标章节之前；如果是之前的卷，遍历整卷
-            chap_limit = target_c_idx if v_idx == target_v_idx else len(vol["chapters"])
-            for c_idx in range(chap_limit):
-                chap = vol["chapters"][c_idx]
-                # 优先读取 AI 之前生成的详细梗概，没有则读用户的
-                ai_syn = chap.get("ai_synopsis", "")
-                user_syn = chap.get("synopsis", "")
-                display_syn = ai_syn if ai_syn.strip() else (user_syn if user_syn.strip() else "暂无概要")
-
-                history_str += f"  - 第{c_idx + 1}章 [{chap['name']}]: {display_syn}\n"
-        return history_str
+        return self.history.budgeted(target_v_idx, target_c_idx)
 
 class SummaryWorker(QThread):
     status_signal = pyqtSignal(str)
@@ -863,9 +1526,10 @@ class SummaryWorker(QThread):
     finished_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
 
-    def __init__(self, api_key, base_url, model, temperature, tasks):
+    def __init__(self, api_key, base_url, model, temperature, tasks, max_concurrency=4):
         """
         tasks 格式: [{"v_idx": int, "c_idx": int, "vol_name": str, "chap_name": str, "content": str}, ...]
+        max_concurrency: 同时在途的总结请求数上限，遇到 429 限流时会自动收缩
         """
         super().__init__()
         self.api_key = api_key
@@ -873,28 +1537,56 @@ class SummaryWorker(QThread):
         self.model = model
         self.temperature = temperature
         self.tasks = tasks
+        self.max_concurrency = max(1, int(max_concurrency))
         self._is_cancelled = False
+        self.llm = LLMSession(api_key, base_url, model, temperature, worker="summary")
+        self.llm.on_retry = self.status_signal.emit
 
     def cancel(self):
         self._is_cancelled = True
-        if hasattr(self, 'client'):
-            try:
-                self.client.close()
-            except Exception:
-                pass
+        self.llm.cancel()
 
     def run(self):
+        total = len(self.tasks)
+        limiter = AdaptiveLimiter(self.max_concurrency)
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
         try:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-            for i, task in enumerate(self.tasks):
+            futures = {pool.submit(self._summarize_task, task, limiter): task for task in self.tasks}
+            self.status_signal.emit(f"⏳ 正在为前文补全 AI 总结 (0/{total})，并发 {self.max_concurrency} 路...")
+
+            done = 0
+            # 谁先完成就先回写谁，不必按章节顺序等待
+            for future in as_completed(futures):
                 if self._is_cancelled:
                     break
-
+                task = futures[future]
+                summary = future.result()
+                done += 1
+                if summary:
+                    self.summary_ready_signal.emit(task['v_idx'], task['c_idx'], summary)
                 self.status_signal.emit(
-                    f"⏳ 正在为前文补全 AI 总结 ({i + 1}/{len(self.tasks)}): {task['vol_name']} - {task['chap_name']}")
+                    f"⏳ 正在为前文补全 AI 总结 ({done}/{total}): 已完成 {task['vol_name']} - {task['chap_name']}"
+                    f"（当前并发 {limiter.limit} 路）")
 
-                sys_prompt = "你是一个专业的小说阅读助手和主编。必须返回严格的JSON对象。"
-                user_prompt = f"""
+            self.finished_signal.emit()
+        except Exception as e:
+            self.cancel()  # 出现非限流类错误时终止整批，停掉其他在途请求
+            self.error_signal.emit(str(e))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _summarize_task(self, task, limiter):
+        # 429：收缩并发后稍等再重新排队，而不是让整批任务失败
+        def on_throttled(new_limit, wait):
+            self.status_signal.emit(f"⚠️ 触发接口限流，并发已降为 {new_limit} 路，{wait:.0f} 秒后重试：{task['chap_name']}")
+
+        summary = run_with_limiter(limiter, lambda: self._request_summary(task), lambda: self._is_cancelled,
+                                   on_throttled=on_throttled, policy=self.llm.retry_policy)
+        return summary or ""
+
+    def _request_summary(self, task):
+        sys_prompt = "你是一个专业的小说阅读助手和主编。必须返回严格的JSON对象。"
+        user_prompt = f"""
 请仔细阅读以下小说章节内容，并严格按照以下3个维度输出约500字的本章详细梗概（客观、精炼，作为后续AI写作的记忆锚点）：
 1. 核心剧情脉络：按时间顺序简述本章发生的实质性事件。
 2. 人物状态更新：记录本章主角及配角的行为及心态。
@@ -908,32 +1600,26 @@ class SummaryWorker(QThread):
     "summary": "生成的500字详细结构化梗概"
 }}
 """
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=self.temperature,
-                    response_format={"type": "json_object"},
-                    messages=[
-                        {"role": "system", "content": sys_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-
-                # 解析返回的JSON，兼容可能带有 Markdown 代码块的情况
-                content = response.choices[0].message.content.strip()
-                if content.startswith("```json"):
-                    content = content[7:]
-                if content.endswith("```"):
-                    content = content[:-3]
-
-                result = json.loads(content)
-                summary = result.get("summary", "")
+        with self.llm.usage_scope(task['vol_name'], task['chap_name']):
+            content = self.llm.complete(
+                response_format={"type": "json_object"},
+                messages=[
+                    {"role": "system", "content": sys_prompt},
+                    {"role": "user", "content": user_prompt}
+                ]
+            )
+        if self._is_cancelled:
+            return ""
 
-                if summary:
-                    self.summary_ready_signal.emit(task['v_idx'], task['c_idx'], summary)
+        # 解析返回的JSON，兼容可能带有 Markdown 代码块的情况
+        content = content.strip()
+        if content.startswith("```json"):
+            content = content[7:]
+        if content.endswith("```"):
+            content = content[:-3]
 
-            self.finished_signal.emit()
-        except Exception as e:
-            self.error_signal.emit(str(e))
+        result = json.loads(content)
+        return result.get("summary", "")
 
 class SegmentModifyWorker(QThread):
     reasoning_signal = pyqtSignal(str)
@@ -941,7 +1627,8 @@ class SegmentModifyWorker(QThread):
     finished_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
 
-    def __init__(self, api_key, base_url, model, temperature, sys_prompt, user_prompt):
+    def __init__(self, api_key, base_url, model, temperature, sys_prompt, user_prompt, chapter=None):
+        """chapter 为正在修改的 (卷名, 章名)，用于用量台账"""
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
@@ -950,31 +1637,23 @@ class SegmentModifyWorker(QThread):
         self.sys_prompt = sys_prompt
         self.user_prompt = user_prompt
         self._is_cancelled = False
+        self.llm = LLMSession(api_key, base_url, model, temperature, worker="modify", chapter=chapter)
+        self.llm.on_retry = lambda msg: self.reasoning_signal.emit(f"\n{msg}\n")
 
     def cancel(self):
         self._is_cancelled = True
-        if hasattr(self, 'client'):
-            try:
-                self.client.close()
-            except Exception:
-                pass
+        self.llm.cancel()
 
     def run(self):
         try:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=self.temperature,
+            response = self.llm.stream_chat(
                 messages=[
                     {"role": "system", "content": self.sys_prompt},
                     {"role": "user", "content": self.user_prompt}
-                ],
-                stream=True
+                ]
             )
 
             for chunk in response:
-                if self._is_cancelled:
-                    break
                 delta = chunk.choices[0].delta
 
                 reasoning = getattr(delta, "reasoning_content", None)
@@ -987,4 +1666,49 @@ class SegmentModifyWorker(QThread):
 
             self.finished_signal.emit()
         except Exception as e:
-            self.error_signal.emit(str(e))
\ No newline at end of file
+            self.error_signal.emit(str(e))
+
+class RetrievalIndexWorker(QThread):
+    """后台读入全书，完成写作检索索引的首次构建；建好之前界面上的生成不附带检索片段"""
+    finished_signal = pyqtSignal(bool)  # 是否完整建完
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, retrieval):
+        super().__init__()
+        self.retrieval = retrieval
+        self._is_cancelled = False
+
+    def cancel(self):
+        self._is_cancelled = True
+
+    def run(self):
+        try:
+            self.finished_signal.emit(self.retrieval.build(should_stop=lambda: self._is_cancelled))
+        except Exception as e:
+            self.error_signal.emit(str(e))
+
+
+class SearchIndexWorker(QThread):
+    """后台补齐全文检索索引（首次打开大部头时需要逐章入库）"""
+    status_signal = pyqtSignal(str)
+    finished_signal = pyqtSignal(int)  # 本次重建的章数
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, search_index):
+        super().__init__()
+        self.search_index = search_index
+        self._is_cancelled = False
+
+    def cancel(self):
+        self._is_cancelled = True
+
+    def run(self):
+        try:
+            def progress(done, total):
+                if done % 20 == 0 or done == total:
+                    self.status_signal.emit(f"🔍 正在建立全文索引 ({done}/{total})...")
+
+            rebuilt = self.search_index.sync(progress=progress, should_stop=lambda: self._is_cancelled)
+            self.finished_signal.emit(rebuilt)
+        except Exception as e:
+            self.error_signal.emit(str(e))
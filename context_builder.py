@@ -0,0 +1,295 @@
+# context_builder.py
+import re
+import threading
+
+# 剧情轨迹默认的 token 上限；整本书的历史超出时按“近详远略”的层级压缩
+DEFAULT_HISTORY_BUDGET = 16000
+# 预算中留给“最近章节完整梗概”的比例，其余依次留给较早章节的精简梗概和远处卷的卷级摘要
+RECENT_SHARE = 0.6
+CONDENSED_SHARE = 0.25
+# 较早章节只保留梗概的开头这么多字
+CONDENSED_CHARS = 120
+# 当前卷之前保留逐章梗概的卷数；更早且已有卷级摘要的卷一律只用摘要
+DETAILED_VOLUMES = 1
+# 压缩后的剧情轨迹不必每章都重新压缩：预算中留出这一比例给“锚点”之后追加的章节梗概，
+# 追加的部分用满了才换下一个锚点重新压缩，其间连续几章的 prompt 共享同一段前缀，能命中服务端的前缀缓存
+ANCHOR_RESERVE_SHARE = 0.2
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """
+    本地估算 token 数，不依赖具体模型的分词器。
+    中文（含全角标点）按每字 1 个 token 计，其余字符按约 3.5 个字符 1 个 token 计，估算偏保守。
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) * 2 // 7
+
+
+def condense_synopsis(text, limit=CONDENSED_CHARS):
+    """
+    把章节梗概压缩成一两句话：结构化的 AI 概要只取“核心剧情脉络”部分，
+    再在 limit 字以内按句号截断。
+    """
+    text = text.strip()
+    match = re.search(r"核心剧情脉络[：:]?\s*(.*?)(?:\n\s*2[\.、．]|$)", text, re.S)
+    if match and match.group(1).strip():
+        text = match.group(1).strip()
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    end = max(cut.rfind(mark) for mark in "。！？；")
+    return (cut[:end + 1] if end >= limit // 3 else cut) + "…"
+
+
+def volume_digest(vol):
+    """远处卷在剧情轨迹中的代表：优先使用卷级摘要，尚未生成时退回卷梗概"""
+    return vol.get("digest") or vol.get("synopsis") or "无"
+
+
+def format_volume_digest_line(vol):
+    return f"▶ {vol['name']} (卷级摘要: {volume_digest(vol)})\n"
+
+
+def chapter_display_synopsis(chap):
+    """章节在剧情轨迹里展示的梗概：优先 AI 概要，其次用户细纲"""
+    ai_syn = chap.get("ai_synopsis", "")
+    if ai_syn.strip():
+        return ai_syn
+    user_syn = chap.get("synopsis", "")
+    return user_syn if user_syn.strip() else "暂无梗概"
+
+
+def format_volume_line(vol):
+    return f"▶ {vol['name']} (本卷梗概: {vol.get('synopsis') or '无'})\n"
+
+
+def format_chapter_line(chap):
+    return f"  - {chap['name']}: {chapter_display_synopsis(chap)}\n"
+
+
+class HistoryBuilder:
+    """
+    “过往剧情轨迹”的增量构建器。
+    全书的卷头/章节梗概按阅读顺序拼成一条前缀文本，并记下每卷、每章在其中的起始偏移；
+    第 k 章之前的历史就是这条前缀的一个切片。挂机按顺序往后写时每章只需追加一行，
+    不必每次从第一卷重新拼接。
+    通过项目的变更监听得知梗概/结构被修改，只把修改位置之后的部分作废，下次用到时再补建。
+    """
+
+    def __init__(self, project, token_budget=DEFAULT_HISTORY_BUDGET):
+        self.project = project
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self._reset()
+        project.add_change_listener(self._on_project_change)
+
+    def close(self):
+        self.project.remove_change_listener(self._on_project_change)
+
+    def _reset(self):
+        self._text = ""
+        self._vol_offsets = []   # 第 v 卷卷头在 _text 中的起始位置
+        self._chap_offsets = []  # 第 v 卷第 c 章那一行的起始位置
+        # 下一个待追加的位置：(卷, 章)，章为 -1 表示该卷卷头
+        self._v, self._c = 0, -1
+
+    # --- 查询接口 ---
+    def before_chapter(self, v_idx, c_idx):
+        """第 v_idx 卷第 c_idx 章之前的全部历史（含本卷卷头与本卷前面的章节）"""
+        return self._prefix(v_idx, c_idx)
+
+    def before_volume(self, v_idx):
+        """第 v_idx 卷之前所有卷的历史"""
+        return self._prefix(v_idx, -1)
+
+    def full(self):
+        return self._prefix(len(self.project.meta["volumes"]), -1)
+
+    def budgeted(self, v_idx, c_idx=-1, max_tokens=None):
+        """
+        受 token 上限约束的剧情轨迹（(v_idx, c_idx) 之前的部分，c_idx 为 -1 表示该卷之前）。
+        整段历史放得下时与 before_chapter/before_volume 完全相同；放不下时由近及远分层压缩：
+        最近的章节给完整梗概，再往前给精简梗概，更远的卷只给卷级摘要，总量不超过上限。
+        压缩只做到本卷的某个锚点章节为止，锚点之后的章节梗概原样追加在末尾；
+        同一锚点下相邻两章拿到的剧情轨迹是“前一章的 + 一行”，逐字节共享前缀。
+        """
+        max_tokens = max_tokens or self.token_budget
+        prefix = self._rollup_prefix(v_idx, c_idx)
+        # 每个字符至多估 1 个 token，字数没超上限就不必逐字估算
+        if len(prefix) <= max_tokens or estimate_tokens(prefix) <= max_tokens:
+            return prefix
+        volumes = self.project.meta["volumes"]
+        if 0 < c_idx and v_idx < len(volumes):
+            # 从本卷开头按顺序切段：追加部分超出预留额度就在该章另起锚点。锚点只取决于前面各章的梗概，
+            # 所以往后写新章节时，已经确定的锚点不会移动
+            reserve = int(max_tokens * ANCHOR_RESERVE_SHARE)
+            lines = [format_chapter_line(chap) for chap in volumes[v_idx]["chapters"][:c_idx]]
+            anchor, used = 0, 0
+            for i, line in enumerate(lines):
+                cost = estimate_tokens(line)
+                if used + cost > reserve:
+                    anchor, used = i, 0
+                used += cost
+            if used <= reserve:
+                return self._compress(v_idx, anchor, max_tokens - reserve) + "".join(lines[anchor:])
+        return self._compress(v_idx, c_idx, max_tokens)
+
+    def _compress(self, v_idx, c_idx, max_tokens):
+        volumes = self.project.meta["volumes"]
+        v_idx = min(v_idx, len(volumes))
+        recent_budget = max_tokens * RECENT_SHARE
+        condensed_budget = max_tokens * (RECENT_SHARE + CONDENSED_SHARE)
+
+        # 从目标位置往前逐章回溯，直到预算用完；回溯的开销只与预算有关，与全书长度无关
+        used = 0
+        chapter_lines = {}  # v -> 倒序收集的章节行
+        stop_v = -1  # 回溯在这一卷中途停下；更早的卷只保留卷级摘要
+        for v in range(v_idx, -1, -1):
+            if v >= len(volumes) or (v == v_idx and c_idx == -1):
+                continue
+            chapters = volumes[v]["chapters"]
+            limit = c_idx if v == v_idx else len(chapters)
+            lines = chapter_lines.setdefault(v, [])
+            used += estimate_tokens(format_volume_line(volumes[v]))
+            for c in range(min(limit, len(chapters)) - 1, -1, -1):
+                chap = chapters[c]
+                full_line = format_chapter_line(chap)
+                cost = estimate_tokens(full_line)
+                if used + cost <= recent_budget:
+                    lines.append(full_line)
+                else:
+                    short_line = f"  - {chap['name']}: {condense_synopsis(chapter_display_synopsis(chap))}\n"
+                    cost = estimate_tokens(short_line)
+                    if used + cost > condensed_budget:
+                        break
+                    lines.append(short_line)
+                used += cost
+            else:
+                continue
+            stop_v = v
+            break
+
+        # 组装：远处卷用卷级摘要，从最近的往前加，直到触到硬上限
+        head_lines = []
+        notice = "【注意：因前文过长，较早的卷仅保留卷级摘要，较早的章节仅保留精简梗概】\n"
+        used += estimate_tokens(notice)
+        for v in range(stop_v - 1, -1, -1):
+            line = format_volume_digest_line(volumes[v])
+            cost = estimate_tokens(line)
+            if used + cost > max_tokens:
+                head_lines.append("▶ ……(更早的卷已省略)\n")
+                break
+            head_lines.append(line)
+            used += cost
+        head_lines.reverse()
+
+        parts = [notice] + head_lines
+        last_v = v_idx if c_idx != -1 else v_idx - 1
+        for v in range(max(stop_v, 0), last_v + 1):
+            if v >= len(volumes):
+                break
+            parts.append(format_volume_line(volumes[v]))
+            if v == stop_v and len(chapter_lines.get(v, [])) < len(volumes[v]["chapters"]):
+                parts.append("  - ……(本卷更早的章节已省略)\n")
+            parts.extend(reversed(chapter_lines.get(v, [])))
+        return "".join(parts)
+
+    def _rollup_prefix(self, v_idx, c_idx):
+        """
+        已完结的远处卷（当前卷往前 DETAILED_VOLUMES 卷之外）若有卷级摘要，就用一行摘要代替整卷的逐章梗概；
+        其余部分直接取增量前缀的切片。
+        """
+        # 目标卷（c_idx 为 -1 时是目标位置之后的那一卷）往前数，最近的几卷保持逐章明细
+        current = v_idx if c_idx != -1 else v_idx - 1
+        first_detailed = max(0, current - DETAILED_VOLUMES)
+        volumes = self.project.meta["volumes"]
+        if not any(volumes[v].get("digest") for v in range(min(first_detailed, len(volumes)))):
+            return self._prefix(v_idx, c_idx)
+
+        with self._lock:
+            self._extend_to(v_idx, c_idx)
+            end = self._offset_of(v_idx, c_idx)
+            parts = []
+            for v in range(first_detailed):
+                if volumes[v].get("digest"):
+                    parts.append(format_volume_digest_line(volumes[v]))
+                else:
+                    parts.append(self._text[self._offset_of(v, -1):self._offset_of(v + 1, -1)])
+            parts.append(self._text[self._offset_of(first_detailed, -1):end])
+            return "".join(parts)
+
+    def _prefix(self, v_idx, c_idx):
+        with self._lock:
+            self._extend_to(v_idx, c_idx)
+            return self._text[:self._offset_of(v_idx, c_idx)]
+
+    # --- 增量构建 ---
+    def _extend_to(self, v_idx, c_idx):
+        volumes = self.project.meta["volumes"]
+        pieces = []
+        length = len(self._text)
+        while (self._v, self._c) < (v_idx, c_idx) and self._v < len(volumes):
+            vol = volumes[self._v]
+            if self._c == -1:
+                line = format_volume_line(vol)
+                self._vol_offsets.append(length)
+                self._chap_offsets.append([])
+                self._c = 0
+            elif self._c < len(vol["chapters"]):
+                line = format_chapter_line(vol["chapters"][self._c])
+                self._chap_offsets[self._v].append(length)
+                self._c += 1
+            else:
+                self._v, self._c = self._v + 1, -1
+                continue
+            pieces.append(line)
+            length += len(line)
+        if pieces:
+            self._text += "".join(pieces)
+
+    def _offset_of(self, v_idx, c_idx):
+        """已构建部分中 (v_idx, c_idx) 位置的字符偏移；超出已构建范围时返回当前末尾"""
+        if v_idx >= len(self._vol_offsets):
+            return len(self._text)
+        if c_idx == -1:
+            return self._vol_offsets[v_idx]
+        if c_idx < len(self._chap_offsets[v_idx]):
+            return self._chap_offsets[v_idx][c_idx]
+        if v_idx + 1 < len(self._vol_offsets):
+            return self._vol_offsets[v_idx + 1]
+        return len(self._text)
+
+    def invalidate(self, v_idx=0, c_idx=-1):
+        """作废 (v_idx, c_idx) 及其之后已构建的部分"""
+        with self._lock:
+            if (v_idx, c_idx) >= (self._v, self._c):
+                return
+            self._text = self._text[:self._offset_of(v_idx, c_idx)]
+            if c_idx == -1:
+                del self._vol_offsets[v_idx:]
+                del self._chap_offsets[v_idx:]
+            else:
+                del self._vol_offsets[v_idx + 1:]
+                del self._chap_offsets[v_idx + 1:]
+                del self._chap_offsets[v_idx][c_idx:]
+            self._v, self._c = v_idx, c_idx
+
+    def _on_project_change(self, op):
+        kind = op["op"]
+        if kind == "update_volume":
+            if {"name", "synopsis"} & op["fields"].keys():
+                self.invalidate(op["v"])
+        elif kind == "update_chapter":
+            if {"name", "synopsis", "ai_synopsis"} & op["fields"].keys():
+                self.invalidate(op["v"], op["c"])
+        elif kind == "add_volume":
+            self.invalidate(len(self.project.meta["volumes"]) - 1)
+        elif kind == "add_chapter":
+            self.invalidate(op["v"], len(self.project.meta["volumes"][op["v"]]["chapters"]) - 1)
+        elif kind == "delete_volume":
+            self.invalidate(op["v"])
+        elif kind == "delete_chapter":
+            self.invalidate(op["v"], op["c"])
@@ -0,0 +1,188 @@
+# correction_state.py
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _atomic_write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(prefix=".progress.", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CorrectionProgress:
+    """
+    全书纠错的逐章校对记录，保存在项目目录下。
+    每校对完一章就记下该章校对后正文的哈希，整轮跑完也保留；之后再跑全书校对（包括中途取消后重跑），
+    正文没变过的章节直接跳过，只校对新写或改动过的章节。
+    version 为校对逻辑的版本号，与记录里的不一致（如校对 prompt 升级过）时所有章节重新校对。
+    """
+    FILENAME = "correction_progress.json"
+
+    def __init__(self, root_path, mode, version=1):
+        self.path = os.path.join(root_path, self.FILENAME)
+        self.mode = mode
+        self.version = version
+        self._lock = threading.Lock()
+        self._done = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("mode") == mode and data.get("version") == version:
+                    self._done = data.get("done", {})
+            except (OSError, ValueError):
+                self._done = {}
+
+    @staticmethod
+    def _key(vol_name, chap_name):
+        return f"{vol_name}/{chap_name}"
+
+    def resumed_count(self):
+        return len(self._done)
+
+    def is_done(self, vol_name, chap_name, content):
+        with self._lock:
+            return self._done.get(self._key(vol_name, chap_name)) == content_hash(content)
+
+    def mark_done(self, vol_name, chap_name, content):
+        with self._lock:
+            self._done[self._key(vol_name, chap_name)] = content_hash(content)
+            _atomic_write_json(self.path, {"mode": self.mode, "version": self.version, "done": self._done})
+
+    def prune(self, live_keys):
+        """去掉已删除或改名的章节的记录，live_keys 为当前全部 (vol_name, chap_name)"""
+        live = {self._key(*key) for key in live_keys}
+        with self._lock:
+            stale = [key for key in self._done if key not in live]
+            if not stale:
+                return
+            for key in stale:
+                del self._done[key]
+            _atomic_write_json(self.path, {"mode": self.mode, "version": self.version, "done": self._done})
+
+    def clear(self):
+        with self._lock:
+            self._done = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class PatchLog:
+    """
+    纠错补丁日志，每次纠错对某章实际应用的片段替换追加一行到项目目录下的 jsonl 文件。
+    只记录改动的片段而不是整章快照，复查和撤销（text_patch.revert_patches）都很便宜。
+    """
+    FILENAME = "correction_patches.jsonl"
+
+    def __init__(self, root_path):
+        self.path = os.path.join(root_path, self.FILENAME)
+        self._lock = threading.Lock()
+
+    def record(self, vol_name, chap_name, mode, patches):
+        if not patches:
+            return
+        entry = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "volume": vol_name,
+            "chapter": chap_name,
+            "mode": mode,
+            "patches": patches,
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+
+    def entries(self, vol_name=None, chap_name=None):
+        """按时间顺序返回日志条目，可按卷/章过滤；损坏的行直接跳过"""
+        if not os.path.exists(self.path):
+            return []
+        result = []
+        with self._lock:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if vol_name is not None and entry.get("volume") != vol_name:
+                continue
+            if chap_name is not None and entry.get("chapter") != chap_name:
+                continue
+            result.append(entry)
+        return result
+
+
+class SettingScanState:
+    """
+    全书设定复核的扫描记录，保存在项目目录下。
+    记下每章最近一次经过 AI 复核时的概要哈希和正文哈希；之后两者都没变的章节不再送审，
+    从没复核过的新章节、改动过概要或正文的章节则排进下一轮的候选。
+    """
+    FILENAME = "setting_scan.json"
+
+    def __init__(self, root_path):
+        self.path = os.path.join(root_path, self.FILENAME)
+        self._lock = threading.Lock()
+        self._scanned = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._scanned = json.load(f).get("chapters", {})
+            except (OSError, ValueError):
+                self._scanned = {}
+
+    @staticmethod
+    def _key(vol_name, chap_name):
+        return f"{vol_name}/{chap_name}"
+
+    def changes(self, vol_name, chap_name, summary, body_hash):
+        """返回该章自上次复核以来的变化：["new"]、["summary"]、["body"]、["summary", "body"] 或 []"""
+        with self._lock:
+            entry = self._scanned.get(self._key(vol_name, chap_name))
+        if entry is None:
+            return ["new"]
+        result = []
+        if entry.get("summary") != content_hash(summary):
+            result.append("summary")
+        if body_hash is not None and entry.get("body") != body_hash:
+            result.append("body")
+        return result
+
+    def mark_scanned(self, items):
+        """items 为 [(vol_name, chap_name, summary, body_hash), ...]，一次性落盘"""
+        if not items:
+            return
+        with self._lock:
+            for vol_name, chap_name, summary, body_hash in items:
+                self._scanned[self._key(vol_name, chap_name)] = {"summary": content_hash(summary), "body": body_hash}
+            _atomic_write_json(self.path, {"chapters": self._scanned})
+
+    def carry_over(self, vol_name, chap_name, old_body_hash, new_body_hash):
+        """
+        错别字校对改了正文之后调用：只改字词不动情节，若改之前的正文正是上次复核过的版本，
+        就把记录顺延到改后的正文，免得下一轮把校对过的章节（连同其后几章）当作正文有改动重新送审。
+        """
+        if old_body_hash == new_body_hash:
+            return
+        with self._lock:
+            entry = self._scanned.get(self._key(vol_name, chap_name))
+            if entry is None or entry.get("body") != old_body_hash:
+                return
+            entry["body"] = new_body_hash
+            _atomic_write_json(self.path, {"chapters": self._scanned})
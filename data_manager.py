@@ -2,53 +2,331 @@
 import os
 import json
 import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 import docx
 
-class NovelProject:
-    def __init__(self, root_path):
+
+class DocxChapterStorage:
+    """原始存储方式：每章正文保存为一个 .docx 文件"""
+    ext = ".docx"
+
+    def __init__(self, root_path, read_only=False):
         self.root_path = root_path
+        # 只读打开（如作为导入源）时，读取正文不得顺带迁移或改写任何文件
+        self.read_only = read_only
+
+    def path(self, vol_name, chap_name):
+        return os.path.join(self.root_path, vol_name, f"{chap_name}{self.ext}")
+
+    def stat(self, vol_name, chap_name):
+        """返回 (mtime_ns, size) 作为缓存校验戳，文件不存在时返回 None"""
+        try:
+            st = os.stat(self.path(vol_name, chap_name))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read(self, vol_name, chap_name):
+        doc = docx.Document(self.path(vol_name, chap_name))
+        return "\n".join([p.text for p in doc.paragraphs])
+
+    def write(self, vol_name, chap_name, content):
+        _write_docx(self.path(vol_name, chap_name), content)
+
+    def create(self, vol_name, chap_name):
+        chap_path = self.path(vol_name, chap_name)
+        if not os.path.exists(chap_path):
+            docx.Document().save(chap_path)
+
+    def rename(self, vol_name, old_name, new_name):
+        old_path = self.path(vol_name, old_name)
+        if os.path.exists(old_path):
+            os.rename(old_path, self.path(vol_name, new_name))
+
+    def remove(self, vol_name, chap_name):
+        chap_path = self.path(vol_name, chap_name)
+        if os.path.exists(chap_path):
+            os.remove(chap_path)
+
+    def sync_docx(self, chapters):
+        return 0
+
+
+class TextChapterStorage(DocxChapterStorage):
+    """
+    纯文本存储：UTF-8 的 .txt（或 .md）是正文的唯一来源，.docx 只是按需重建的导出副本。
+    保存时不再逐段构建 Document 并压缩，读取时也不再解压遍历 XML。
+    """
+    ext = ".txt"
+
+    def __init__(self, root_path, ext=".txt", read_only=False):
+        super().__init__(root_path, read_only)
+        self.ext = ext
+
+    def docx_path(self, vol_name, chap_name):
+        return os.path.join(self.root_path, vol_name, f"{chap_name}.docx")
+
+    def stat(self, vol_name, chap_name):
+        stamp = super().stat(vol_name, chap_name)
+        try:
+            st = os.stat(self.docx_path(vol_name, chap_name))
+        except OSError:
+            return stamp
+        # 老项目只有 docx，或 docx 在 Word 里被改得比文本还新：此时以 docx 的戳为准，读取时再导入
+        if stamp is None or st.st_mtime_ns > stamp[0]:
+            return st.st_mtime_ns, st.st_size
+        return stamp
+
+    def read(self, vol_name, chap_name):
+        txt_path = self.path(vol_name, chap_name)
+        docx_path = self.docx_path(vol_name, chap_name)
+        if self._docx_edited_externally(txt_path, docx_path) or not os.path.exists(txt_path):
+            # 迁移老项目，或导入用户在 Word 里改过的 docx
+            doc = docx.Document(docx_path)
+            content = "\n".join([p.text for p in doc.paragraphs])
+            if self.read_only:
+                return content
+            self._write_text(txt_path, content)
+            self._mark_docx_synced(txt_path, docx_path)
+            return content
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write(self, vol_name, chap_name, content):
+        # docx 因为 mtime 早于文本而自动变为“过期”，等 sync_docx 时再重建
+        self._write_text(self.path(vol_name, chap_name), content)
+
+    def create(self, vol_name, chap_name):
+        txt_path = self.path(vol_name, chap_name)
+        if not os.path.exists(txt_path) and not os.path.exists(self.docx_path(vol_name, chap_name)):
+            self._write_text(txt_path, "")
+
+    def rename(self, vol_name, old_name, new_name):
+        super().rename(vol_name, old_name, new_name)
+        old_docx = self.docx_path(vol_name, old_name)
+        if os.path.exists(old_docx):
+            os.rename(old_docx, self.docx_path(vol_name, new_name))
+
+    def remove(self, vol_name, chap_name):
+        super().remove(vol_name, chap_name)
+        docx_path = self.docx_path(vol_name, chap_name)
+        if os.path.exists(docx_path):
+            os.remove(docx_path)
+
+    def sync_docx(self, chapters):
+        """把过期或缺失的 .docx 按文本重新生成，返回重建的章数"""
+        rebuilt = 0
+        for vol_name, chap_name in chapters:
+            txt_path = self.path(vol_name, chap_name)
+            docx_path = self.docx_path(vol_name, chap_name)
+            if not os.path.exists(txt_path):
+                continue
+            if os.path.exists(docx_path) and os.stat(docx_path).st_mtime_ns >= os.stat(txt_path).st_mtime_ns:
+                continue
+            with open(txt_path, 'r', encoding='utf-8') as f:
+                _write_docx(docx_path, f.read())
+            self._mark_docx_synced(txt_path, docx_path)
+            rebuilt += 1
+        return rebuilt
+
+    @staticmethod
+    def _write_text(path, content):
+        # newline='' 保证写入什么读回什么，不做换行符转换
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+
+    @staticmethod
+    def _mark_docx_synced(txt_path, docx_path):
+        # 让 docx 与文本的 mtime 完全一致：之后 docx 更新 = 被外部编辑，docx 更旧 = 需要重建
+        st = os.stat(txt_path)
+        os.utime(docx_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    @staticmethod
+    def _docx_edited_externally(txt_path, docx_path):
+        try:
+            return os.stat(docx_path).st_mtime_ns > os.stat(txt_path).st_mtime_ns
+        except OSError:
+            return False
+
+
+def _write_docx(path, content):
+    doc = docx.Document()
+    for line in content.split('\n'):
+        doc.add_paragraph(line)
+    doc.save(path)
+
+
+# 可选的正文存储后端，项目通过 meta["storage"] 记录自己使用的后端
+STORAGE_BACKENDS = {
+    "docx": DocxChapterStorage,
+    "text": TextChapterStorage,
+}
+# 新建项目使用的后端
+DEFAULT_STORAGE = "text"
+# meta.json 里没有记录后端的老项目当时只能是 docx；沿用它，改用纯文本需由用户在菜单里显式转换
+LEGACY_STORAGE = "docx"
+
+class NovelProject:
+    # 正文解码缓存的默认容量（章数）。一章正文通常几千字，几百章常驻内存也只有几 MB
+    CHAPTER_CACHE_SIZE = 256
+    # 变更日志累计到这么多条时，把 meta.json 整体重写一次并清空日志（压缩）
+    JOURNAL_COMPACT_EVERY = 200
+
+    def __init__(self, root_path, cache_size=CHAPTER_CACHE_SIZE, storage=None, journal=False, read_only=False):
+        self._init_state(root_path, cache_size, journal, read_only)
         self.meta_path = os.path.join(self.root_path, "meta.json")
+        self.journal_path = os.path.join(self.root_path, "meta.journal")
+
+        is_new = not os.path.exists(self.meta_path)
+        self.load_meta()
+
+        # 正文存储后端：显式传入优先，否则沿用项目记录的后端；新项目用默认后端
+        backend = storage or self.meta.get("storage", DEFAULT_STORAGE if is_new else LEGACY_STORAGE)
+        self.storage = STORAGE_BACKENDS[backend](self.root_path, read_only=read_only)
+        if self.meta.get("storage") != backend and not read_only:
+            self.update_meta(storage=backend)
+
+    def _init_state(self, root_path, cache_size, journal, read_only):
+        """各种项目实现共用的内存状态（meta、正文缓存、订阅者、持久化标记），在加载任何数据之前调用"""
+        self.root_path = root_path
+        # 只读：不创建/重写 meta.json，不迁移正文存储，只用来读取（如导入为 SQLite 时的源项目）
+        self.read_only = read_only
+        # 正文存储后端；SQLite 项目的正文就在库里，没有单独的存储后端
+        self.storage = None
         self.meta = {
             "title": os.path.basename(self.root_path),
             "global_synopsis": "",
             "characters": [],
             "volumes": []
         }
-        self.load_meta()
+
+        # 章节正文 LRU 缓存：(vol_name, chap_name) -> ((mtime_ns, size), text)
+        # 挂机/纠错/导出会在不同线程反复读同一批章节，避免每次都重新解析 docx
+        self._chapter_cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # meta 持久化状态：脏标记 + 批量合并 + 可选的追加式变更日志
+        # on_meta_dirty 由 UI 层注入（例如启动一个防抖定时器再调用 flush_meta）；
+        # 未注入时每次修改立即落盘，保持脚本/后台使用时的直观行为
+        self.on_meta_dirty = None
+        # 结构/梗概变更的订阅者（如剧情轨迹缓存），在每条实际生效的变更之后被调用，参数为变更 op
+        self._change_listeners = []
+        # 正文保存的订阅者（如检索索引），参数为 (vol_name, chap_name, content)
+        self._content_listeners = []
+        self._dirty = False
+        self._batch_depth = 0
+        self._journal_enabled = journal
+        self._journal_count = 0
+        self._journal_seq = 0
+        self._meta_lock = threading.RLock()
 
     def load_meta(self):
         if os.path.exists(self.meta_path):
             with open(self.meta_path, 'r', encoding='utf-8') as f:
                 self.meta = json.load(f)
-        else:
+            # 上次异常退出时还没压缩进 meta.json 的变更，在这里重放（只读时仅重放到内存）
+            if self._replay_journal() and not self.read_only:
+                self.flush_meta()
+        elif not self.read_only:
             self.save_meta()
 
     def save_meta(self):
-        with open(self.meta_path, 'w', encoding='utf-8') as f:
-            json.dump(self.meta, f, ensure_ascii=False, indent=4)
+        """标记 meta 已修改（直接改了 self.meta 字典之后调用），实际写盘可能被合并推迟"""
+        with self._meta_lock:
+            self._dirty = True
+        self._schedule_flush()
+
+    def flush_meta(self):
+        """若有未落盘的修改，原子地整体重写 meta.json 并压缩变更日志。返回是否真的写了盘"""
+        with self._meta_lock:
+            if not self._dirty or self.read_only:
+                return False
+            # 先写临时文件再 os.replace：中途崩溃也不会留下被截断的 meta.json
+            if self._journal_enabled:
+                # 记录已并入 meta.json 的日志序号：即使在替换文件后、清空日志前崩溃，重放时也不会重复应用
+                self.meta["journal_seq"] = self._journal_seq
+            fd, tmp_path = tempfile.mkstemp(prefix=".meta.", suffix=".tmp", dir=self.root_path)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(self.meta, f, ensure_ascii=False, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.meta_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._dirty = False
+            if self._journal_count or os.path.exists(self.journal_path):
+                open(self.journal_path, 'w').close()
+                self._journal_count = 0
+            return True
+
+    @contextmanager
+    def batch(self):
+        """批量修改时使用：with project.batch(): ... 期间的所有修改最多只落盘一次"""
+        with self._meta_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._meta_lock:
+                self._batch_depth -= 1
+            self._schedule_flush()
+
+    def is_dirty(self):
+        return self._dirty
+
+    def add_change_listener(self, callback):
+        self._change_listeners.append(callback)
+
+    def remove_change_listener(self, callback):
+        if callback in self._change_listeners:
+            self._change_listeners.remove(callback)
+
+    def _notify_change(self, op):
+        for callback in list(self._change_listeners):
+            callback(op)
+
+    def add_content_listener(self, callback):
+        self._content_listeners.append(callback)
+
+    def remove_content_listener(self, callback):
+        if callback in self._content_listeners:
+            self._content_listeners.remove(callback)
+
+    def _notify_content(self, vol_name, chap_name, content):
+        for callback in list(self._content_listeners):
+            callback(vol_name, chap_name, content)
+
+    # --- 带变更日志的结构化修改接口 ---
+    def update_meta(self, **fields):
+        self._commit({"op": "update_meta", "fields": fields})
+
+    def update_volume(self, v_idx, **fields):
+        self._commit({"op": "update_volume", "v": v_idx, "fields": fields})
+
+    def update_chapter(self, v_idx, c_idx, **fields):
+        self._commit({"op": "update_chapter", "v": v_idx, "c": c_idx, "fields": fields})
 
     def add_volume(self, vol_name, synopsis=""):
         vol_path = os.path.join(self.root_path, vol_name)
         if not os.path.exists(vol_path):
             os.makedirs(vol_path)
-        self.meta["volumes"].append({"name": vol_name, "synopsis": synopsis, "chapters": []})
-        self.save_meta()
+        self._commit({"op": "add_volume", "name": vol_name, "synopsis": synopsis})
 
     def add_chapter(self, vol_index, chap_name, synopsis="", ai_synopsis=""):
         vol_name = self.meta["volumes"][vol_index]["name"]
-        chap_filename = f"{chap_name}.docx"
-        chap_path = os.path.join(self.root_path, vol_name, chap_filename)
-
-        if not os.path.exists(chap_path):
-            doc = docx.Document()
-            doc.save(chap_path)
-
-        self.meta["volumes"][vol_index]["chapters"].append({
-            "name": chap_name,
-            "synopsis": synopsis,
-            "ai_synopsis": ai_synopsis
-        })
-        self.save_meta()
+        self.storage.create(vol_name, chap_name)
+        self._commit({"op": "add_chapter", "v": vol_index, "name": chap_name,
+                      "synopsis": synopsis, "ai_synopsis": ai_synopsis})
 
     def rename_volume(self, v_idx, new_name):
         old_name = self.meta["volumes"][v_idx]["name"]
@@ -57,47 +335,505 @@ class NovelProject:
         new_path = os.path.join(self.root_path, new_name)
         if os.path.exists(old_path):
             os.rename(old_path, new_path)
-        self.meta["volumes"][v_idx]["name"] = new_name
-        self.save_meta()
+        self._invalidate_cache(vol_name=old_name)
+        # 变更监听在 meta 更新之后才收到通知，带上旧名字供按名字索引的订阅方改键
+        self._commit({"op": "update_volume", "v": v_idx, "fields": {"name": new_name}, "old_name": old_name})
 
     def rename_chapter(self, v_idx, c_idx, new_name):
         vol_name = self.meta["volumes"][v_idx]["name"]
         old_name = self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
         if old_name == new_name: return
-        old_path = os.path.join(self.root_path, vol_name, f"{old_name}.docx")
-        new_path = os.path.join(self.root_path, vol_name, f"{new_name}.docx")
-        if os.path.exists(old_path):
-            os.rename(old_path, new_path)
-        self.meta["volumes"][v_idx]["chapters"][c_idx]["name"] = new_name
-        self.save_meta()
+        self.storage.rename(vol_name, old_name, new_name)
+        self._invalidate_cache(vol_name, old_name)
+        self._commit({"op": "update_chapter", "v": v_idx, "c": c_idx, "fields": {"name": new_name},
+                      "old_name": old_name})
 
     def delete_volume(self, v_idx):
         vol_name = self.meta["volumes"][v_idx]["name"]
         vol_path = os.path.join(self.root_path, vol_name)
         if os.path.exists(vol_path):
             shutil.rmtree(vol_path)
-        del self.meta["volumes"][v_idx]
-        self.save_meta()
+        self._invalidate_cache(vol_name=vol_name)
+        self._commit({"op": "delete_volume", "v": v_idx, "name": vol_name})
 
     def delete_chapter(self, v_idx, c_idx):
         vol_name = self.meta["volumes"][v_idx]["name"]
         chap_name = self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
-        chap_path = os.path.join(self.root_path, vol_name, f"{chap_name}.docx")
-        if os.path.exists(chap_path):
-            os.remove(chap_path)
-        del self.meta["volumes"][v_idx]["chapters"][c_idx]
-        self.save_meta()
+        self.storage.remove(vol_name, chap_name)
+        self._invalidate_cache(vol_name, chap_name)
+        self._commit({"op": "delete_chapter", "v": v_idx, "c": c_idx, "name": chap_name})
+
+    def _apply_op(self, op):
+        """把一条变更作用到内存中的 meta 上（正常修改与日志重放共用这一处逻辑）"""
+        kind = op["op"]
+        if kind == "update_meta":
+            target = self.meta
+        elif kind == "update_volume":
+            target = self.meta["volumes"][op["v"]]
+        elif kind == "update_chapter":
+            target = self.meta["volumes"][op["v"]]["chapters"][op["c"]]
+        elif kind == "add_volume":
+            self.meta["volumes"].append({"name": op["name"], "synopsis": op["synopsis"], "chapters": []})
+            return True
+        elif kind == "add_chapter":
+            self.meta["volumes"][op["v"]]["chapters"].append({
+                "name": op["name"],
+                "synopsis": op["synopsis"],
+                "ai_synopsis": op["ai_synopsis"]
+            })
+            self.meta["volumes"][op["v"]].pop("digest", None)
+            return True
+        elif kind == "delete_volume":
+            del self.meta["volumes"][op["v"]]
+            return True
+        elif kind == "delete_chapter":
+            del self.meta["volumes"][op["v"]]["chapters"][op["c"]]
+            self.meta["volumes"][op["v"]].pop("digest", None)
+            return True
+        else:
+            raise ValueError(f"未知的 meta 变更类型: {kind}")
+
+        changed = {k: v for k, v in op["fields"].items() if target.get(k) != v}
+        target.update(changed)
+        if kind == "update_chapter" and {"synopsis", "ai_synopsis"} & changed.keys():
+            # 卷级摘要是由本卷各章梗概汇总出来的，任何一章的梗概变了它就过期了
+            self.meta["volumes"][op["v"]].pop("digest", None)
+        return bool(changed)
+
+    def _commit(self, op):
+        with self._meta_lock:
+            if not self._apply_op(op):
+                return  # 值没有变化（例如切换目录时的静默保存），不产生任何写盘
+            self._notify_change(op)
+            self._dirty = True
+            if self._journal_enabled:
+                # 追加一行日志的代价远低于重写整个 meta.json，日志足够长时再压缩
+                self._journal_seq += 1
+                op = dict(op, seq=self._journal_seq)
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                self._journal_count += 1
+                if self._journal_count < self.JOURNAL_COMPACT_EVERY or self._batch_depth:
+                    return
+                self.flush_meta()
+                return
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._batch_depth or not self._dirty:
+            return
+        if self.on_meta_dirty is not None:
+            self.on_meta_dirty()
+        else:
+            self.flush_meta()
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return False
+        replayed = 0
+        self._journal_seq = self.meta.get("journal_seq", 0)
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 崩溃时写了一半的最后一行，丢弃
+                if op.get("seq", 0) <= self._journal_seq:
+                    continue  # 已经压缩进 meta.json 的旧记录
+                self._apply_op(op)
+                self._journal_seq = op["seq"]
+                replayed += 1
+        if replayed:
+            self._dirty = True
+        return replayed > 0
 
     def read_chapter_content(self, vol_name, chap_name):
-        chap_path = os.path.join(self.root_path, vol_name, f"{chap_name}.docx")
-        if os.path.exists(chap_path):
-            doc = docx.Document(chap_path)
-            return "\n".join([p.text for p in doc.paragraphs])
-        return ""
+        stamp = self.storage.stat(vol_name, chap_name)
+        if stamp is None:
+            return ""
+
+        key = (vol_name, chap_name)
+        with self._cache_lock:
+            cached = self._chapter_cache.get(key)
+            # 文件的修改时间和大小都没变，才认为缓存仍然有效（防止外部用 Word 改过文件）
+            if cached is not None and cached[0] == stamp:
+                self._chapter_cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached[1]
+            self.cache_misses += 1
+
+        content = self.storage.read(vol_name, chap_name)
+        self._cache_put(key, stamp, content)
+        return content
 
     def save_chapter_content(self, vol_name, chap_name, content):
-        chap_path = os.path.join(self.root_path, vol_name, f"{chap_name}.docx")
-        doc = docx.Document()
-        for line in content.split('\n'):
-            doc.add_paragraph(line)
-        doc.save(chap_path)
\ No newline at end of file
+        self.storage.write(vol_name, chap_name, content)
+
+        # 写穿缓存：刚保存的正文下次读取时无需再读盘解析
+        self._cache_put((vol_name, chap_name), self.storage.stat(vol_name, chap_name), content)
+        self._notify_content(vol_name, chap_name, content)
+
+    def close(self):
+        self.flush_meta()
+
+    def sync_docx(self):
+        """按需重建过期的 .docx 副本（文本存储后端下才有实际工作），返回重建章数"""
+        chapters = [(v["name"], c["name"]) for v in self.meta["volumes"] for c in v["chapters"]]
+        return self.storage.sync_docx(chapters)
+
+    def convert_storage(self, backend):
+        """
+        显式切换正文存储后端。切到纯文本时老的 .docx 在每章首次读取时自动迁移；
+        切回 docx 前先按文本把过期的 .docx 副本补齐，之后以 docx 为准。
+        """
+        if backend == self.meta.get("storage"):
+            return
+        self.sync_docx()
+        self.storage = STORAGE_BACKENDS[backend](self.root_path)
+        with self._cache_lock:
+            self._chapter_cache.clear()
+        self.update_meta(storage=backend)
+
+    def cache_stats(self):
+        """返回正文缓存的命中统计，便于在大项目上确认缓存是否生效"""
+        with self._cache_lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self._chapter_cache),
+                "capacity": self._cache_size,
+                "hit_rate": self.cache_hits / total if total else 0.0
+            }
+
+    def _cache_put(self, key, stamp, content):
+        with self._cache_lock:
+            self._chapter_cache[key] = (stamp, content)
+            self._chapter_cache.move_to_end(key)
+            while len(self._chapter_cache) > self._cache_size:
+                self._chapter_cache.popitem(last=False)
+
+    def _invalidate_cache(self, vol_name=None, chap_name=None):
+        """按卷或按章剔除缓存；重命名/删除后旧键不能再被命中"""
+        with self._cache_lock:
+            if chap_name is not None:
+                self._chapter_cache.pop((vol_name, chap_name), None)
+            else:
+                for key in [k for k in self._chapter_cache if k[0] == vol_name]:
+                    del self._chapter_cache[key]
+
+
+class SQLiteNovelProject(NovelProject):
+    """
+    单个 SQLite 文件承载整本书的项目实现，面向上千章的长篇。
+    对外接口与 NovelProject 保持一致（meta 字典、add_chapter、read_chapter_content……），
+    但重命名/删除只是几条行更新，不再 os.rename / shutil.rmtree 整个目录。
+    """
+    DB_FILENAME = "novel.db"
+
+    # 这些字段有专门的列/表，其余字段以 JSON 存进 extra 列，保证 meta 中的扩展字段不丢失
+    _VOLUME_COLUMNS = ("name", "synopsis")
+    _CHAPTER_COLUMNS = ("name", "synopsis", "ai_synopsis")
+
+    def __init__(self, root_path, db_path=None):
+        # 正文直接查库，不需要 LRU 缓存；每条变更就是一个事务，也不需要变更日志
+        self._init_state(root_path, cache_size=0, journal=False, read_only=False)
+        self.db_path = db_path or os.path.join(root_path, self.DB_FILENAME)
+
+        # 行 id 与 meta 中位置下标的对应关系
+        self._vol_ids = []
+        self._chap_ids = []
+
+        # 读正文会发生在工作线程里，所有数据库访问都在 _meta_lock 下串行进行
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self._create_schema()
+        self.load_meta()
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS project (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS volumes (
+                    id INTEGER PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    synopsis TEXT NOT NULL DEFAULT '',
+                    extra TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE TABLE IF NOT EXISTS chapters (
+                    id INTEGER PRIMARY KEY,
+                    volume_id INTEGER NOT NULL REFERENCES volumes(id) ON DELETE CASCADE,
+                    position INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    extra TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE TABLE IF NOT EXISTS synopses (
+                    chapter_id INTEGER PRIMARY KEY REFERENCES chapters(id) ON DELETE CASCADE,
+                    synopsis TEXT NOT NULL DEFAULT ''
+                );
+                CREATE TABLE IF NOT EXISTS ai_summaries (
+                    chapter_id INTEGER PRIMARY KEY REFERENCES chapters(id) ON DELETE CASCADE,
+                    summary TEXT NOT NULL DEFAULT ''
+                );
+                CREATE TABLE IF NOT EXISTS bodies (
+                    chapter_id INTEGER PRIMARY KEY REFERENCES chapters(id) ON DELETE CASCADE,
+                    content TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS idx_volumes_name ON volumes(name);
+                CREATE INDEX IF NOT EXISTS idx_chapters_volume ON chapters(volume_id, position);
+                CREATE INDEX IF NOT EXISTS idx_chapters_name ON chapters(volume_id, name);
+            """)
+
+    def load_meta(self):
+        with self._meta_lock:
+            meta = dict(self.meta)
+            for key, value in self.conn.execute("SELECT key, value FROM project"):
+                meta[key] = json.loads(value)
+            meta["volumes"] = []
+            self._vol_ids = []
+            self._chap_ids = []
+            vol_rows = self.conn.execute(
+                "SELECT id, name, synopsis, extra FROM volumes ORDER BY position").fetchall()
+            for vol_id, name, synopsis, extra in vol_rows:
+                vol = json.loads(extra)
+                vol.update({"name": name, "synopsis": synopsis, "chapters": []})
+                ids = []
+                for chap_id, c_name, c_syn, c_ai, c_extra in self.conn.execute("""
+                        SELECT c.id, c.name, COALESCE(s.synopsis, ''), COALESCE(a.summary, ''), c.extra
+                        FROM chapters c
+                        LEFT JOIN synopses s ON s.chapter_id = c.id
+                        LEFT JOIN ai_summaries a ON a.chapter_id = c.id
+                        WHERE c.volume_id = ? ORDER BY c.position""", (vol_id,)):
+                    chap = json.loads(c_extra)
+                    chap.update({"name": c_name, "synopsis": c_syn, "ai_synopsis": c_ai})
+                    vol["chapters"].append(chap)
+                    ids.append(chap_id)
+                meta["volumes"].append(vol)
+                self._vol_ids.append(vol_id)
+                self._chap_ids.append(ids)
+            meta["storage"] = "sqlite"
+            self.meta = meta
+
+    def flush_meta(self):
+        """直接修改过 self.meta 字典后，把全部字段同步回数据库（单个事务）"""
+        with self._meta_lock:
+            if not self._dirty:
+                return False
+            with self.conn:
+                for key in self.meta:
+                    if key != "volumes":
+                        self._write_project_key(key, self.meta[key])
+                for v_idx, vol in enumerate(self.meta["volumes"]):
+                    self._write_volume(self._vol_ids[v_idx], vol)
+                    for c_idx, chap in enumerate(vol["chapters"]):
+                        self._write_chapter(self._chap_ids[v_idx][c_idx], chap)
+            self._dirty = False
+            return True
+
+    # --- 结构修改：不再触碰文件系统，只改数据库行 ---
+    def add_volume(self, vol_name, synopsis=""):
+        self._commit({"op": "add_volume", "name": vol_name, "synopsis": synopsis})
+
+    def add_chapter(self, vol_index, chap_name, synopsis="", ai_synopsis=""):
+        self._commit({"op": "add_chapter", "v": vol_index, "name": chap_name,
+                      "synopsis": synopsis, "ai_synopsis": ai_synopsis})
+
+    def rename_volume(self, v_idx, new_name):
+        old_name = self.meta["volumes"][v_idx]["name"]
+        self._commit({"op": "update_volume", "v": v_idx, "fields": {"name": new_name}, "old_name": old_name})
+
+    def rename_chapter(self, v_idx, c_idx, new_name):
+        old_name = self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
+        self._commit({"op": "update_chapter", "v": v_idx, "c": c_idx, "fields": {"name": new_name},
+                      "old_name": old_name})
+
+    def delete_volume(self, v_idx):
+        self._commit({"op": "delete_volume", "v": v_idx, "name": self.meta["volumes"][v_idx]["name"]})
+
+    def delete_chapter(self, v_idx, c_idx):
+        self._commit({"op": "delete_chapter", "v": v_idx, "c": c_idx,
+                      "name": self.meta["volumes"][v_idx]["chapters"][c_idx]["name"]})
+
+    def _commit(self, op):
+        with self._meta_lock:
+            if not self._apply_op(op):
+                return
+            self._notify_change(op)
+            # 每条变更就是一个很小的事务，无需防抖也不会截断任何文件
+            with self.conn:
+                self._persist_op(op)
+
+    def _persist_op(self, op):
+        kind = op["op"]
+        if kind == "update_meta":
+            for key, value in op["fields"].items():
+                self._write_project_key(key, value)
+        elif kind == "update_volume":
+            self._write_volume(self._vol_ids[op["v"]], self.meta["volumes"][op["v"]])
+        elif kind == "update_chapter":
+            chap = self.meta["volumes"][op["v"]]["chapters"][op["c"]]
+            self._write_chapter(self._chap_ids[op["v"]][op["c"]], chap, fields=op["fields"])
+            if {"synopsis", "ai_synopsis"} & op["fields"].keys():
+                self._write_volume(self._vol_ids[op["v"]], self.meta["volumes"][op["v"]])  # 同步作废卷级摘要
+        elif kind == "add_volume":
+            cur = self.conn.execute("INSERT INTO volumes (position, name, synopsis) VALUES (?, ?, ?)",
+                                    (len(self._vol_ids), op["name"], op["synopsis"]))
+            self._vol_ids.append(cur.lastrowid)
+            self._chap_ids.append([])
+        elif kind == "add_chapter":
+            ids = self._chap_ids[op["v"]]
+            cur = self.conn.execute("INSERT INTO chapters (volume_id, position, name) VALUES (?, ?, ?)",
+                                    (self._vol_ids[op["v"]], len(ids), op["name"]))
+            chap_id = cur.lastrowid
+            self.conn.execute("INSERT INTO synopses (chapter_id, synopsis) VALUES (?, ?)",
+                              (chap_id, op["synopsis"]))
+            self.conn.execute("INSERT INTO ai_summaries (chapter_id, summary) VALUES (?, ?)",
+                              (chap_id, op["ai_synopsis"]))
+            ids.append(chap_id)
+            self._write_volume(self._vol_ids[op["v"]], self.meta["volumes"][op["v"]])
+        elif kind == "delete_volume":
+            vol_id = self._vol_ids.pop(op["v"])
+            self._chap_ids.pop(op["v"])
+            self.conn.execute("DELETE FROM volumes WHERE id = ?", (vol_id,))
+            self.conn.execute("UPDATE volumes SET position = position - 1 WHERE position > ?", (op["v"],))
+        elif kind == "delete_chapter":
+            chap_id = self._chap_ids[op["v"]].pop(op["c"])
+            self.conn.execute("DELETE FROM chapters WHERE id = ?", (chap_id,))
+            self.conn.execute("UPDATE chapters SET position = position - 1 WHERE volume_id = ? AND position > ?",
+                              (self._vol_ids[op["v"]], op["c"]))
+            self._write_volume(self._vol_ids[op["v"]], self.meta["volumes"][op["v"]])
+
+    def _write_project_key(self, key, value):
+        if key == "storage":
+            return
+        self.conn.execute("INSERT OR REPLACE INTO project (key, value) VALUES (?, ?)",
+                          (key, json.dumps(value, ensure_ascii=False)))
+
+    def _write_volume(self, vol_id, vol):
+        extra = {k: v for k, v in vol.items() if k not in self._VOLUME_COLUMNS and k != "chapters"}
+        self.conn.execute("UPDATE volumes SET name = ?, synopsis = ?, extra = ? WHERE id = ?",
+                          (vol["name"], vol.get("synopsis", ""), json.dumps(extra, ensure_ascii=False), vol_id))
+
+    def _write_chapter(self, chap_id, chap, fields=None):
+        # fields 为 None 表示整行同步；否则只写真正变化的那几张表
+        fields = chap if fields is None else fields
+        extra_keys = [k for k in fields if k not in self._CHAPTER_COLUMNS]
+        if "name" in fields or extra_keys:
+            extra = {k: v for k, v in chap.items() if k not in self._CHAPTER_COLUMNS}
+            self.conn.execute("UPDATE chapters SET name = ?, extra = ? WHERE id = ?",
+                              (chap["name"], json.dumps(extra, ensure_ascii=False), chap_id))
+        if "synopsis" in fields:
+            self.conn.execute("INSERT OR REPLACE INTO synopses (chapter_id, synopsis) VALUES (?, ?)",
+                              (chap_id, chap.get("synopsis", "")))
+        if "ai_synopsis" in fields:
+            self.conn.execute("INSERT OR REPLACE INTO ai_summaries (chapter_id, summary) VALUES (?, ?)",
+                              (chap_id, chap.get("ai_synopsis", "")))
+
+    # --- 正文 ---
+    def _find_chapter_id(self, vol_name, chap_name):
+        row = self.conn.execute("""
+            SELECT c.id FROM chapters c JOIN volumes v ON v.id = c.volume_id
+            WHERE v.name = ? AND c.name = ?""", (vol_name, chap_name)).fetchone()
+        return row[0] if row else None
+
+    def read_chapter_content(self, vol_name, chap_name):
+        with self._meta_lock:
+            row = self.conn.execute("""
+                SELECT b.content FROM bodies b
+                JOIN chapters c ON c.id = b.chapter_id
+                JOIN volumes v ON v.id = c.volume_id
+                WHERE v.name = ? AND c.name = ?""", (vol_name, chap_name)).fetchone()
+        return row[0] if row else ""
+
+    def save_chapter_content(self, vol_name, chap_name, content):
+        with self._meta_lock:
+            chap_id = self._find_chapter_id(vol_name, chap_name)
+            if chap_id is None:
+                # 与文件夹存储写入不存在的卷目录时一样报错，而不是让正文悄悄丢失
+                raise FileNotFoundError(f"数据库中找不到章节：{vol_name} / {chap_name}")
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO bodies (chapter_id, content) VALUES (?, ?)",
+                                  (chap_id, content))
+        self._notify_content(vol_name, chap_name, content)
+
+    def sync_docx(self):
+        # 数据库就是唯一的存储，没有需要同步的 docx 副本（导出请使用“一键成书”）
+        return 0
+
+    def close(self):
+        with self._meta_lock:
+            self.flush_meta()
+            self.conn.close()
+
+
+def import_folder_project(root_path, db_path=None):
+    """
+    把“文件夹 + meta.json”格式的老项目导入为 SQLite 项目（原文件保留不动，可作备份）。
+    先导入到同目录下的临时库，全部成功后再替换为正式的数据库文件：中途失败不会留下一个空的 novel.db，
+    否则下次打开时 open_project 会把项目当成空的 SQLite 项目。
+    """
+    db_path = db_path or os.path.join(root_path, SQLiteNovelProject.DB_FILENAME)
+    if os.path.exists(db_path):
+        existing = SQLiteNovelProject(root_path, db_path)
+        try:
+            if existing.meta["volumes"]:
+                raise ValueError(f"目标数据库已有内容，拒绝覆盖：{db_path}")
+        finally:
+            existing.close()
+
+    source = NovelProject(root_path, read_only=True)
+    tmp_path = db_path + ".importing"
+    _remove_db_files(tmp_path)  # 上次导入失败残留的临时库
+    target = SQLiteNovelProject(root_path, tmp_path)
+    try:
+        _copy_into(source, target)
+        target.close()
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        target.conn.close()
+        _remove_db_files(tmp_path)
+        raise
+    return SQLiteNovelProject(root_path, db_path)
+
+
+def _remove_db_files(path):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _copy_into(source, target):
+    with target._meta_lock, target.conn:
+        for key, value in source.meta.items():
+            if key not in ("volumes", "storage", "journal_seq"):
+                target.meta[key] = value
+                target._write_project_key(key, value)
+        for v_idx, vol in enumerate(source.meta["volumes"]):
+            target._apply_op({"op": "add_volume", "name": vol["name"], "synopsis": vol.get("synopsis", "")})
+            target._persist_op({"op": "add_volume", "name": vol["name"], "synopsis": vol.get("synopsis", "")})
+            for chap in vol["chapters"]:
+                op = {"op": "add_chapter", "v": v_idx, "name": chap["name"],
+                      "synopsis": chap.get("synopsis", ""), "ai_synopsis": chap.get("ai_synopsis", "")}
+                target._apply_op(op)
+                target._persist_op(op)
+                chap_id = target._chap_ids[v_idx][-1]
+                target.meta["volumes"][v_idx]["chapters"][-1].update(chap)
+                target._write_chapter(chap_id, chap)
+                content = source.read_chapter_content(vol["name"], chap["name"])
+                target.conn.execute("INSERT OR REPLACE INTO bodies (chapter_id, content) VALUES (?, ?)",
+                                    (chap_id, content))
+            # 卷的扩展字段（如卷级摘要）放在章节导入之后写，避免被添加章节时的摘要作废逻辑清掉
+            target.meta["volumes"][v_idx].update(vol, chapters=target.meta["volumes"][v_idx]["chapters"])
+            target._write_volume(target._vol_ids[v_idx], target.meta["volumes"][v_idx])
+
+
+def open_project(root_path, **kwargs):
+    """按目录内容选择项目实现：存在 novel.db 时使用 SQLite 存储，否则使用文件夹 + meta.json"""
+    if os.path.exists(os.path.join(root_path, SQLiteNovelProject.DB_FILENAME)):
+        return SQLiteNovelProject(root_path)
+    return NovelProject(root_path, **kwargs)
@@ -0,0 +1,294 @@
+# entity_index.py
+import os
+import re
+import json
+import threading
+from collections import defaultdict
+from correction_state import content_hash, _atomic_write_json
+
+# 自动提取的专有名词至少在这么多章里出现过，才收进实体登记表
+PROPER_NOUN_MIN_CHAPTERS = 3
+# 近似名（与登记名只差一个字，或逐字同音异写）在全书至多出现在这么多章里，才被视为疑似笔误；出现得更普遍的多半是正常词语
+NEAR_MISS_MAX_CHAPTERS = 2
+# 单章内近似名至多出现这么多次才算可疑
+NEAR_MISS_MAX_COUNT = 2
+# 被误写的登记名本身在全书至少出现这么多次，才有“写串了”的可能
+NEAR_MISS_MIN_CANONICAL = 5
+
+_CJK = "\u4e00-\u9fff"
+_CJK_CHAR_RE = re.compile(f"[{_CJK}]")
+# 书名号/方括号里的功法、物品、势力名
+_BRACKET_RE = re.compile(f"[《【「]([{_CJK}]{{2,8}})[》】」]")
+# 句首或标点后紧跟“某某（笑/冷笑/沉声…）道：”的说话人
+_SPEAKER_RE = re.compile(f"(?:^|[，。！？；…”」\\s])([{_CJK}]{{2,3}}?)(?:冷笑|淡淡|沉声|低声|笑|怒|喝|问|叹|说)?道[：:，,]",
+                         re.M)
+# 以这些字开头的多半是代词或泛称，不当作专有名词
+_NOUN_STOP_CHARS = set("他她它我你您这那谁众大小老一两几有没不是")
+
+# 人名/专名里常被输入法换成同音字的字，按读音（不计声调）分组。
+# 没有内置拼音库，这里只收网文起名的常用字；组外的字仍可由“一字之差”规则兜住单字替换。
+# 同音规则要求名字的每个字都能归一，日常行文里的高频字（子、言、风、月、云、师、灵……）一旦收进来，
+# 普通词语就会整段归一成某个登记名（“子含”之于“紫涵”），所以只收主要用于起名的字
+_HOMOPHONE_GROUPS = (
+    "萧肖潇箫霄逍", "薰熏勋曛", "炎焰妍嫣", "林琳霖麟", "芸耘昀纭韵",
+    "羽瑜渝禹", "玲铃凌翎", "晨辰宸", "瑶尧姚", "婷廷霆",
+    "轩萱璇", "枫烽", "涵韩晗", "杰洁婕", "浩昊皓豪灏",
+    "紫梓", "悦岳", "墨陌沫", "卿晴", "诗施", "雪薛",
+    "琪琦淇祺麒骐", "黎莉璃", "彰璋", "叶烨",
+)
+# 把每个字映射为所在同音组的第一个字，读音相同的名字映射后完全一样
+_HOMOPHONE_TABLE = str.maketrans({ch: group[0] for group in _HOMOPHONE_GROUPS for ch in group[1:]})
+# 索引文件的格式版本；扫描规则变化后旧记录作废，打开项目时整本重扫一次
+SCAN_VERSION = 3
+
+
+def extract_proper_nouns(text):
+    """从正文中提取疑似专有名词（书名号/方括号里的名称、对话的说话人），返回 {名词: 出现次数}"""
+    counts = defaultdict(int)
+    for regex in (_BRACKET_RE, _SPEAKER_RE):
+        for match in regex.finditer(text):
+            noun = match.group(1)
+            if noun[0] not in _NOUN_STOP_CHARS:
+                counts[noun] += 1
+    return dict(counts)
+
+
+def scan_mentions(text, names, known=()):
+    """
+    统计 names 中每个名字在 text 里的出现次数，并找出近似写法：与之只差一个字的（任意字），
+    或逐字读音相同的（只认 _HOMOPHONE_GROUPS 里收录的字，如“萧熏儿”之于“萧薰儿”、“肖焰”之于“萧炎”）。
+    只比较等长的写法，多字、漏字的情况不在检查范围内。
+    返回 (mentions, near_misses)：mentions 为 {名字: 次数}，near_misses 为 {近似写法: [原名, 次数]}。
+    known 为全部已知名词；落在已知名词出现位置上的片段不算近似写法（如“萧薰儿”里的“萧薰”）。
+    """
+    known = set(known) | set(names)
+    covered = bytearray(len(text))
+    mentions = defaultdict(int)
+    if known:
+        # 长名优先，避免“萧炎”抢走“萧炎帝”之类更长名字的匹配
+        pattern = re.compile("|".join(re.escape(n) for n in sorted(known, key=len, reverse=True)))
+        for match in pattern.finditer(text):
+            covered[match.start():match.end()] = b"\x01" * (match.end() - match.start())
+            if match.group(0) in names:
+                mentions[match.group(0)] += 1
+
+    masks = defaultdict(dict)  # 长度 -> {遮住一个字后的形状: 原名}
+    sounds = defaultdict(dict)  # 长度 -> {按同音组归一后的形状: 原名}
+    for name in names:
+        if len(name) < 2:
+            continue
+        for i in range(len(name)):
+            masks[len(name)][name[:i] + "\0" + name[i + 1:]] = name
+        sounds[len(name)][name.translate(_HOMOPHONE_TABLE)] = name
+    folded = text.translate(_HOMOPHONE_TABLE)
+
+    near_misses = {}
+    for length, table in masks.items():
+        for start in range(len(text) - length + 1):
+            window = text[start:start + length]
+            if window in known or any(covered[start:start + length]):
+                continue
+            for i in range(length):
+                name = table.get(window[:i] + "\0" + window[i + 1:])
+                if name is not None and _CJK_CHAR_RE.match(window[i]):
+                    break
+            else:
+                name = sounds[length].get(folded[start:start + length])
+            if name is not None:
+                entry = near_misses.setdefault(window, [name, 0])
+                entry[1] += 1
+    # 原名在本章根本没出场时，一字之差的写法多半只是普通词语
+    near_misses = {variant: entry for variant, entry in near_misses.items() if mentions.get(entry[0])}
+    return dict(mentions), near_misses
+
+
+class EntityIndex:
+    """
+    实体登记表与逐章提及索引，持久化在项目目录下的 entity_index.json。
+    登记表 = 人物设定里的人物名 + 在多章中反复出现的专有名词；每章记录登记名的出现次数和疑似写错的近似名。
+    正文保存时通过项目的正文监听登记待更新的章节，refresh() 时只重扫改动过的章节，
+    登记表新增名字时也只对这几个名字补扫，不必整本重来。
+    设定纠错据此在本地先筛出可疑章节，只把这些章节交给模型复核。
+    """
+    FILENAME = "entity_index.json"
+
+    def __init__(self, project):
+        self.project = project
+        self.path = os.path.join(project.root_path, self.FILENAME)
+        self._lock = threading.Lock()
+        self._records = {}  # "卷/章" -> {"stamp", "hash", "nouns", "names", "mentions", "near_misses"}
+        self._dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("version") == SCAN_VERSION:
+                    self._records = data.get("chapters", {})
+            except (OSError, ValueError):
+                self._records = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        project.add_content_listener(self._on_content_saved)
+
+    def close(self):
+        self.project.remove_content_listener(self._on_content_saved)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                _atomic_write_json(self.path, {"version": SCAN_VERSION, "chapters": self._records})
+                self._dirty = False
+
+    @staticmethod
+    def _key(vol_name, chap_name):
+        return f"{vol_name}/{chap_name}"
+
+    def _on_content_saved(self, vol_name, chap_name, content):
+        # 保存发生在主线程，这里只登记，扫描推迟到下次 refresh
+        with self._pending_lock:
+            self._pending[(vol_name, chap_name)] = content
+
+    def _stamp(self, vol_name, chap_name):
+        storage = getattr(self.project, "storage", None)
+        if storage is None:
+            return None  # SQLite 项目没有文件时间戳，每次都按正文哈希比对
+        stamp = storage.stat(vol_name, chap_name)
+        return None if stamp is None else f"{stamp[0]}:{stamp[1]}"
+
+    # --- 维护 ---
+    def registry(self):
+        """当前的实体登记表：人物设定里的人物名，加上在足够多章节里出现过的专有名词"""
+        names = {c.get("name", "").strip() for c in self.project.meta.get("characters", [])}
+        chapter_counts = defaultdict(int)
+        with self._lock:
+            for record in self._records.values():
+                for noun in record["nouns"]:
+                    chapter_counts[noun] += 1
+        names.update(noun for noun, n in chapter_counts.items() if n >= PROPER_NOUN_MIN_CHAPTERS)
+        names.discard("")
+        return names
+
+    def refresh(self, should_stop=None):
+        """对照当前卷章结构和正文补齐索引，返回重扫的章数"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        chapters = [(v["name"], c["name"]) for v in self.project.meta["volumes"] for c in v["chapters"]]
+        live = {self._key(*key) for key in chapters}
+
+        # 第一遍：正文有变化的章节重新提取专有名词（与登记表无关）
+        contents = {}
+        with self._lock:
+            for key in [k for k in self._records if k not in live]:
+                del self._records[key]
+                self._dirty = True
+        for vol_name, chap_name in chapters:
+            if should_stop and should_stop():
+                # 没处理完的保存留到下次；已处理的按哈希判断，重复登记也无妨
+                with self._pending_lock:
+                    self._pending = {**pending, **self._pending}
+                return 0
+            key = self._key(vol_name, chap_name)
+            stamp = self._stamp(vol_name, chap_name)
+            record = self._records.get(key)
+            content = pending.get((vol_name, chap_name))
+            if content is None:
+                if record is not None and stamp is not None and record["stamp"] == stamp:
+                    continue
+                content = self.project.read_chapter_content(vol_name, chap_name)
+            digest = content_hash(content)
+            if record is not None and record["hash"] == digest:
+                if record["stamp"] != stamp:
+                    with self._lock:
+                        record["stamp"] = stamp
+                        self._dirty = True
+                continue
+            contents[key] = content
+            with self._lock:
+                self._records[key] = {"stamp": stamp, "hash": digest, "nouns": extract_proper_nouns(content),
+                                      "names": [], "mentions": {}, "near_misses": {}}
+                self._dirty = True
+
+        # 第二遍：按最新登记表补扫提及；老章节只补扫新增的名字，已移出登记表的名字直接删掉
+        names = self.registry()
+        known = set(names)
+        with self._lock:
+            for record in self._records.values():
+                known.update(record["nouns"])
+        rescanned = 0
+        for vol_name, chap_name in chapters:
+            if should_stop and should_stop():
+                break
+            key = self._key(vol_name, chap_name)
+            record = self._records[key]
+            scanned = set(record["names"])
+            missing = names - scanned
+            if not missing and scanned <= names:
+                continue
+            content = contents.get(key)
+            if content is None and missing:
+                content = self.project.read_chapter_content(vol_name, chap_name)
+            mentions = {n: c for n, c in record["mentions"].items() if n in names}
+            near_misses = {v: e for v, e in record["near_misses"].items() if e[0] in names}
+            if missing:
+                new_mentions, new_near = scan_mentions(content, missing, known)
+                mentions.update(new_mentions)
+                near_misses.update(new_near)
+            with self._lock:
+                record.update(names=sorted(names), mentions=mentions, near_misses=near_misses)
+                self._dirty = True
+            rescanned += 1
+        self.flush()
+        return rescanned
+
+    # --- 查询 ---
+    def content_digest(self, vol_name, chap_name):
+        """最近一次 refresh 时该章正文的哈希，未收录时返回 None"""
+        record = self._records.get(self._key(vol_name, chap_name))
+        return record["hash"] if record else None
+
+    def chapters_mentioning(self, name):
+        """按阅读顺序返回提到 name 的章节 [(vol_name, chap_name, 次数)]"""
+        result = []
+        for vol in self.project.meta["volumes"]:
+            for chap in vol["chapters"]:
+                record = self._records.get(self._key(vol["name"], chap["name"]))
+                if record and record["mentions"].get(name):
+                    result.append((vol["name"], chap["name"], record["mentions"][name]))
+        return result
+
+    def suspicious_chapters(self):
+        """
+        本地排查出的可疑章节 {(v_idx, c_idx): [疑点描述, ...]}（需先 refresh）。
+        目前只检查人名/专名的一字之差与同音异写：登记名在全书多次出现，而某个近似写法只在极少数章节零星出现，
+        多半是笔误或写串了人。
+        """
+        totals = defaultdict(int)
+        variant_chapters = defaultdict(int)
+        known = set()
+        with self._lock:
+            for record in self._records.values():
+                known.update(record["nouns"])
+                for name, count in record["mentions"].items():
+                    totals[name] += count
+                for variant in record["near_misses"]:
+                    variant_chapters[variant] += 1
+        known.update(totals)
+
+        result = {}
+        for v_idx, vol in enumerate(self.project.meta["volumes"]):
+            for c_idx, chap in enumerate(vol["chapters"]):
+                record = self._records.get(self._key(vol["name"], chap["name"]))
+                if not record:
+                    continue
+                issues = []
+                for variant, (name, count) in sorted(record["near_misses"].items()):
+                    if variant in known or count > NEAR_MISS_MAX_COUNT:
+                        continue
+                    if variant_chapters[variant] > NEAR_MISS_MAX_CHAPTERS or totals[name] < NEAR_MISS_MIN_CANONICAL:
+                        continue
+                    diff = "仅一字之差" if sum(a != b for a, b in zip(variant, name)) == 1 else "读音相同"
+                    issues.append(f"疑似人名/专名笔误：“{variant}”与“{name}”{diff}（全书“{name}”出现 {totals[name]} 次）")
+                if issues:
+                    result[(v_idx, c_idx)] = issues
+        return result
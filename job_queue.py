@@ -0,0 +1,167 @@
+# job_queue.py
+import os
+import time
+import sqlite3
+import threading
+
+# 挂机任务单元的种类：某一卷的章节细纲规划、某一章的正文生成
+KIND_PLAN = "plan"
+KIND_CHAPTER = "chapter"
+
+# 章节单元的状态：
+# pending    已规划，等待生成
+# streaming  正在流式生成，buffer 里是已收到的部分
+# generated  已生成完整输出（正文 + [AI_SUMMARY] 概要），buffer 里是完整输出，概要尚未写回
+# summarised 概要已写回，buffer 里是正文，等待落盘
+# done       正文已落盘（规划单元只有 done 一种状态）
+STATE_PENDING = "pending"
+STATE_STREAMING = "streaming"
+STATE_GENERATED = "generated"
+STATE_SUMMARISED = "summarised"
+STATE_DONE = "done"
+
+# 流式生成时收到的新内容每累计这么多字写一次盘
+FLUSH_CHARS = 400
+
+
+class JobQueue:
+    """
+    挂机任务队列，存放在项目目录下的 autopilot_jobs.db，记录本轮挂机中每个规划/生成单元的状态。
+    程序崩溃、断网或休眠导致挂机中断后，再次开启挂机时按记录从断点继续：规划过的卷不再重新规划，
+    写完的章节不必重新读盘判断，写到一半的章节从已收到的部分接着写。
+    整轮挂机顺利完成后清空，下次挂机重新开始一轮。
+    """
+    FILENAME = "autopilot_jobs.db"
+
+    def __init__(self, root_path):
+        self.db_path = os.path.join(root_path, self.FILENAME)
+        self._lock = threading.Lock()
+        self.project = None
+        # 多个工作线程共用一个连接，由锁串行化
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS units (
+                    kind TEXT NOT NULL,
+                    volume TEXT NOT NULL,
+                    chapter TEXT NOT NULL DEFAULT '',
+                    state TEXT NOT NULL,
+                    buffer TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (kind, volume, chapter)
+                )""")
+
+    def close(self):
+        self.detach()
+        with self._lock:
+            self.conn.close()
+            self.conn = None
+
+    def attach(self, project):
+        """订阅项目的正文保存与结构变更；项目对象被替换（如转换存储格式）后需重新 attach"""
+        self.detach()
+        self.project = project
+        project.add_content_listener(self.on_content_saved)
+        project.add_change_listener(self._on_project_change)
+
+    def detach(self):
+        if self.project is not None:
+            self.project.remove_content_listener(self.on_content_saved)
+            self.project.remove_change_listener(self._on_project_change)
+            self.project = None
+
+    def _on_project_change(self, op):
+        """单元以卷名、章名为键：改名时跟着改键，删除时丢弃，避免续跑时把改名后的章节当成没写过"""
+        kind = op["op"]
+        if kind == "update_volume" and "old_name" in op:
+            self._execute("UPDATE OR REPLACE units SET volume = ? WHERE volume = ?",
+                          (op["fields"]["name"], op["old_name"]))
+        elif kind == "update_chapter" and "old_name" in op:
+            vol_name = self.project.meta["volumes"][op["v"]]["name"]
+            self._execute("UPDATE OR REPLACE units SET chapter = ? WHERE kind = ? AND volume = ? AND chapter = ?",
+                          (op["fields"]["name"], KIND_CHAPTER, vol_name, op["old_name"]))
+        elif kind == "delete_volume" and "name" in op:
+            self._execute("DELETE FROM units WHERE volume = ?", (op["name"],))
+        elif kind == "delete_chapter" and "name" in op:
+            vol_name = self.project.meta["volumes"][op["v"]]["name"]
+            self._execute("DELETE FROM units WHERE kind = ? AND volume = ? AND chapter = ?",
+                          (KIND_CHAPTER, vol_name, op["name"]))
+
+    def _execute(self, sql, params):
+        with self._lock:
+            if self.conn is None:
+                return
+            with self.conn:
+                self.conn.execute(sql, params)
+
+    def set_state(self, kind, volume, chapter, state, buffer=None):
+        with self._lock:
+            if self.conn is None:
+                return  # 项目已关闭
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO units (kind, volume, chapter, state, buffer, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (kind, volume, chapter, state, buffer, time.time()))
+
+    def state(self, kind, volume, chapter=""):
+        """(状态, buffer)，没有记录时返回 None"""
+        with self._lock:
+            if self.conn is None:
+                return None
+            return self.conn.execute("SELECT state, buffer FROM units WHERE kind = ? AND volume = ? AND chapter = ?",
+                                     (kind, volume, chapter)).fetchone()
+
+    def states(self, kind):
+        """{(卷名, 章名): (状态, buffer)}，一次读出某类单元的全部记录"""
+        with self._lock:
+            if self.conn is None:
+                return {}
+            rows = self.conn.execute("SELECT volume, chapter, state, buffer FROM units WHERE kind = ?",
+                                     (kind,)).fetchall()
+        return {(row[0], row[1]): (row[2], row[3]) for row in rows}
+
+    def is_plan_done(self, volume):
+        row = self.state(KIND_PLAN, volume)
+        return row is not None and row[0] == STATE_DONE
+
+    def mark_plan_done(self, volume):
+        self.set_state(KIND_PLAN, volume, "", STATE_DONE)
+
+    def on_content_saved(self, vol_name, chap_name, content):
+        """
+        正文保存的订阅回调：用户手动写完了还在排队的章节，或清空了已完成的章节时，相应地更新状态。
+        挂机正在处理的章节（streaming 之后的状态）以挂机线程的记录为准。
+        """
+        with self._lock:
+            if self.conn is None:
+                return
+            with self.conn:
+                if len(content.strip()) > 100:
+                    self.conn.execute(
+                        "UPDATE units SET state = ?, updated = ? "
+                        "WHERE kind = ? AND volume = ? AND chapter = ? AND state = ?",
+                        (STATE_DONE, time.time(), KIND_CHAPTER, vol_name, chap_name, STATE_PENDING))
+                else:
+                    self.conn.execute(
+                        "UPDATE units SET state = ?, buffer = NULL, updated = ? "
+                        "WHERE kind = ? AND volume = ? AND chapter = ? AND state = ?",
+                        (STATE_PENDING, time.time(), KIND_CHAPTER, vol_name, chap_name, STATE_DONE))
+
+    def unfinished_count(self):
+        """本轮还没写完的章节数与写到一半的章节数"""
+        with self._lock:
+            if self.conn is None:
+                return 0, 0
+            row = self.conn.execute(
+                "SELECT COALESCE(SUM(state != ?), 0), COALESCE(SUM(state = ?), 0) FROM units WHERE kind = ?",
+                (STATE_DONE, STATE_STREAMING, KIND_CHAPTER)).fetchone()
+        return row[0], row[1]
+
+    def clear(self):
+        with self._lock:
+            if self.conn is None:
+                return
+            with self.conn:
+                self.conn.execute("DELETE FROM units")
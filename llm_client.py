@@ -0,0 +1,555 @@
+# llm_client.py
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import httpx
+from openai import OpenAI, RateLimitError, APIConnectionError
+from response_cache import make_key
+from context_builder import estimate_tokens
+
+# 连接池与超时的默认配置，可在设置中修改后通过 configure_pool 生效
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_TIMEOUT = 600.0  # 推理模型长思考时首包可能很慢，读超时给得比较宽
+CONNECT_TIMEOUT = 15.0
+KEEPALIVE_EXPIRY = 90.0
+
+# 重试策略的默认参数
+RETRY_MAX_ATTEMPTS = 5  # 单次调用最多尝试的次数（含第一次）
+RETRY_BASE_DELAY = 2.0  # 第一次重试前的等待秒数，之后每次翻倍
+RETRY_MAX_DELAY = 60.0  # 指数退避的单次等待上限
+RETRY_AFTER_LIMIT = 600.0  # 服务端 Retry-After 要求等待超过这么久时不再重试
+RETRY_JOB_BUDGET = 50  # 一个任务（一个 LLMSession）累计允许的重试次数，接口持续不可用时不再无休止地重试
+
+_lock = threading.Lock()
+_clients = {}  # (base_url, api_key) -> OpenAI
+_retired = []  # 配置变更后被替换下来的旧客户端，可能仍有线程在用，等 close_all 时再关闭
+_config = {"max_connections": DEFAULT_MAX_CONNECTIONS, "timeout": DEFAULT_TIMEOUT}
+_response_cache = None  # 当前项目的响应缓存（ResponseCache），为 None 时不走缓存
+_usage_ledger = None  # 当前项目的用量台账（UsageLedger），为 None 时不记账
+_limiter_state = threading.local()  # 当前线程是否正在 run_with_limiter 的并发名额内执行
+_no_stream_options = set()  # 拒绝过 stream_options 参数的接口地址，之后的请求不再附带，用量按字数估算
+
+
+def configure_pool(max_connections=None, timeout=None):
+    """修改连接池上限和请求超时。只影响之后新建的客户端，正在进行的请求不受影响"""
+    new_config = dict(_config)
+    if max_connections is not None:
+        new_config["max_connections"] = max(1, int(max_connections))
+    if timeout is not None:
+        new_config["timeout"] = max(1.0, float(timeout))
+    with _lock:
+        if new_config == _config:
+            return
+        _config.update(new_config)
+        _retired.extend(_clients.values())
+        _clients.clear()
+
+
+def get_client(api_key, base_url):
+    """按 (base_url, api_key) 返回进程级共享的客户端，复用 keep-alive 连接与 TLS 会话"""
+    key = (base_url, api_key)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=_config["max_connections"],
+                                    max_keepalive_connections=_config["max_connections"],
+                                    keepalive_expiry=KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(_config["timeout"], connect=CONNECT_TIMEOUT),
+            )
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            _clients[key] = client
+        return client
+
+
+def set_response_cache(cache):
+    """设置 LLMSession.complete 使用的响应缓存；传 None 关闭缓存（打开/关闭项目、切换设置时调用）"""
+    global _response_cache
+    _response_cache = cache
+
+
+def set_usage_ledger(ledger):
+    """设置记录每次调用 token 用量的台账；传 None 停止记账（打开/关闭项目时调用）"""
+    global _usage_ledger
+    _usage_ledger = ledger
+
+
+def _wants_json(options):
+    return (options.get("response_format") or {}).get("type") == "json_object"
+
+
+def _is_cacheable(content, options):
+    """要求返回 JSON 的请求，只有能正常解析时才缓存，免得把一次坏结果永久固定下来"""
+    if not content.strip():
+        return False
+    return not _wants_json(options) or _parses_as_json(content)
+
+
+def _parses_as_json(content):
+    """能否解析为 JSON，兼容外面包了 Markdown 代码块的情况"""
+    text = content.strip()
+    if text.startswith("```json"):
+        text = text[7:]
+    if text.endswith("```"):
+        text = text[:-3]
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+
+class TruncatedResponseError(Exception):
+    """要求返回 JSON 的请求拿到了无法解析的内容，多半是输出中途被截断"""
+
+
+def is_retryable_error(error):
+    """
+    判断异常是否值得重试：限流、服务端 5xx、请求超时/冲突、连接失败，以及流式读取途中断开或读超时，
+    还有被截断的 JSON 响应。参数错误、鉴权失败、余额不足等 4xx 重试也没用，直接抛出。
+    """
+    if isinstance(error, (TruncatedResponseError, APIConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def rejects_stream_options(error):
+    """服务端是否因为不认识 stream_options 参数而拒绝了请求（部分 OpenAI 兼容接口不支持该参数）"""
+    if getattr(error, "status_code", None) not in (400, 422):
+        return False
+    text = str(error).lower()
+    return "stream_options" in text or "include_usage" in text
+
+
+def retry_after_seconds(error):
+    """服务端在 Retry-After（或 retry-after-ms）响应头里要求的等待秒数，没有时返回 None"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # 也可能是 HTTP 日期格式
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    所有调用共用的重试策略：只重试 is_retryable_error 认可的异常，指数退避并加随机抖动，
+    服务端给了 Retry-After 时按它的要求等待。
+    单次调用最多尝试 max_attempts 次；同一个策略对象（一个任务）累计最多重试 job_budget 次。
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 job_budget=RETRY_JOB_BUDGET):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.job_budget = job_budget
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def next_delay(self, attempt, error, max_attempts=None):
+        """
+        第 attempt 次重试（从 0 计）前应等待的秒数，不该再重试时返回 None。
+        返回非 None 即占用一次任务预算。max_attempts 为 None 时使用策略的单次调用上限。
+        """
+        max_attempts = self.max_attempts if max_attempts is None else max_attempts
+        if attempt + 1 >= max_attempts or not is_retryable_error(error):
+            return None
+        wait = retry_after_seconds(error)
+        if wait is not None and wait > RETRY_AFTER_LIMIT:
+            return None
+        with self._lock:
+            if self.retries >= self.job_budget:
+                return None
+            self.retries += 1
+        if wait is None:
+            # 抖动：多路并发同时失败时错开重试时间，免得一起撞上限流
+            wait = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        return wait
+
+
+def describe_error(error):
+    status = getattr(error, "status_code", None)
+    text = f"{type(error).__name__}{f' {status}' if status else ''}: {error}"
+    return text if len(text) <= 120 else text[:120] + "..."
+
+
+def cached_prompt_tokens(usage):
+    """
+    usage 中命中服务端前缀缓存的 prompt token 数。
+    DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 兼容接口返回 prompt_tokens_details.cached_tokens。
+    """
+    if usage is None:
+        return 0
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None) if details is not None else None
+    return hit or 0
+
+
+def continuation_messages(messages, partial):
+    """
+    流式输出中断后接着生成用的消息：把已经收到的部分作为 assistant 回复放回对话，再要求从断点处继续，
+    只需重新生成剩下的内容。
+    """
+    return list(messages) + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": "输出在上面中途断开了。请从断开处紧接着往下写，不要重复已经写过的内容，"
+                                    "不要任何开场白或说明，保持原有格式要求。"},
+    ]
+
+
+def close_all():
+    """关闭所有共享客户端及其连接池（切换项目/退出程序时调用）"""
+    with _lock:
+        clients = list(_clients.values()) + _retired
+        _clients.clear()
+        _retired.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+class LLMSession:
+    """
+    单个工作线程的调用会话。
+    连接池是全局共享的，取消时只能关掉本会话自己打开的响应流，而不是整个客户端。
+    """
+
+    def __init__(self, api_key, base_url, model, temperature, worker="", chapter=None, retry_policy=None):
+        self.client = get_client(api_key, base_url)
+        self.base_url = base_url
+        self.model = model
+        self.temperature = temperature
+        # 用量台账里的任务类型与默认归属的 (卷名, 章名)；并行任务可用 usage_scope 按线程另行指定
+        self.worker = worker
+        self.chapter = chapter
+        self._local = threading.local()
+        # 本任务的重试策略与预算；on_retry(message) 用于向界面报告正在重试
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.on_retry = None
+        self._cancelled = False
+        self._cancel_event = threading.Event()
+        self._streams = set()
+        self._streams_lock = threading.Lock()
+        # 本会话累计的 prompt / 缓存命中 / 输出 token 数；最近一次请求的 usage 按线程分别记录，见 last_usage
+        self.usage_totals = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self._usage_lock = threading.Lock()
+
+    @property
+    def last_usage(self):
+        """当前线程最近一次流式请求的 usage（服务端没有返回时为 None）"""
+        return getattr(self._local, "last_usage", None)
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        self._cancelled = True
+        self._cancel_event.set()  # 叫醒正在等待重试的线程
+        with self._streams_lock:
+            streams = list(self._streams)
+        for stream in streams:
+            try:
+                # 关闭底层 HTTP 响应，打断正阻塞在读取上的线程；该连接被丢弃，连接池不受影响
+                stream.close()
+            except Exception:
+                pass
+
+    def cache_hit_rate(self):
+        """本会话累计的 prompt 缓存命中率（没有 usage 数据时为 None）"""
+        with self._usage_lock:
+            prompt = self.usage_totals["prompt_tokens"]
+            return self.usage_totals["cached_tokens"] / prompt if prompt else None
+
+    def _record_usage(self, usage):
+        self._local.last_usage = usage
+        with self._usage_lock:
+            self.usage_totals["calls"] += 1
+            self.usage_totals["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            self.usage_totals["cached_tokens"] += cached_prompt_tokens(usage)
+            self.usage_totals["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    @contextmanager
+    def usage_scope(self, vol_name, chap_name=None):
+        """在此范围内由当前线程发起的调用，用量记在 (vol_name, chap_name) 名下"""
+        previous = getattr(self._local, "chapter", None)
+        self._local.chapter = (vol_name, chap_name)
+        try:
+            yield
+        finally:
+            self._local.chapter = previous
+
+    def _log_call(self, model, messages, usage, output, latency, local_hit=False):
+        ledger = _usage_ledger
+        if ledger is None:
+            return
+        vol_name, chap_name = getattr(self._local, "chapter", None) or self.chapter or (None, None)
+        if local_hit:
+            ledger.record(self.worker, vol_name, chap_name, model, latency=latency, local_hit=True)
+        elif usage is not None:
+            details = getattr(usage, "completion_tokens_details", None)
+            ledger.record(self.worker, vol_name, chap_name, model,
+                          prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                          cached_tokens=cached_prompt_tokens(usage),
+                          completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+                          reasoning_tokens=getattr(details, "reasoning_tokens", 0) or 0,
+                          latency=latency)
+        else:
+            # 服务端不支持返回 usage 时按字数估算
+            prompt = sum(estimate_tokens(m.get("content") or "") for m in messages)
+            ledger.record(self.worker, vol_name, chap_name, model, prompt_tokens=prompt,
+                          completion_tokens=estimate_tokens("".join(output)), latency=latency, estimated=True)
+
+    def _wait_before_retry(self, attempt, error):
+        """按重试策略等待后返回 True；不该重试（或等待期间被取消）时返回 False"""
+        if self._cancelled:
+            return False
+        # 在 run_with_limiter 里执行时，限流交给它处理：收缩并发后再重新排队
+        if is_rate_limit_error(error) and getattr(_limiter_state, "active", False):
+            return False
+        wait = self.retry_policy.next_delay(attempt, error)
+        if wait is None:
+            return False
+        if self.on_retry:
+            self.on_retry(f"⚠️ 请求失败（{describe_error(error)}），{wait:.0f} 秒后第 {attempt + 1} 次重试...")
+        self._cancel_event.wait(wait)
+        return not self._cancelled
+
+    def stream_chat(self, messages, **kwargs):
+        """
+        流式请求，逐个产出 chunk。被取消时安静地结束迭代，而不是抛出网络异常。
+        网络中断、限流、服务端错误按重试策略自动重试；已经输出了部分正文的，只请求剩下的部分接着输出，
+        调用方看到的仍是一条连续的流（要求返回 JSON 的请求没法续写，输出过内容后出错时照常抛出）。
+        """
+        received = ""
+        attempt = 0
+        while True:
+            request = continuation_messages(messages, received) if received else messages
+            try:
+                for chunk in self._stream_once(request, **kwargs):
+                    if chunk.choices:
+                        received += getattr(chunk.choices[0].delta, "content", None) or ""
+                    yield chunk
+                return
+            except Exception as e:
+                if self._cancelled:
+                    return
+                if (received and _wants_json(kwargs)) or not self._wait_before_retry(attempt, e):
+                    if self._cancelled:
+                        return  # 在等待重试期间被取消
+                    raise
+                attempt += 1
+
+    def _stream_once(self, messages, **kwargs):
+        """发起一次流式请求，不做重试"""
+        kwargs.setdefault("model", self.model)
+        kwargs.setdefault("temperature", self.temperature)
+        # 让服务端在流的末尾附带 usage（含缓存命中的 token 数）；不支持该参数的接口去掉后重发一次
+        auto_usage = "stream_options" not in kwargs and self.base_url not in _no_stream_options
+        if auto_usage:
+            kwargs["stream_options"] = {"include_usage": True}
+        self._local.last_usage = None
+        if self._cancelled:
+            return
+        started = time.monotonic()
+        try:
+            stream = self.client.chat.completions.create(messages=messages, stream=True, **kwargs)
+        except Exception as e:
+            if not (auto_usage and rejects_stream_options(e)):
+                raise
+            with _lock:
+                _no_stream_options.add(self.base_url)
+            del kwargs["stream_options"]
+            stream = self.client.chat.completions.create(messages=messages, stream=True, **kwargs)
+        with self._streams_lock:
+            self._streams.add(stream)
+        try:
+            if self._cancelled:
+                return
+            usage = None
+            output = []  # 只在服务端不返回 usage 时用来估算输出 token
+            for chunk in stream:
+                if self._cancelled:
+                    break
+                chunk_usage = getattr(chunk, "usage", None)
+                if chunk_usage is not None:
+                    usage = chunk_usage
+                    self._record_usage(usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                output.append(getattr(delta, "reasoning_content", None) or "")
+                output.append(getattr(delta, "content", None) or "")
+                yield chunk
+            else:
+                # 只给完整结束的调用记账；被取消或中途出错的调用拿不到 usage
+                self._log_call(kwargs["model"], messages, usage, output, time.monotonic() - started)
+        except Exception:
+            if self._cancelled:
+                return
+            raise
+        finally:
+            with self._streams_lock:
+                self._streams.discard(stream)
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def complete(self, messages, on_reasoning=None, use_cache=True, **kwargs):
+        """
+        非流式语义的请求：返回完整正文。
+        内部仍走流式，这样长时间的思考/生成也能被 cancel() 立即打断。
+        开启了响应缓存时，完全相同的请求直接返回缓存结果（命中时没有思考过程可推送）。
+        """
+        cache = _response_cache if use_cache else None
+        key = None
+        if cache is not None:
+            started = time.monotonic()
+            model = kwargs.get("model", self.model)
+            options = {k: v for k, v in kwargs.items() if k not in ("model", "temperature", "stream_options")}
+            key = make_key(self.base_url, model, kwargs.get("temperature", self.temperature), messages, options)
+            cached = cache.get(key)
+            if cached is not None:
+                self._log_call(model, messages, None, (), time.monotonic() - started, local_hit=True)
+                return cached
+
+        # 出错时整个请求重来（要求 JSON 的结果没法续写）；JSON 解析不了的结果也当作被截断，按同样的策略重试
+        attempt = 0
+        while True:
+            content_buffer = ""
+            try:
+                for chunk in self._stream_once(messages, **kwargs):
+                    delta = chunk.choices[0].delta
+                    reasoning = getattr(delta, "reasoning_content", None)
+                    if reasoning and on_reasoning:
+                        on_reasoning(reasoning)
+                    content = getattr(delta, "content", None)
+                    if content:
+                        content_buffer += content
+                if not self._cancelled and _wants_json(kwargs) and not _parses_as_json(content_buffer):
+                    raise TruncatedResponseError("返回的 JSON 不完整")
+                break
+            except Exception as e:
+                if self._cancelled:
+                    break
+                if not self._wait_before_retry(attempt, e):
+                    # 等待期间被取消，或截断的 JSON 重试用尽：把最后一次的结果交给调用方按原有方式处理
+                    if self._cancelled or isinstance(e, TruncatedResponseError):
+                        break
+                    raise
+                attempt += 1
+        # 被取消的请求内容不完整，不能缓存
+        if cache is not None and not self._cancelled and _is_cacheable(content_buffer, kwargs):
+            cache.put(key, content_buffer)
+        return content_buffer
+
+
+def is_rate_limit_error(error):
+    """判断异常是否为服务端限流（HTTP 429）"""
+    return isinstance(error, RateLimitError) or getattr(error, "status_code", None) == 429
+
+
+class AdaptiveLimiter:
+    """
+    并发上限可以动态调整的信号量。
+    遇到限流时把上限减半（最少 1 路），之后每连续成功若干次再放宽 1 路，直到恢复到初始上限。
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max(1, int(max_limit))
+        self.limit = self.max_limit
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, should_stop=None):
+        """占用一个并发名额；should_stop 返回 True 时放弃等待并返回 False"""
+        with self._cond:
+            while self._active >= self.limit:
+                if should_stop and should_stop():
+                    return False
+                self._cond.wait(0.2)
+            self._active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self.limit < self.max_limit and self._successes >= self.limit * 2:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_rate_limited(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            return self.limit
+
+
+def run_with_limiter(limiter, fn, should_stop, on_throttled=None, policy=None):
+    """
+    在 limiter 的并发名额内执行 fn()。遇到限流时收缩并发、按重试策略退避后重新排队，其余异常照常抛出
+    （其他可重试的错误已由 LLMSession 自己重试过）。限流不受单次调用的尝试次数限制，只消耗任务预算。
+    on_throttled(new_limit, wait_seconds) 用于向界面报告限流情况。被取消时返回 None。
+    policy 一般传入任务所用 LLMSession 的 retry_policy，与其他重试共用一份预算。
+    """
+    policy = policy or RetryPolicy()
+    attempt = 0
+    while not should_stop():
+        if not limiter.acquire(should_stop=should_stop):
+            break
+        _limiter_state.active = True
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_rate_limit_error(e) or should_stop():
+                raise
+            wait = policy.next_delay(attempt, e, max_attempts=float("inf"))
+            if wait is None:
+                raise
+            new_limit = limiter.on_rate_limited()
+            if on_throttled:
+                on_throttled(new_limit, wait)
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            _limiter_state.active = False
+            limiter.release()
+        # 分段等待，被取消时尽快退出
+        deadline = time.monotonic() + wait
+        while not should_stop() and time.monotonic() < deadline:
+            time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+        attempt += 1
+    return None
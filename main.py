@@ -5,6 +5,7 @@ from PyQt6.QtCore import QSettings
 from styles import MODERN_QSS
 from ui_components import WelcomeDialog, SettingsDialog
 from main_window import MainWindow
+import llm_client
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -15,6 +16,9 @@ if __name__ == '__main__':
         QMessageBox.information(None, "初始化", "检测到您首次使用或未配置 API Key，请先进行全局设置。")
         SettingsDialog().exec()
 
+    llm_client.configure_pool(max_connections=settings.value("pool_size", llm_client.DEFAULT_MAX_CONNECTIONS),
+                              timeout=settings.value("request_timeout", llm_client.DEFAULT_TIMEOUT))
+
     while True:
         welcome = WelcomeDialog()
         if welcome.exec() == QDialog.DialogCode.Accepted and welcome.selected_path:
@@ -23,6 +27,9 @@ if __name__ == '__main__':
             window.show()
             app.exec()
 
+            # 切换项目或退出前，释放共享的 HTTP 连接池
+            llm_client.close_all()
+
             if getattr(window, 'switch_project', False):
                 continue
             else:
@@ -4,20 +4,47 @@ import docx
 from PyQt6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
                              QTextEdit, QPushButton, QScrollArea, QSplitter, QMessageBox,
                              QFileDialog, QTreeWidget, QTreeWidgetItem, QMenu, QStackedWidget,
-                             QInputDialog, QToolBar, QCheckBox)
-from PyQt6.QtCore import Qt, QSettings
-from PyQt6.QtGui import QShortcut, QKeySequence, QAction, QTextDocument
+                             QInputDialog, QToolBar, QCheckBox, QLineEdit, QListWidgetItem)
+from PyQt6.QtCore import Qt, QSettings, QTimer, QElapsedTimer
+from PyQt6.QtGui import QShortcut, QKeySequence, QAction, QTextDocument, QTextCursor
 from PyQt6.QtPrintSupport import QPrinter
-from data_manager import NovelProject
-from ai_worker import AutoPilotWorker, AIWorker, CorrectionWorker, SummaryWorker,SegmentModifyWorker
-from ui_components import SettingsDialog, CharacterWidget
+from data_manager import open_project, import_folder_project, SQLiteNovelProject
+from ai_worker import AutoPilotWorker, AIWorker, CorrectionWorker, SummaryWorker,SegmentModifyWorker, SearchIndexWorker, \
+    RetrievalIndexWorker
+from ui_components import SettingsDialog, CharacterWidget, UsageStatsDialog
+from text_patch import diff_paragraphs
+from context_builder import HistoryBuilder, DEFAULT_HISTORY_BUDGET
+from retrieval import RetrievalIndex, format_passages, RETRIEVAL_TOP_K
+from search_index import SearchIndex
+from entity_index import EntityIndex
+from response_cache import ResponseCache, DEFAULT_ENABLED as RESPONSE_CACHE_DEFAULT
+from usage_ledger import UsageLedger
+from job_queue import JobQueue
+import llm_client
 from PyQt6.QtWidgets import QToolButton, QMenu, QListWidget, QDockWidget # 新增引用
 
 class MainWindow(QMainWindow):
     def __init__(self, project_path):
         super().__init__()
-        self.project = NovelProject(project_path)
+        self.project = open_project(project_path, journal=True)
         self.settings = QSettings("AIWriter", "Settings")
+        # 过往剧情轨迹的增量缓存，生成/挂机/纠错共用
+        self.history_builder = HistoryBuilder(self.project, token_budget=self.history_token_budget())
+        # 全书正文/概要的本地检索索引，为写作 prompt 挑选相关前文片段
+        self.retrieval = RetrievalIndex(self.project)
+        # 全文检索的持久化倒排索引（项目目录下的 search_index.db），启动后在后台补齐
+        self.search_index = SearchIndex(self.project)
+        # 人物/专名的实体登记表与逐章提及索引，设定纠错前用来本地筛查可疑章节
+        self.entity_index = EntityIndex(self.project)
+        # 项目级的 LLM 响应缓存，完全相同的请求直接复用上次结果
+        self.response_cache = ResponseCache(self.project.root_path)
+        self.apply_response_cache_setting()
+        # 项目级的 token 用量台账，所有工作线程的调用都记在这里
+        self.usage_ledger = UsageLedger(self.project.root_path)
+        llm_client.set_usage_ledger(self.usage_ledger)
+        # 挂机任务队列（项目目录下的 autopilot_jobs.db），中断后再次挂机时从断点继续
+        self.job_queue = JobQueue(self.project.root_path)
+        self.job_queue.attach(self.project)
         self.character_widgets = []
         self.current_vol_index = -1
         self.current_chap_index = -1
@@ -30,6 +57,13 @@ class MainWindow(QMainWindow):
         self.gen_content_buffer = ""  # 正文生成的内存缓冲区
         self.gen_reasoning_buffer = ""  # 思考过程的内存缓冲区
 
+        # meta 防抖落盘：短时间内的连续修改（如挂机批量建章）合并为一次写入
+        self.meta_flush_timer = QTimer(self)
+        self.meta_flush_timer.setSingleShot(True)
+        self.meta_flush_timer.setInterval(800)
+        self.meta_flush_timer.timeout.connect(lambda: self.project.flush_meta())
+        self.project.on_meta_dirty = self.meta_flush_timer.start
+
         self.setWindowTitle(f"AI 网文辅助创作系统 - 📖 [{self.project.meta['title']}] (按 Ctrl+S 保存)")
         self.resize(1400, 850)
 
@@ -37,6 +71,8 @@ class MainWindow(QMainWindow):
         self.init_ui()
         self.setup_shortcuts()
         self.refresh_tree()
+        self.start_search_index_sync()
+        self.start_retrieval_build()
 
     def init_menu_and_toolbar(self):
         # 菜单栏
@@ -47,6 +83,18 @@ class MainWindow(QMainWindow):
         settings_action.triggered.connect(self.open_settings)
         file_menu.addAction(settings_action)
 
+        usage_action = QAction('📊 Token 用量统计', self)
+        usage_action.triggered.connect(self.open_usage_stats)
+        file_menu.addAction(usage_action)
+
+        text_storage_action = QAction('📝 转换为纯文本存储（保存/读取更快）', self)
+        text_storage_action.triggered.connect(self.convert_to_text_storage)
+        file_menu.addAction(text_storage_action)
+
+        convert_action = QAction('🗄️ 转换为 SQLite 单文件存储（适合超长篇）', self)
+        convert_action.triggered.connect(self.convert_to_sqlite)
+        file_menu.addAction(convert_action)
+
         # 显眼的顶部工具栏 (任何时候都可以快速调出设置)
         toolbar = QToolBar("Main Toolbar")
         toolbar.setMovable(False)
@@ -73,6 +121,11 @@ class MainWindow(QMainWindow):
         btn_settings.clicked.connect(self.open_settings)
         toolbar.addWidget(btn_settings)
 
+        btn_usage = QPushButton("📊 用量统计")
+        btn_usage.setStyleSheet("background-color: transparent; border: 1px solid #DCDFE6; font-weight:bold;")
+        btn_usage.clicked.connect(self.open_usage_stats)
+        toolbar.addWidget(btn_usage)
+
         toolbar.addSeparator()
 
         lbl_status = QLabel("  💡 提示：在左侧树状图右键可新建卷/章。")
@@ -89,6 +142,7 @@ class MainWindow(QMainWindow):
         self.auto_pilot_menu = QMenu(self)
         self.auto_pilot_menu.addAction("📚 一键生成全书", lambda: self.toggle_auto_pilot("full"))
         self.auto_pilot_menu.addAction("📄 一键生成本卷", lambda: self.toggle_auto_pilot("volume"))
+        self.auto_pilot_menu.addAction("⚡ 一键生成全书（多卷并行）", lambda: self.toggle_auto_pilot("full", parallel=True))
         self.btn_auto_pilot.setMenu(self.auto_pilot_menu)
         toolbar.addWidget(self.btn_auto_pilot)
 
@@ -116,6 +170,86 @@ class MainWindow(QMainWindow):
 
     def open_settings(self):
         SettingsDialog(self).exec()
+        self.history_builder.token_budget = self.history_token_budget()
+        self.apply_response_cache_setting()
+
+    def apply_response_cache_setting(self):
+        enabled = self.settings.value("response_cache", RESPONSE_CACHE_DEFAULT, type=bool)
+        llm_client.set_response_cache(self.response_cache if enabled else None)
+
+    def open_usage_stats(self):
+        self.save_all()
+        # 与挂机的判断一致：正文不足 100 字的章节算作未写。字数取自全文索引，不在界面线程读全书正文；
+        # 首次建索引尚未完成时，还没入库的章节暂按未写计
+        meta = self.project.meta
+        lengths = self.search_index.body_lengths()
+        remaining = sum(1 for vol in meta["volumes"] for chap in vol["chapters"]
+                        if lengths.get((vol["name"], chap["name"]), 0) <= 100)
+        UsageStatsDialog(self.usage_ledger, [vol["name"] for vol in meta["volumes"]], remaining, self).exec()
+
+    def history_token_budget(self):
+        return int(self.settings.value("history_token_budget", DEFAULT_HISTORY_BUDGET))
+
+    def convert_to_text_storage(self):
+        if isinstance(self.project, SQLiteNovelProject):
+            QMessageBox.information(self, "提示", "当前项目使用 SQLite 存储，正文已在数据库中，无需转换。")
+            return
+        if self.project.meta.get("storage") == "text":
+            QMessageBox.information(self, "提示", "当前项目已经在使用纯文本存储。")
+            return
+        if getattr(self, 'is_auto_piloting', False) or getattr(self, 'is_generating', False) or \
+                getattr(self, 'is_correcting', False):
+            QMessageBox.warning(self, "操作受限", "请先停止正在进行的生成/挂机/纠错任务，再转换存储格式！")
+            return
+        reply = QMessageBox.question(self, '转换存储格式',
+                                     '之后正文以同名 .txt 文件为准，各章在首次打开时自动从 .docx 迁移；\n'
+                                     '.docx 保留为导出副本，关闭项目时按需重建。确认转换吗？')
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        self.save_all()
+        self.project.convert_storage("text")
+        QMessageBox.information(self, "转换成功", "项目已切换为纯文本存储。")
+
+    def convert_to_sqlite(self):
+        if isinstance(self.project, SQLiteNovelProject):
+            QMessageBox.information(self, "提示", "当前项目已经在使用 SQLite 存储。")
+            return
+        if getattr(self, 'is_auto_piloting', False) or getattr(self, 'is_generating', False) or \
+                getattr(self, 'is_correcting', False):
+            QMessageBox.warning(self, "操作受限", "请先停止正在进行的生成/挂机/纠错任务，再转换存储格式！")
+            return
+        reply = QMessageBox.question(self, '转换存储格式',
+                                     '将把全部卷章、梗概和正文导入项目目录下的 novel.db，之后以该数据库为准。\n'
+                                     '原有的 meta.json 与章节文件会原样保留作为备份。确认转换吗？')
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+
+        self.save_all()
+        self.meta_flush_timer.stop()
+        self.project.flush_meta()
+        try:
+            new_project = import_folder_project(self.project.root_path)
+        except Exception as e:
+            QMessageBox.critical(self, "转换失败", f"导入 SQLite 时发生错误：\n{str(e)}")
+            return
+
+        self.stop_search_index_sync()
+        self.stop_retrieval_build()
+        self.history_builder.close()
+        self.retrieval.close()
+        self.search_index.close()
+        self.entity_index.close()
+        self.project = new_project
+        self.history_builder = HistoryBuilder(self.project, token_budget=self.history_token_budget())
+        self.retrieval = RetrievalIndex(self.project)
+        self.search_index = SearchIndex(self.project)
+        self.entity_index = EntityIndex(self.project)
+        self.job_queue.attach(self.project)
+        self.project.on_meta_dirty = self.meta_flush_timer.start
+        self.refresh_tree()
+        self.start_search_index_sync()
+        self.start_retrieval_build()
+        QMessageBox.information(self, "转换成功", f"项目已切换为 SQLite 存储：\n{self.project.db_path}")
 
     def init_ui(self):
         central_widget = QWidget()
@@ -255,7 +389,7 @@ class MainWindow(QMainWindow):
 
         # 3. 正文显示区
         right_layout.addWidget(
-            QLabel("<span style='font-size:16px; font-weight:bold;'>✍️ 小说正文区 (按 Ctrl+S 实时保存到 docx)</span>"))
+            QLabel("<span style='font-size:16px; font-weight:bold;'>✍️ 小说正文区 (按 Ctrl+S 实时保存到本地)</span>"))
 
         self.content_output = QTextEdit()
         self.content_output.setStyleSheet("""
@@ -332,6 +466,27 @@ class MainWindow(QMainWindow):
         mod_layout.addWidget(self.btn_apply_replace)
         self.sidebar_stacked.addWidget(self.modifier_widget)
 
+        # -- 侧边栏 Page 2: 全文搜索 --
+        self.search_widget = QWidget()
+        search_layout = QVBoxLayout(self.search_widget)
+        search_layout.setContentsMargins(5, 5, 5, 5)
+        search_layout.addWidget(QLabel("<b>🔍 全文搜索</b>"))
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("输入人名、物品或任意原文片段，回车搜索")
+        self.search_input.returnPressed.connect(self.run_full_text_search)
+        search_layout.addWidget(self.search_input)
+        self.lbl_search_status = QLabel("")
+        self.lbl_search_status.setStyleSheet("color: #909399; font-size: 12px;")
+        self.lbl_search_status.setWordWrap(True)
+        search_layout.addWidget(self.lbl_search_status)
+        self.search_results = QListWidget()
+        self.search_results.setStyleSheet(
+            "background-color: #FAFAFA; border: 1px solid #E4E7ED; color: #606266; padding: 5px;")
+        self.search_results.setWordWrap(True)
+        self.search_results.itemDoubleClicked.connect(self.jump_to_search_hit)
+        search_layout.addWidget(self.search_results)
+        self.sidebar_stacked.addWidget(self.search_widget)
+
         # -- 最最右侧的竖向按钮柱 (侧边导航栏) --
         vertical_toolbar = QWidget()
         vertical_toolbar.setFixedWidth(46)  # 稍微放宽一点点，避免文字贴边
@@ -377,8 +532,14 @@ class MainWindow(QMainWindow):
         self.btn_sidebar_modifier.setFixedSize(40, 80)
         self.btn_sidebar_modifier.clicked.connect(lambda: self.toggle_right_sidebar(1, self.btn_sidebar_modifier))
 
+        self.btn_sidebar_search = QPushButton("🔍\n搜\n索")
+        self.btn_sidebar_search.setCheckable(True)
+        self.btn_sidebar_search.setFixedSize(40, 80)
+        self.btn_sidebar_search.clicked.connect(lambda: self.toggle_right_sidebar(2, self.btn_sidebar_search))
+
         v_toolbar_layout.addWidget(self.btn_sidebar_log)
         v_toolbar_layout.addWidget(self.btn_sidebar_modifier)
+        v_toolbar_layout.addWidget(self.btn_sidebar_search)
         v_toolbar_layout.addStretch()  # 把按钮顶在上面
 
         # 重新拼装主视窗
@@ -403,6 +564,8 @@ class MainWindow(QMainWindow):
         shortcut_save.activated.connect(self.save_all)
         shortcut_delete = QShortcut(QKeySequence("Delete"), self.tree)
         shortcut_delete.activated.connect(lambda: self.ui_delete_item(self.tree.currentItem()))
+        shortcut_search = QShortcut(QKeySequence("Ctrl+Shift+F"), self)
+        shortcut_search.activated.connect(self.open_search_panel)
 
     # --- UI 辅助与交互逻辑 ---
     def add_character(self, init_data=None):
@@ -427,6 +590,7 @@ class MainWindow(QMainWindow):
             self.sidebar_stacked.show()
             self.btn_sidebar_log.setChecked(True)
             self.btn_sidebar_modifier.setChecked(False)
+            self.btn_sidebar_search.setChecked(False)
         else:
             self.sidebar_stacked.hide()
             self.btn_sidebar_log.setChecked(False)
@@ -591,7 +755,10 @@ class MainWindow(QMainWindow):
         model = self.settings.value("model", "deepseek-reasoner")
         temp = float(self.settings.value("temperature", 0.7))
 
-        self.correct_worker = CorrectionWorker(api_key, base_url, model, temp, self.project, scope, mode)
+        concurrency = int(self.settings.value("max_concurrency", 4))
+        self.correct_worker = CorrectionWorker(api_key, base_url, model, temp, self.project, scope, mode,
+                                               max_concurrency=concurrency, history=self.history_builder,
+                                               entities=self.entity_index)
         if scope == "chapter":
             self.correct_worker.set_target(self.current_vol_index, self.current_chap_index)
 
@@ -620,15 +787,45 @@ class MainWindow(QMainWindow):
 
         # 后台落盘
         self.project.save_chapter_content(vol_name, chap_name, new_content)
-        if new_summary and new_summary != chap.get("ai_synopsis", ""):
-            chap["ai_synopsis"] = new_summary
-            self.project.save_meta()
+        if new_summary:
+            self.project.update_chapter(v_idx, c_idx, ai_synopsis=new_summary)
 
         # 如果当前 UI 正好停留在被修改的这一章，实时刷新文本框
         if self.current_vol_index == v_idx and self.current_chap_index == c_idx:
-            self.content_output.setText(new_content)
+            self.patch_editor_text(new_content)
             self.statusBar().showMessage(f"✨ 当前章节 [{chap_name}] 纠错并刷新完毕！", 3000)
 
+    def patch_editor_text(self, new_content):
+        """只替换有变化的段落，避免 setText 整篇重排，也能保住滚动位置"""
+        doc = self.content_output.document()
+        cursor = QTextCursor(doc)
+        cursor.beginEditBlock()
+        # 从后往前替换，前面段落的块号不受影响
+        for i1, i2, new_lines in diff_paragraphs(self.content_output.toPlainText(), new_content):
+            if i1 < i2 and not new_lines:
+                # 纯删除：连同段落之间的换行一起删掉
+                if i2 < doc.blockCount():
+                    cursor.setPosition(doc.findBlockByNumber(i1).position())
+                    cursor.setPosition(doc.findBlockByNumber(i2).position(), QTextCursor.MoveMode.KeepAnchor)
+                else:
+                    prev = doc.findBlockByNumber(max(0, i1 - 1))
+                    cursor.setPosition(prev.position() + prev.length() - 1 if i1 > 0 else 0)
+                    cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+                cursor.removeSelectedText()
+            elif i1 < i2:
+                cursor.setPosition(doc.findBlockByNumber(i1).position())
+                last = doc.findBlockByNumber(i2 - 1)
+                cursor.setPosition(last.position() + last.length() - 1, QTextCursor.MoveMode.KeepAnchor)
+                cursor.insertText("\n".join(new_lines))
+            elif i1 < doc.blockCount():
+                # 纯插入：插到第 i1 段之前
+                cursor.setPosition(doc.findBlockByNumber(i1).position())
+                cursor.insertText("\n".join(new_lines) + "\n")
+            else:
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+                cursor.insertText("\n" + "\n".join(new_lines))
+        cursor.endEditBlock()
+
     def correction_finished(self):
         self.is_correcting = False
         self.update_ui_state()  # 这一步会让按钮从“停止”重新变回“一键纠错”
@@ -776,9 +973,10 @@ class MainWindow(QMainWindow):
         self.update_ui_state()
         self.refresh_tree()
 
-    def on_tree_select(self, item):
+    def on_tree_select(self, item, *, autosave=True):
         # 【新增】在切换目录之前，先静默保存当前选中的卷/章信息，防止内容丢失
-        self.save_all(silent=True)
+        if autosave:
+            self.save_all(silent=True)
 
         data = item.data(0, Qt.ItemDataRole.UserRole)
         self.current_vol_index = -1
@@ -834,32 +1032,49 @@ class MainWindow(QMainWindow):
             self.switch_project = True  # 设置标志位为 True
             self.close()  # 关闭当前主窗口
 
+    def closeEvent(self, event):
+        self.stop_search_index_sync()
+        self.stop_retrieval_build()
+        self.search_index.close()
+        self.entity_index.close()
+        llm_client.set_response_cache(None)
+        self.response_cache.close()
+        llm_client.set_usage_ledger(None)
+        self.usage_ledger.close()
+        self.job_queue.close()
+        # 正文以纯文本为准，关闭项目时再统一把改动过的章节重建为 docx 副本
+        self.meta_flush_timer.stop()
+        self.project.flush_meta()
+        try:
+            self.project.sync_docx()
+        except Exception as e:
+            QMessageBox.warning(self, "同步 docx 失败", f"正文已安全保存为文本，但重建 docx 副本时出错：\n{str(e)}")
+        self.project.close()
+        super().closeEvent(event)
+
     # --- 数据保存逻辑 ---
     def save_global_meta(self, silent=False):
-        self.project.meta["global_synopsis"] = self.story_synopsis_input.toPlainText().strip()
         chars = []
         for w in self.character_widgets:
             d = w.get_data()
             if any(d.values()):
                 chars.append(d)
-        self.project.meta["characters"] = chars
-        self.project.save_meta()
+        self.project.update_meta(global_synopsis=self.story_synopsis_input.toPlainText().strip(),
+                                 characters=chars)
         if not silent:
             QMessageBox.information(self, "提示", "全局设定保存成功！")
 
     def save_vol_meta(self, silent=False):
         if self.current_vol_index != -1:
-            self.project.meta["volumes"][self.current_vol_index][
-                "synopsis"] = self.vol_synopsis_input.toPlainText().strip()
-            self.project.save_meta()
+            self.project.update_volume(self.current_vol_index,
+                                       synopsis=self.vol_synopsis_input.toPlainText().strip())
             if not silent:
                 QMessageBox.information(self, "提示", "当前卷设定保存成功！")
 
     def save_chap_meta(self, silent=False):
         if self.current_chap_index != -1:
-            self.project.meta["volumes"][self.current_vol_index]["chapters"][self.current_chap_index][
-                "synopsis"] = self.chap_synopsis_input.toPlainText().strip()
-            self.project.save_meta()
+            self.project.update_chapter(self.current_vol_index, self.current_chap_index,
+                                        synopsis=self.chap_synopsis_input.toPlainText().strip())
             if not silent:
                 QMessageBox.information(self, "提示", "当前章设定保存成功！")
 
@@ -872,7 +1087,7 @@ class MainWindow(QMainWindow):
             self.save_vol_meta(silent=silent)
         elif idx == 2:
             self.save_chap_meta(silent=silent)
-            # 保存 docx 正文
+            # 保存正文
             if self.current_vol_index != -1 and self.current_chap_index != -1:
                 vol_name = self.project.meta["volumes"][self.current_vol_index]["name"]
                 chap_name = self.project.meta["volumes"][self.current_vol_index]["chapters"][self.current_chap_index][
@@ -1020,28 +1235,9 @@ class MainWindow(QMainWindow):
             if len(prev_chapter_content) > 1500:
                 prev_chapter_content = "...(前文省略)...\n" + prev_chapter_content[-1500:]
 
-        # 【修改处】提取过往所有梗概时，优先使用 ai_synopsis
-        history_str = ""
-        for i in range(v_idx + 1):
-            vol = meta["volumes"][i]
-            history_str += f"\n> {vol['name']} (梗概: {vol.get('synopsis', '无')})\n"
-
-            chap_limit = c_idx if i == v_idx else len(vol["chapters"])
-            for j in range(chap_limit):
-                chap = vol["chapters"][j]
-
-                # 优先读取 AI 之前生成的梗概，如果没有则降级读取用户的细纲
-                ai_syn = chap.get("ai_synopsis", "")
-                user_syn = chap.get("synopsis", "无")
-                display_syn = ai_syn if ai_syn.strip() else user_syn
-
-                history_str += f"  - {chap['name']}: {display_syn}\n"
-
-        if len(history_str) > 15000:
-            history_str = "【注意：因前文过长，此处仅提供过往卷梗概】\n"
-            for i in range(v_idx + 1):
-                vol = meta["volumes"][i]
-                history_str += f"\n> {vol['name']} (梗概: {vol.get('synopsis', '无')})\n"
+        # 过往所有梗概（优先使用 ai_synopsis），由增量缓存直接给出前缀
+        # 超出 token 上限时近详远略地分层压缩，而不是一刀切只留卷梗概
+        history_str = self.history_builder.budgeted(v_idx, c_idx)
 
         if not history_str.strip():
             history_str = "本书刚刚开篇，无过往历史。"
@@ -1055,6 +1251,16 @@ class MainWindow(QMainWindow):
 {history_str.strip()}
 
 """
+        # 按本章细纲从前文检索相关片段（人物、物品、伏笔），补上梗概里被略去的细节
+        query = f"{curr_chap['name']} {curr_chap.get('synopsis', '')} {curr_chap.get('ai_synopsis', '')}"
+        exclude = set()
+        if prev_v_idx != -1 and prev_c_idx != -1:
+            exclude.add((meta["volumes"][prev_v_idx]["name"], meta["volumes"][prev_v_idx]["chapters"][prev_c_idx]["name"]))
+        # 首次建索引在后台进行，尚未完成时本次生成先不附带检索片段，避免在界面线程读全书
+        related = format_passages(self.retrieval.search(query, k=RETRIEVAL_TOP_K, before=(v_idx, c_idx),
+                                                        exclude=exclude, wait=False))
+        if related:
+            user_prompt += f"【相关前文片段（按本章细纲检索）】\n{related}\n"
         if prev_chapter_content.strip():
             user_prompt += f"""【本次写作任务】
             当前所处卷：{curr_vol['name']}
@@ -1124,9 +1330,11 @@ class MainWindow(QMainWindow):
         temperature = float(self.settings.value("temperature", 1.5))
         max_tokens = int(self.settings.value("max_tokens", 6000))
 
+        gen_vol = self.project.meta["volumes"][self.gen_v_idx]
         self.worker = AIWorker(api_key=self.settings.value("api_key", ""), base_url=base_url, model=model,
                                temperature=temperature, max_tokens=max_tokens, system_prompt=system_prompt,
-                               user_prompt=user_prompt)
+                               user_prompt=user_prompt,
+                               chapter=(gen_vol["name"], gen_vol["chapters"][self.gen_c_idx]["name"]))
         self.worker.reasoning_signal.connect(self.append_thinking)
         self.worker.content_signal.connect(self.append_content)
         self.worker.error_signal.connect(self.handle_error)
@@ -1173,7 +1381,8 @@ class MainWindow(QMainWindow):
         model = self.settings.value("model", "deepseek-reasoner")
         temp = float(self.settings.value("temperature", 0.7))
 
-        self.summary_worker = SummaryWorker(api_key, base_url, model, temp, tasks)
+        concurrency = int(self.settings.value("max_concurrency", 4))
+        self.summary_worker = SummaryWorker(api_key, base_url, model, temp, tasks, max_concurrency=concurrency)
         self.summary_worker.status_signal.connect(lambda msg: self.statusBar().showMessage(msg))
         self.summary_worker.summary_ready_signal.connect(self._on_missing_summary_ready)
         self.summary_worker.finished_signal.connect(lambda: self._on_missing_summary_finished(callback))
@@ -1182,9 +1391,7 @@ class MainWindow(QMainWindow):
 
     def _on_missing_summary_ready(self, v_idx, c_idx, summary):
         # 回写数据到结构中
-        chap = self.project.meta["volumes"][v_idx]["chapters"][c_idx]
-        chap["ai_synopsis"] = summary
-        self.project.save_meta()
+        self.project.update_chapter(v_idx, c_idx, ai_synopsis=summary)
 
         # 顺手把 UI 里可能看得到的界面同步一下（如果用户正停留在该章）
         if self.current_vol_index == v_idx and self.current_chap_index == c_idx:
@@ -1268,8 +1475,7 @@ class MainWindow(QMainWindow):
 
             # 2. 如果成功生成了 AI 总结，将其隐式保存到 meta 并在后台落盘
             if ai_summary:
-                chap_data["ai_synopsis"] = ai_summary
-                self.project.save_meta()
+                self.project.update_chapter(self.gen_v_idx, self.gen_c_idx, ai_synopsis=ai_summary)
 
             # 3. 如果用户还停留在这个章节，确保文本框里显示的是纯净的、没有尾巴的正文
             if self.current_vol_index == self.gen_v_idx and self.current_chap_index == self.gen_c_idx:
@@ -1285,7 +1491,7 @@ class MainWindow(QMainWindow):
         self.statusBar().showMessage("✅ 章节正文生成完毕，AI内部线索梗概已入库！", 3000)
 
     #追加:自动挂机类函数
-    def toggle_auto_pilot(self, mode="full"):
+    def toggle_auto_pilot(self, mode="full", parallel=False):
         if mode == "stop":
             if getattr(self, 'is_generating_summaries', False):
                 if hasattr(self, 'summary_worker') and self.summary_worker.isRunning():
@@ -1319,6 +1525,8 @@ class MainWindow(QMainWindow):
                 return
 
         msg = '确定开启全自动挂机？\nAI将自动消耗大量Token补全所有设定和正文！' if mode == "full" else '确定一键生成本卷？\nAI将基于当前卷梗概，自动为您扩展章节并撰写本卷全部正文！'
+        if parallel:
+            msg += '\n\n多卷并行：各卷同时起草，卷首章先按细纲写，全部写完后再对照上一卷结尾修补衔接。'
         reply = QMessageBox.question(self, '高能预警', msg,
                                      QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply != QMessageBox.StandardButton.Yes: return
@@ -1331,19 +1539,23 @@ class MainWindow(QMainWindow):
         target_v = self.current_vol_index if mode == "volume" else None
         target_c = 0 if mode == "volume" else None
 
-        self._check_and_fill_summaries(target_v, target_c, lambda: self._execute_auto_pilot(mode, target_v))
+        self._check_and_fill_summaries(target_v, target_c, lambda: self._execute_auto_pilot(mode, target_v, parallel))
 
-    def _execute_auto_pilot(self, mode, target_v_idx):
+    def _execute_auto_pilot(self, mode, target_v_idx, parallel=False):
         self.is_auto_piloting = True
         self.update_ui_state()
 
         base_url = self.settings.value("base_url", "https://api.deepseek.com")
         ai_model = self.settings.value("model", "deepseek-reasoner")
         temp = float(self.settings.value("temperature", 0.7))
+        # 多卷并行时同时起草的卷数沿用“最大并发数”设置
+        parallel_volumes = int(self.settings.value("max_concurrency", 4)) if parallel else 1
 
         self.auto_worker = AutoPilotWorker(
             self.settings.value("api_key", ""), base_url, ai_model, temp,
-            self.project, mode=mode, target_v_idx=target_v_idx if target_v_idx is not None else -1
+            self.project, mode=mode, target_v_idx=target_v_idx if target_v_idx is not None else -1,
+            history=self.history_builder, retrieval=self.retrieval, parallel_volumes=parallel_volumes,
+            jobs=self.job_queue
         )
 
         self.auto_worker.status_signal.connect(lambda msg: self.statusBar().showMessage(msg))
@@ -1352,12 +1564,16 @@ class MainWindow(QMainWindow):
         self.hit_summary_delimiter = False
         self.auto_worker.content_signal.connect(self.append_content)
         self.auto_worker.reasoning_signal.connect(self.append_thinking)
-        self.auto_worker.start_chapter_signal.connect(self.auto_start_chapter, Qt.ConnectionType.BlockingQueuedConnection)
+        # 切换到新章节只是界面操作，不必让挂机线程等它；同一线程发出的信号按顺序处理，不会晚于该章的正文流
+        self.auto_worker.start_chapter_signal.connect(self.auto_start_chapter)
         self.auto_worker.add_volume_signal.connect(self.auto_add_volume, Qt.ConnectionType.BlockingQueuedConnection)
         self.auto_worker.add_chapter_signal.connect(self.auto_add_chapter, Qt.ConnectionType.BlockingQueuedConnection)
         self.auto_worker.save_content_signal.connect(self.auto_save_content, Qt.ConnectionType.BlockingQueuedConnection)
+        self.auto_worker.save_summary_signal.connect(self.auto_save_summary, Qt.ConnectionType.BlockingQueuedConnection)
         self.auto_worker.update_chapter_signal.connect(self.auto_update_chapter, Qt.ConnectionType.BlockingQueuedConnection)
         self.auto_worker.update_volume_signal.connect(self.auto_update_volume, Qt.ConnectionType.BlockingQueuedConnection)
+        self.auto_worker.update_volume_digest_signal.connect(self.auto_update_volume_digest,
+                                                             Qt.ConnectionType.BlockingQueuedConnection)
 
         self.auto_worker.finished_signal.connect(self.auto_pilot_finished)
         self.auto_worker.error_signal.connect(self.handle_error)
@@ -1365,25 +1581,27 @@ class MainWindow(QMainWindow):
         self.auto_worker.start()
 
     def auto_update_volume(self, v_idx, synopsis):
-        vol = self.project.meta["volumes"][v_idx]
-        vol["synopsis"] = synopsis
-        self.project.save_meta()
+        self.project.update_volume(v_idx, synopsis=synopsis)
 
         # 如果当前 UI 正好停留在这一卷的设置界面，实时刷新文本框
         if self.current_vol_index == v_idx and self.stacked_widget.currentIndex() == 1:
             self.vol_synopsis_input.setText(synopsis)
 
+    def auto_update_volume_digest(self, v_idx, digest):
+        self.project.update_volume(v_idx, digest=digest)
+
     # --- 供 AutoPilotWorker 跨线程调用的 UI 和数据更新槽函数 ---
     def auto_update_chapter(self, v_idx, c_idx, ai_synopsis):
         chap = self.project.meta["volumes"][v_idx]["chapters"][c_idx]
-        chap["ai_synopsis"] = ai_synopsis
 
         # 核心逻辑：如果用户原本就没有写 synopsis，那就把 AI 写的塞到台面上；
         # 如果用户写了，那就保留用户写的，AI 的扩写只放在隐式的 ai_synopsis 里供大模型看
-        if not chap.get("synopsis", "").strip():
-            chap["synopsis"] = ai_synopsis
-
-        self.project.save_meta()
+        # synopsis 与 ai_synopsis 相同说明台面上本来就是 AI 规划的（用户没改过），跟着一起更新
+        synopsis = chap.get("synopsis", "")
+        if not synopsis.strip() or synopsis == chap.get("ai_synopsis", ""):
+            self.project.update_chapter(v_idx, c_idx, ai_synopsis=ai_synopsis, synopsis=ai_synopsis)
+        else:
+            self.project.update_chapter(v_idx, c_idx, ai_synopsis=ai_synopsis)
 
         # 如果当前 UI 正好停留在这一章，刷新一下文本框显示
         if self.current_vol_index == v_idx and self.current_chap_index == c_idx:
@@ -1391,8 +1609,7 @@ class MainWindow(QMainWindow):
 
     def auto_update_events(self, v_idx, events):
         """后台收到大事件数据更新时，静默落盘保存到 meta"""
-        self.project.meta["volumes"][v_idx]["events"] = events
-        self.project.save_meta()
+        self.project.update_volume(v_idx, events=events)
 
     def auto_add_volume(self, name, synopsis):
         self.project.add_volume(name, synopsis)
@@ -1406,6 +1623,13 @@ class MainWindow(QMainWindow):
         self.tree.scrollToBottom()
 
     def auto_start_chapter(self, v_idx, c_idx):
+        # 编辑器里正显示着挂机上一章的生成流时，该章正文由挂机的落盘线程经 save_content_signal 保存；
+        # 这里再 save_all 会和它抢着写同一章，可能用带概要尾巴的流式文本盖掉刚落盘的正文，所以只保存章设定
+        owned = (self.stacked_widget.currentIndex() == 2 and
+                 (self.current_vol_index, self.current_chap_index) == (self.gen_v_idx, self.gen_c_idx))
+        if owned:
+            self.save_chap_meta(silent=True)
+
         self.gen_v_idx = v_idx
         self.gen_c_idx = c_idx
         self.gen_content_buffer = ""
@@ -1421,24 +1645,28 @@ class MainWindow(QMainWindow):
                 # 选中树节点
                 self.tree.setCurrentItem(c_node)
                 # 触发点击事件，让右侧面板切换到该章的空白编辑状态
-                self.on_tree_select(c_node)
+                self.on_tree_select(c_node, autosave=not owned)
 
-    def auto_save_content(self, v_idx, c_idx, main_content, ai_summary):
+    def auto_save_content(self, v_idx, c_idx, main_content):
+        # 挂机线程在写下一章的同时由后台线程发来，落盘不占用生成的时间
         vol_name = self.project.meta["volumes"][v_idx]["name"]
         chap_name = self.project.meta["volumes"][v_idx]["chapters"][c_idx]["name"]
 
         # 保存本地 docx
         self.project.save_chapter_content(vol_name, chap_name, main_content)
+
+    def auto_save_summary(self, v_idx, c_idx, ai_summary):
         # 更新 meta 中的 AI 总结
         if ai_summary:
-            self.project.meta["volumes"][v_idx]["chapters"][c_idx]["ai_synopsis"] = ai_summary
-            self.project.save_meta()
+            self.project.update_chapter(v_idx, c_idx, ai_synopsis=ai_summary)
 
         # 【关键修复】：取消这行 clear()，将清理工作交给 on_tree_select 去自然过渡
         self.hit_summary_delimiter = False
 
     def auto_pilot_finished(self):
         self.is_auto_piloting = False
+        self.gen_v_idx = -1
+        self.gen_c_idx = -1
         self.update_ui_state()
 
     def cancel_correction(self):
@@ -1461,6 +1689,86 @@ class MainWindow(QMainWindow):
             self.sidebar_stacked.show()
             self.btn_sidebar_log.setChecked(page_index == 0)
             self.btn_sidebar_modifier.setChecked(page_index == 1)
+            self.btn_sidebar_search.setChecked(page_index == 2)
+
+    # === 全文搜索 ===
+    def start_search_index_sync(self):
+        self.search_index_worker = SearchIndexWorker(self.search_index)
+        self.search_index_worker.status_signal.connect(self.lbl_search_status.setText)
+        self.search_index_worker.finished_signal.connect(
+            lambda rebuilt: self.lbl_search_status.setText(f"✅ 全文索引已就绪（本次更新 {rebuilt} 章）"))
+        self.search_index_worker.error_signal.connect(
+            lambda msg: self.lbl_search_status.setText(f"❌ 建立全文索引失败：{msg}"))
+        self.search_index_worker.start()
+
+    def stop_search_index_sync(self):
+        worker = getattr(self, 'search_index_worker', None)
+        if worker is not None and worker.isRunning():
+            worker.cancel()
+            worker.wait()
+
+    def start_retrieval_build(self):
+        self.retrieval_worker = RetrievalIndexWorker(self.retrieval)
+        self.retrieval_worker.error_signal.connect(
+            lambda msg: self.statusBar().showMessage(f"⚠️ 建立写作检索索引失败：{msg}", 5000))
+        self.retrieval_worker.start()
+
+    def stop_retrieval_build(self):
+        worker = getattr(self, 'retrieval_worker', None)
+        if worker is not None and worker.isRunning():
+            worker.cancel()
+            worker.wait()
+
+    def open_search_panel(self):
+        self.sidebar_stacked.setCurrentIndex(2)
+        self.sidebar_stacked.show()
+        self.btn_sidebar_log.setChecked(False)
+        self.btn_sidebar_modifier.setChecked(False)
+        self.btn_sidebar_search.setChecked(True)
+        self.search_input.setFocus()
+        self.search_input.selectAll()
+
+    def run_full_text_search(self):
+        query = self.search_input.text().strip()
+        self.search_results.clear()
+        if not query:
+            return
+        # 编辑器里尚未保存的改动先落盘，搜索结果才与正文一致
+        self.save_all(silent=True)
+
+        timer = QElapsedTimer()
+        timer.start()
+        hits = self.search_index.search(query)
+        elapsed = timer.elapsed()
+
+        for vol_name, chap_name, offset, snippet in hits:
+            item = QListWidgetItem(f"[{vol_name}-{chap_name}] …{snippet}…")
+            item.setData(Qt.ItemDataRole.UserRole, (vol_name, chap_name, offset, len(query)))
+            self.search_results.addItem(item)
+        syncing = getattr(self, 'search_index_worker', None) is not None and self.search_index_worker.isRunning()
+        note = "（索引仍在建立中，结果可能不全）" if syncing else ""
+        self.lbl_search_status.setText(f"共 {len(hits)} 处命中，用时 {elapsed} ms{note}")
+
+    def jump_to_search_hit(self, item):
+        vol_name, chap_name, offset, length = item.data(Qt.ItemDataRole.UserRole)
+        tree_root = self.tree.topLevelItem(0)
+        for v_idx, vol in enumerate(self.project.meta["volumes"]):
+            if vol["name"] != vol_name:
+                continue
+            for c_idx, chap in enumerate(vol["chapters"]):
+                if chap["name"] == chap_name:
+                    chap_item = tree_root.child(v_idx).child(c_idx)
+                    self.tree.setCurrentItem(chap_item)
+                    self.on_tree_select(chap_item)
+                    cursor = self.content_output.textCursor()
+                    cursor.setPosition(min(offset, len(self.content_output.toPlainText())))
+                    cursor.setPosition(min(offset + length, len(self.content_output.toPlainText())),
+                                       QTextCursor.MoveMode.KeepAnchor)
+                    self.content_output.setTextCursor(cursor)
+                    self.content_output.ensureCursorVisible()
+                    self.content_output.setFocus()
+                    return
+        self.lbl_search_status.setText("⚠️ 该章节已被删除或改名，请重新搜索")
 
     def show_editor_context_menu(self, pos):
         # 调用 PyQt 原生的富文本标准菜单
@@ -1486,6 +1794,7 @@ class MainWindow(QMainWindow):
         self.sidebar_stacked.show()
         self.btn_sidebar_modifier.setChecked(True)
         self.btn_sidebar_log.setChecked(False)
+        self.btn_sidebar_search.setChecked(False)
 
         # 3. 数据灌入
         self.mod_selected_text.setPlainText(selected_text)
@@ -1528,7 +1837,11 @@ class MainWindow(QMainWindow):
         model = self.settings.value("model", "deepseek-reasoner")
         temp = float(self.settings.value("temperature", 0.7))
 
-        self.mod_worker = SegmentModifyWorker(api_key, base_url, model, temp, sys_prompt, user_prompt)
+        chapter = None
+        if self.current_vol_index != -1 and self.current_chap_index != -1:
+            vol = self.project.meta["volumes"][self.current_vol_index]
+            chapter = (vol["name"], vol["chapters"][self.current_chap_index]["name"])
+        self.mod_worker = SegmentModifyWorker(api_key, base_url, model, temp, sys_prompt, user_prompt, chapter=chapter)
         # 如果模型吐出了思考过程，我们可以拼接到原先的思考日志窗，或者直接无视
         self.mod_worker.reasoning_signal.connect(self.append_thinking)
         self.mod_worker.content_signal.connect(lambda text: self.mod_result.insertPlainText(text))
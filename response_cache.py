@@ -0,0 +1,115 @@
+# response_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# 缓存条目的最长保留天数与缓存文件的总大小上限
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# 每写入这么多条检查一次是否需要淘汰
+EVICT_EVERY = 50
+# 设置里“响应缓存”开关的默认值：缓存会让重新生成得到与上次完全相同的结果，需要用户主动开启
+DEFAULT_ENABLED = False
+
+
+def make_key(base_url, model, temperature, messages, options=None):
+    """
+    按 (接口地址, 模型, 温度, 全部消息, 其余请求参数) 计算缓存键；任何一个字节不同都视为不同请求。
+    不同服务商可能用同一个模型名，接口地址也要算进去。
+    """
+    payload = json.dumps({"base_url": base_url, "model": model, "temperature": temperature, "messages": messages,
+                          "options": options or {}}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    项目级的 LLM 响应缓存，存放在项目目录下的 llm_cache.db。
+    只缓存非流式语义的请求（LLMSession.complete）：取消重试、对没改动的章节重跑纠错、反复开关挂机时，
+    完全相同的请求直接返回上次的结果，不再消耗 token。
+    超过 max_age_days 的条目作废；总大小超过 max_bytes 时按最近使用时间从旧到新淘汰。
+    """
+    FILENAME = "llm_cache.db"
+
+    def __init__(self, root_path, max_age_days=DEFAULT_MAX_AGE_DAYS, max_bytes=DEFAULT_MAX_BYTES):
+        self.db_path = os.path.join(root_path, self.FILENAME)
+        self.max_age = max_age_days * 86400
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        # 多个工作线程共用一个连接，由锁串行化
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            if self.conn is None:
+                return None  # 项目已关闭，后台线程里迟到的请求按未命中处理
+            row = self.conn.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        with self._lock:
+            if self.conn is None:
+                return
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, content, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, content, len(content.encode("utf-8")), now, now))
+            # 第一次写入时就检查一次，之后每 EVICT_EVERY 次检查一次
+            if self._puts % EVICT_EVERY == 0:
+                self._evict(now)
+            self._puts += 1
+
+    def _evict(self, now):
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            # 淘汰到上限的八成，免得每次写入都要触发淘汰
+            excess = total - self.max_bytes * 0.8
+            doomed = []
+            for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                doomed.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def clear(self):
+        with self._lock:
+            if self.conn is None:
+                return
+            with self.conn:
+                self.conn.execute("DELETE FROM responses")
+            self.conn.execute("VACUUM")
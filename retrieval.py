@@ -0,0 +1,216 @@
+# retrieval.py
+import re
+import math
+import threading
+from collections import defaultdict
+
+# 正文切成的检索片段长度（字），片段按段落边界聚合，不会把一段话拦腰截断
+PASSAGE_CHARS = 300
+# 写作 prompt 中附带的检索片段条数
+RETRIEVAL_TOP_K = 5
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CJK_RUN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+
+def tokenize(text):
+    """中文按相邻两字切成二元组（单字的片段保留单字），英文/数字按整词小写，适合无词典的中文检索"""
+    tokens = []
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD_RE.findall(text))
+    return tokens
+
+
+def split_passages(content, size=PASSAGE_CHARS):
+    """按段落聚合成约 size 字的片段"""
+    passages = []
+    current = []
+    length = 0
+    for para in content.split("\n"):
+        para = para.strip()
+        if not para:
+            continue
+        current.append(para)
+        length += len(para)
+        if length >= size:
+            passages.append("\n".join(current))
+            current, length = [], 0
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+class RetrievalIndex:
+    """
+    全书正文与章节概要的本地 BM25 检索索引（内存中，按中文二元组建倒排）。
+    首次建索引需要读入全书，应在后台线程调用 build()；之后正文保存时通过项目的正文监听增量更新单章，
+    概要与卷章结构的变动在每次查询前对照 meta 补齐，无需整体重建。
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._passages = {}  # pid -> (doc_key, kind, text, length)
+        self._doc_passages = defaultdict(list)  # (vol_name, chap_name) -> [pid]
+        self._doc_sources = {}  # (doc_key, kind) -> 建索引时的原文，用于判断是否需要更新
+        self._postings = defaultdict(dict)  # token -> {pid: tf}
+        self._total_length = 0
+        self._ready = False  # 首次建索引是否已完成
+        # 正文保存发生在主线程，这里只登记待更新的正文，真正的索引更新推迟到下次查询时进行，
+        # 避免与后台线程正在进行的首次建索引抢锁而卡住界面
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        project.add_content_listener(self._on_content_saved)
+
+    def close(self):
+        self.project.remove_content_listener(self._on_content_saved)
+
+    def is_ready(self):
+        return self._ready
+
+    def build(self, should_stop=None):
+        """读入全书完成首次建索引（耗时，供后台线程调用）。返回是否完整建完，中途取消时已读入的部分保留"""
+        with self._lock:
+            self._sync(should_stop)
+            if should_stop and should_stop():
+                return False
+            self._ready = True
+            return True
+
+    # --- 查询 ---
+    def search(self, query, k=5, before=None, exclude=(), wait=True):
+        """
+        返回与 query 最相关的 k 个片段 [(score, vol_name, chap_name, kind, text)]，kind 为 "body" 或 "summary"。
+        before=(v_idx, c_idx) 时只在该章之前的章节中检索；exclude 为要排除的 (vol_name, chap_name)。
+        wait=False 时若首次建索引尚未完成则直接返回空列表，不在调用线程（如界面线程）里读全书。
+        """
+        if not wait and not self._ready:
+            return []
+        with self._lock:
+            order = self._sync()
+            self._ready = True
+            limit = None
+            if before is not None:
+                limit = sum(len(v["chapters"]) for v in self.project.meta["volumes"][:before[0]]) + before[1]
+
+            terms = set(tokenize(query))
+            n = len(self._passages)
+            if not terms or not n:
+                return []
+            avgdl = self._total_length / n
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for pid, tf in postings.items():
+                    length = self._passages[pid][3]
+                    scores[pid] += idf * tf * (BM25_K1 + 1) / (
+                            tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl))
+
+            results = []
+            for pid, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                doc_key, kind, text, _ = self._passages[pid]
+                if doc_key in exclude:
+                    continue
+                if limit is not None and order.get(doc_key, limit) >= limit:
+                    continue
+                results.append((score, doc_key[0], doc_key[1], kind, text))
+                if len(results) >= k:
+                    break
+            return results
+
+    # --- 增量维护 ---
+    def _on_content_saved(self, vol_name, chap_name, content):
+        with self._pending_lock:
+            self._pending[(vol_name, chap_name)] = content
+
+    def _sync(self, should_stop=None):
+        """对照当前 meta 补齐索引：新增/改名的章节读入正文，删除的章节移出，概要变化的重建概要片段。返回章节顺序表"""
+        order = {}
+        for vol in self.project.meta["volumes"]:
+            for chap in vol["chapters"]:
+                order[(vol["name"], chap["name"])] = len(order)
+
+        for doc_key in [key for key in self._doc_passages if key not in order]:
+            self._remove_doc(doc_key)
+            self._doc_sources.pop((doc_key, "body"), None)
+            self._doc_sources.pop((doc_key, "summary"), None)
+
+        for vol in self.project.meta["volumes"]:
+            if should_stop and should_stop():
+                return order
+            for chap in vol["chapters"]:
+                doc_key = (vol["name"], chap["name"])
+                if (doc_key, "body") not in self._doc_sources:
+                    self._update_doc(doc_key, "body", self.project.read_chapter_content(*doc_key))
+                self._update_doc(doc_key, "summary", chap.get("ai_synopsis", ""))
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for doc_key, content in pending.items():
+            if doc_key in order:
+                self._update_doc(doc_key, "body", content)
+        return order
+
+    def _update_doc(self, doc_key, kind, text):
+        if self._doc_sources.get((doc_key, kind)) == text:
+            return
+        self._doc_sources[(doc_key, kind)] = text
+        self._remove_doc(doc_key, kind)
+        pieces = split_passages(text) if kind == "body" else ([text.strip()] if text.strip() else [])
+        for piece in pieces:
+            pid = self._next_id
+            self._next_id += 1
+            tokens = tokenize(piece)
+            self._passages[pid] = (doc_key, kind, piece, len(tokens))
+            self._doc_passages[doc_key].append(pid)
+            self._total_length += len(tokens)
+            counts = defaultdict(int)
+            for token in tokens:
+                counts[token] += 1
+            for token, tf in counts.items():
+                self._postings[token][pid] = tf
+
+    def _remove_doc(self, doc_key, kind=None):
+        kept = []
+        for pid in self._doc_passages.get(doc_key, []):
+            _, p_kind, text, length = self._passages[pid]
+            if kind is not None and p_kind != kind:
+                kept.append(pid)
+                continue
+            del self._passages[pid]
+            self._total_length -= length
+            for token in set(tokenize(text)):
+                postings = self._postings.get(token)
+                if postings is not None:
+                    postings.pop(pid, None)
+                    if not postings:
+                        del self._postings[token]
+        if kept:
+            self._doc_passages[doc_key] = kept
+        else:
+            self._doc_passages.pop(doc_key, None)
+
+
+def format_passages(results, max_chars=1500):
+    """把检索结果整理成 prompt 片段，总长度不超过 max_chars"""
+    lines = []
+    used = 0
+    for _, vol_name, chap_name, kind, text in results:
+        label = "概要" if kind == "summary" else "正文"
+        line = f"[{vol_name}-{chap_name}|{label}] {text}\n"
+        if used + len(line) > max_chars:
+            break
+        lines.append(line)
+        used += len(line)
+    return "".join(lines)
@@ -0,0 +1,227 @@
+# search_index.py
+import os
+import sqlite3
+import hashlib
+import threading
+
+# 每条命中前后截取的上下文字数
+SNIPPET_CONTEXT = 20
+# 单次搜索最多返回的命中数
+MAX_HITS = 500
+# 求候选章节时最多使用的查询二元组数。候选最终都会用 str.find 复核，只取一部分二元组结果不变，
+# 同时保证 IN (...) 的参数个数远低于 SQLite 的绑定变量上限（较老版本只有 999 个）
+MAX_QUERY_TOKENS = 64
+
+
+def bigrams(text):
+    """
+    逐行切出相邻两字（不跨行），中文无需分词即可做子串检索。
+    二元组编码成整数（两个码点拼接）存储，倒排表比存字符串小得多，建索引也快得多。
+    """
+    tokens = set()
+    for line in text.split("\n"):
+        codes = [ord(ch) for ch in line]
+        tokens.update((a << 21) | b for a, b in zip(codes, codes[1:]))
+    return tokens
+
+
+class SearchIndex:
+    """
+    全书全文检索的持久化倒排索引，存放在项目目录下的 search_index.db。
+    倒排表记录“二元组 -> 包含它的章节”，查询时先用倒排表求候选章节的交集，
+    再在候选章节正文里用 str.find 定位出每一处命中的偏移，结果与逐章查找完全一致。
+    正文保存时通过项目的正文监听增量更新对应章节，卷章改名/删除通过变更监听随之改键或移除；
+    启动后 sync() 负责补齐外部改动。
+    """
+    FILENAME = "search_index.db"
+
+    def __init__(self, project):
+        self.project = project
+        self.db_path = os.path.join(project.root_path, self.FILENAME)
+        self._lock = threading.RLock()
+        # 同步在后台线程进行，查询与增量更新在主线程，共用一个连接并由锁串行化
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    id INTEGER PRIMARY KEY,
+                    volume TEXT NOT NULL,
+                    chapter TEXT NOT NULL,
+                    stamp TEXT,
+                    content_hash TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    UNIQUE (volume, chapter)
+                );
+                CREATE TABLE IF NOT EXISTS postings (
+                    token INTEGER NOT NULL,
+                    doc_id INTEGER NOT NULL,
+                    PRIMARY KEY (token, doc_id)
+                ) WITHOUT ROWID;
+            """)
+        project.add_content_listener(self._on_content_saved)
+        project.add_change_listener(self._on_project_change)
+
+    def close(self):
+        self.project.remove_content_listener(self._on_content_saved)
+        self.project.remove_change_listener(self._on_project_change)
+        with self._lock:
+            self.conn.close()
+
+    def _stamp(self, vol_name, chap_name):
+        storage = getattr(self.project, "storage", None)
+        if storage is None:
+            return None  # SQLite 项目的正文只会经由本程序修改，靠正文监听即可
+        stamp = storage.stat(vol_name, chap_name)
+        return None if stamp is None else f"{stamp[0]}:{stamp[1]}"
+
+    # --- 维护 ---
+    def sync(self, progress=None, should_stop=None):
+        """
+        对照当前卷章结构补齐索引：新章节/外部修改过的章节重新入库，已删除或改名前的旧条目移除。
+        逐章加锁，不会长时间阻塞主线程的查询。progress(done, total) 用于报告进度。返回重建的章数。
+        """
+        chapters = [(v["name"], c["name"]) for v in self.project.meta["volumes"] for c in v["chapters"]]
+        with self._lock:
+            indexed = {(vol, chap): (doc_id, stamp) for doc_id, vol, chap, stamp in
+                       self.conn.execute("SELECT id, volume, chapter, stamp FROM docs")}
+            live = set(chapters)
+            stale_ids = [doc_id for key, (doc_id, _) in indexed.items() if key not in live]
+            for doc_id in stale_ids:
+                with self.conn:
+                    self._remove_doc(doc_id)
+
+        rebuilt = 0
+        for done, (vol_name, chap_name) in enumerate(chapters, 1):
+            if should_stop and should_stop():
+                break
+            stamp = self._stamp(vol_name, chap_name)
+            entry = indexed.get((vol_name, chap_name))
+            if entry is None or (stamp is not None and entry[1] != stamp):
+                # 读正文与入库在同一把锁内完成，期间主线程的保存会排在后面，不会被旧正文覆盖
+                with self._lock:
+                    content = self.project.read_chapter_content(vol_name, chap_name)
+                    if self._index_doc(vol_name, chap_name, content, stamp):
+                        rebuilt += 1
+            if progress:
+                progress(done, len(chapters))
+        return rebuilt
+
+    def _on_content_saved(self, vol_name, chap_name, content):
+        self._index_doc(vol_name, chap_name, content, self._stamp(vol_name, chap_name))
+
+    def _on_project_change(self, op):
+        kind = op["op"]
+        with self._lock, self.conn:
+            if kind == "update_volume" and "old_name" in op:
+                new_name = op["fields"]["name"]
+                self._remove_docs("volume = ?", (new_name,))  # 新名字下残留的旧条目，避免唯一约束冲突
+                self.conn.execute("UPDATE docs SET volume = ? WHERE volume = ?", (new_name, op["old_name"]))
+            elif kind == "update_chapter" and "old_name" in op:
+                vol_name, new_name = self.project.meta["volumes"][op["v"]]["name"], op["fields"]["name"]
+                self._remove_docs("volume = ? AND chapter = ?", (vol_name, new_name))
+                self.conn.execute("UPDATE docs SET chapter = ? WHERE volume = ? AND chapter = ?",
+                                  (new_name, vol_name, op["old_name"]))
+            elif kind == "delete_volume" and "name" in op:
+                self._remove_docs("volume = ?", (op["name"],))
+            elif kind == "delete_chapter" and "name" in op:
+                self._remove_docs("volume = ? AND chapter = ?",
+                                  (self.project.meta["volumes"][op["v"]]["name"], op["name"]))
+
+    def _remove_docs(self, where, params):
+        for (doc_id,) in self.conn.execute(f"SELECT id FROM docs WHERE {where}", params).fetchall():
+            self._remove_doc(doc_id)
+
+    def _remove_doc(self, doc_id):
+        # 倒排表按 (token, doc_id) 建主键，用旧正文的二元组逐条删除，无需按 doc_id 全表扫描
+        row = self.conn.execute("SELECT content FROM docs WHERE id = ?", (doc_id,)).fetchone()
+        if row is not None:
+            self.conn.executemany("DELETE FROM postings WHERE token = ? AND doc_id = ?",
+                                  ((token, doc_id) for token in bigrams(row[0])))
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def _index_doc(self, vol_name, chap_name, content, stamp):
+        """
+        索引单章；正文没变时只更新时间戳。返回是否改动了倒排。
+        已有章节只增删新旧正文二元组的差集，改几个字的保存只涉及寥寥几行。
+        """
+        content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT id, content_hash, content FROM docs WHERE volume = ? AND chapter = ?",
+                                    (vol_name, chap_name)).fetchone()
+            if row is not None and row[1] == content_hash:
+                self.conn.execute("UPDATE docs SET stamp = ? WHERE id = ?", (stamp, row[0]))
+                return False
+            new_tokens = bigrams(content)
+            if row is None:
+                doc_id = self.conn.execute(
+                    "INSERT INTO docs (volume, chapter, stamp, content_hash, content) VALUES (?, ?, ?, ?, ?)",
+                    (vol_name, chap_name, stamp, content_hash, content)).lastrowid
+                added, removed = new_tokens, ()
+            else:
+                doc_id = row[0]
+                old_tokens = bigrams(row[2])
+                added, removed = new_tokens - old_tokens, old_tokens - new_tokens
+                self.conn.execute("UPDATE docs SET stamp = ?, content_hash = ?, content = ? WHERE id = ?",
+                                  (stamp, content_hash, content, doc_id))
+            self.conn.executemany("DELETE FROM postings WHERE token = ? AND doc_id = ?",
+                                  ((token, doc_id) for token in removed))
+            # 按 token 排序插入，B 树页的访问更集中
+            self.conn.executemany("INSERT INTO postings (token, doc_id) VALUES (?, ?)",
+                                  ((token, doc_id) for token in sorted(added)))
+            return True
+
+    # --- 查询 ---
+    def body_lengths(self):
+        """{(卷名, 章名): 去掉首尾空白后的正文字数}，直接在库里计算，不必逐章读盘解析正文"""
+        with self._lock:
+            rows = self.conn.execute("SELECT volume, chapter, length(trim(content, ?)) FROM docs",
+                                     (" \t\r\n\v\f\u3000",)).fetchall()
+        return {(vol, chap): length for vol, chap, length in rows}
+
+    def search(self, query, max_hits=MAX_HITS):
+        """
+        返回 [(vol_name, chap_name, offset, snippet)]，按全书阅读顺序排列。
+        offset 为命中处在该章正文中的字符偏移。
+        """
+        query = query.strip()
+        if not query or "\n" in query:
+            return []
+        with self._lock:
+            # bigrams 已去重；超长查询只均匀抽取其中一部分参与筛选，绑定的参数个数有上限
+            tokens = sorted(bigrams(query))
+            if len(tokens) > MAX_QUERY_TOKENS:
+                step = len(tokens) / MAX_QUERY_TOKENS
+                tokens = [tokens[int(i * step)] for i in range(MAX_QUERY_TOKENS)]
+            if tokens:
+                placeholders = ",".join("?" * len(tokens))
+                rows = self.conn.execute(f"""
+                    SELECT d.volume, d.chapter, d.content FROM docs d
+                    WHERE d.id IN (
+                        SELECT doc_id FROM postings WHERE token IN ({placeholders})
+                        GROUP BY doc_id HAVING COUNT(*) = ?
+                    )""", (*tokens, len(tokens))).fetchall()
+            else:
+                # 单字查询没有二元组可用，直接在已入库的正文里查找
+                rows = self.conn.execute("SELECT volume, chapter, content FROM docs WHERE instr(content, ?) > 0",
+                                         (query,)).fetchall()
+
+        order = {}
+        for vol in self.project.meta["volumes"]:
+            for chap in vol["chapters"]:
+                order[(vol["name"], chap["name"])] = len(order)
+        rows.sort(key=lambda row: order.get((row[0], row[1]), len(order)))
+
+        hits = []
+        for vol_name, chap_name, content in rows:
+            pos = content.find(query)
+            while pos != -1:
+                start = max(0, pos - SNIPPET_CONTEXT)
+                end = min(len(content), pos + len(query) + SNIPPET_CONTEXT)
+                snippet = content[start:end].replace("\n", " ")
+                hits.append((vol_name, chap_name, pos, snippet))
+                if len(hits) >= max_hits:
+                    return hits
+                pos = content.find(query, pos + len(query))
+        return hits
@@ -0,0 +1,142 @@
+# tests/test_context_builder.py
+from context_builder import (ANCHOR_RESERVE_SHARE, HistoryBuilder, estimate_tokens,
+                             format_chapter_line, format_volume_digest_line, format_volume_line)
+from data_manager import NovelProject
+
+
+def _project(root, volumes=2, chapters=5, synopsis_len=20):
+    project = NovelProject(str(root))
+    with project.batch():
+        for v in range(volumes):
+            project.add_volume(f"第{v + 1}卷", synopsis=f"卷{v + 1}梗概")
+            for c in range(chapters):
+                project.add_chapter(v, f"第{c + 1}章", ai_synopsis=f"卷{v + 1}章{c + 1}" + "剧情" * synopsis_len)
+    return project
+
+
+def _from_scratch(project, v_idx, c_idx):
+    """不经过增量缓存，直接按阅读顺序拼出 (v_idx, c_idx) 之前的历史"""
+    parts = []
+    for v, vol in enumerate(project.meta["volumes"]):
+        if v > v_idx or (v == v_idx and c_idx == -1):
+            break
+        parts.append(format_volume_line(vol))
+        chapters = vol["chapters"] if v < v_idx else vol["chapters"][:c_idx]
+        parts.extend(format_chapter_line(chap) for chap in chapters)
+    return "".join(parts)
+
+
+# --- 增量前缀 ---
+def test_prefix_matches_full_rebuild(tmp_path):
+    project = _project(tmp_path)
+    builder = HistoryBuilder(project)
+    for v in range(2):
+        assert builder.before_volume(v) == _from_scratch(project, v, -1)
+        for c in range(6):
+            assert builder.before_chapter(v, c) == _from_scratch(project, v, c)
+    assert builder.full() == _from_scratch(project, 2, -1)
+
+
+def test_appending_a_chapter_appends_one_line(tmp_path):
+    project = _project(tmp_path, volumes=1, chapters=3)
+    builder = HistoryBuilder(project)
+    before = builder.before_chapter(0, 3)
+    project.add_chapter(0, "第4章", ai_synopsis="新写完的一章")
+    after = builder.before_chapter(0, 4)
+    assert after == before + format_chapter_line(project.meta["volumes"][0]["chapters"][3])
+
+
+def test_change_listener_invalidates_from_edit_point(tmp_path):
+    project = _project(tmp_path)
+    builder = HistoryBuilder(project)
+    builder.full()
+
+    project.update_chapter(0, 2, ai_synopsis="改写后的概要")
+    assert "改写后的概要" in builder.full()
+    project.rename_volume(1, "终卷")
+    project.rename_chapter(0, 0, "序章")
+    project.delete_chapter(0, 3)
+    project.update_volume(0, synopsis="新的卷梗概")
+    project.add_volume("第三卷")
+    project.add_chapter(2, "第1章", synopsis="用户细纲")
+    assert builder.full() == _from_scratch(project, 3, -1)
+    assert builder.before_chapter(1, 2) == _from_scratch(project, 1, 2)
+
+    # 摘要不在剧情轨迹里，改它不作废已构建的前缀
+    length = len(builder._text)
+    project.update_volume(0, digest="第一卷摘要")
+    assert len(builder._text) == length
+
+
+def test_close_stops_listening(tmp_path):
+    project = _project(tmp_path, volumes=1, chapters=2)
+    builder = HistoryBuilder(project)
+    builder.full()
+    builder.close()
+    project.update_chapter(0, 0, ai_synopsis="关闭之后的修改")
+    assert "关闭之后的修改" not in builder.full()
+
+
+# --- token 预算与分层压缩 ---
+def test_budgeted_is_plain_prefix_when_it_fits(tmp_path):
+    project = _project(tmp_path)
+    builder = HistoryBuilder(project, token_budget=100000)
+    assert builder.budgeted(1, 3) == builder.before_chapter(1, 3)
+    assert builder.budgeted(2) == builder.before_volume(2)
+
+
+def test_budgeted_stays_under_ceiling_as_book_grows(tmp_path):
+    project = _project(tmp_path, volumes=6, chapters=30, synopsis_len=40)
+    builder = HistoryBuilder(project, token_budget=3000)
+    assert estimate_tokens(builder.full()) > 3000 * 5
+    for v in range(6):
+        for c in (-1, 1, 15, 30):
+            text = builder.budgeted(v, c)
+            assert estimate_tokens(text) <= 3000
+            if c > 0:
+                # 紧挨着目标位置的那一章总是完整梗概
+                assert text.endswith(format_chapter_line(project.meta["volumes"][v]["chapters"][c - 1]))
+
+
+def test_distant_volumes_roll_up_to_digests(tmp_path):
+    project = _project(tmp_path, volumes=4, chapters=3)
+    project.update_volume(0, digest="第一卷的卷级摘要")
+    project.update_volume(2, digest="第三卷的卷级摘要")
+    builder = HistoryBuilder(project, token_budget=100000)
+
+    text = builder.budgeted(3, 1)
+    assert text.startswith(format_volume_digest_line(project.meta["volumes"][0]))
+    assert "卷1章1" not in text
+    # 紧挨当前卷的一卷即使有摘要也保留逐章梗概
+    assert "第三卷的卷级摘要" not in text and "卷3章3" in text
+    assert "卷2章1" in text
+
+
+def test_consecutive_chapters_share_prefix_under_anchor(tmp_path):
+    project = _project(tmp_path, volumes=1, chapters=80, synopsis_len=40)
+    budget = 2000
+    builder = HistoryBuilder(project, token_budget=budget)
+    chapters = project.meta["volumes"][0]["chapters"]
+    line_cost = estimate_tokens(format_chapter_line(chapters[0]))
+
+    results = [builder.budgeted(0, c) for c in range(1, 81)]
+    assert all(estimate_tokens(text) <= budget for text in results)
+    anchor_moves = 0
+    for c, (prev, cur) in enumerate(zip(results, results[1:]), start=2):
+        if cur == prev + format_chapter_line(chapters[c - 1]):
+            continue
+        anchor_moves += 1
+    # 每段追加部分用满预留额度才换锚点：锚点移动次数约为 章数 / 每段能放下的行数
+    lines_per_anchor = int(budget * ANCHOR_RESERVE_SHARE) // line_cost
+    assert lines_per_anchor >= 2
+    assert anchor_moves <= 80 // lines_per_anchor + 1
+
+
+def test_anchor_does_not_move_when_later_chapters_are_written(tmp_path):
+    project = _project(tmp_path, volumes=1, chapters=40, synopsis_len=40)
+    builder = HistoryBuilder(project, token_budget=2000)
+    before = builder.budgeted(0, 30)
+    with project.batch():
+        for c in range(40, 60):
+            project.add_chapter(0, f"第{c + 1}章", ai_synopsis="后写的章节" * 20)
+    assert builder.budgeted(0, 30) == before
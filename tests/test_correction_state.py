@@ -0,0 +1,24 @@
+# tests/test_correction_state.py
+from correction_state import SettingScanState, content_hash
+
+
+def test_typo_fix_carries_setting_scan_over(tmp_path):
+    state = SettingScanState(str(tmp_path))
+    state.mark_scanned([("卷一", "第一章", "概要", content_hash("他走进了房问。"))])
+
+    state.carry_over("卷一", "第一章", content_hash("他走进了房问。"), content_hash("他走进了房间。"))
+
+    reloaded = SettingScanState(str(tmp_path))
+    assert reloaded.changes("卷一", "第一章", "概要", content_hash("他走进了房间。")) == []
+
+
+def test_carry_over_keeps_unreviewed_body_changes(tmp_path):
+    state = SettingScanState(str(tmp_path))
+    state.mark_scanned([("卷一", "第一章", "概要", content_hash("旧正文"))])
+
+    # 校对前的正文已经不是复核过的版本（用户改过情节），不能顺延
+    state.carry_over("卷一", "第一章", content_hash("改过情节的正文"), content_hash("改过情节的正文。"))
+    state.carry_over("卷一", "第二章", content_hash("新章"), content_hash("新章。"))
+
+    assert state.changes("卷一", "第一章", "概要", content_hash("改过情节的正文。")) == ["body"]
+    assert state.changes("卷一", "第二章", "", content_hash("新章。")) == ["new"]
@@ -0,0 +1,281 @@
+# tests/test_data_manager.py
+import json
+import os
+
+import pytest
+
+import data_manager
+from data_manager import NovelProject, SQLiteNovelProject, import_folder_project, open_project
+
+
+def _folder_project(root):
+    project = NovelProject(str(root))
+    project.update_meta(global_synopsis="少年入山修行", characters=[{"name": "萧炎"}])
+    project.add_volume("第一卷", synopsis="入门")
+    project.add_chapter(0, "第一章", synopsis="拜师", ai_synopsis="萧炎拜入山门")
+    project.add_chapter(0, "第二章", synopsis="试炼")
+    project.add_volume("第二卷")
+    project.add_chapter(1, "第三章")
+    project.update_volume(0, digest="第一卷摘要")
+    project.save_chapter_content("第一卷", "第一章", "第一章正文\n第二段")
+    project.save_chapter_content("第一卷", "第二章", "第二章正文")
+    project.flush_meta()
+    return project
+
+
+def test_import_round_trip(tmp_path):
+    source = _folder_project(tmp_path)
+    imported = import_folder_project(str(tmp_path))
+    imported.close()
+
+    reopened = open_project(str(tmp_path))
+    try:
+        assert isinstance(reopened, SQLiteNovelProject)
+        expected = {k: v for k, v in source.meta.items() if k not in ("storage", "journal_seq")}
+        actual = {k: v for k, v in reopened.meta.items() if k != "storage"}
+        assert actual == expected
+        for vol in source.meta["volumes"]:
+            for chap in vol["chapters"]:
+                assert reopened.read_chapter_content(vol["name"], chap["name"]) == \
+                       source.read_chapter_content(vol["name"], chap["name"])
+        with pytest.raises(FileNotFoundError):
+            reopened.save_chapter_content("第一卷", "不存在的章", "正文")
+    finally:
+        reopened.close()
+
+
+def test_failed_import_leaves_folder_project_intact(tmp_path, monkeypatch):
+    source = _folder_project(tmp_path)
+    meta_before = (tmp_path / "meta.json").read_bytes()
+    read = NovelProject.read_chapter_content
+
+    def flaky_read(self, vol_name, chap_name):
+        if chap_name == "第二章":
+            raise OSError("磁盘读取失败")
+        return read(self, vol_name, chap_name)
+
+    monkeypatch.setattr(NovelProject, "read_chapter_content", flaky_read)
+    with pytest.raises(OSError):
+        import_folder_project(str(tmp_path))
+    monkeypatch.undo()
+
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(SQLiteNovelProject.DB_FILENAME)]
+    assert (tmp_path / "meta.json").read_bytes() == meta_before
+    reopened = open_project(str(tmp_path))
+    assert type(reopened) is NovelProject
+    assert reopened.meta["volumes"] == source.meta["volumes"]
+    assert reopened.read_chapter_content("第一卷", "第二章") == "第二章正文"
+
+    # 失败之后可以重新导入
+    import_folder_project(str(tmp_path)).close()
+    reopened = open_project(str(tmp_path))
+    assert isinstance(reopened, SQLiteNovelProject)
+    assert reopened.read_chapter_content("第一卷", "第二章") == "第二章正文"
+    reopened.close()
+
+
+def test_import_refuses_to_overwrite_existing_database(tmp_path):
+    _folder_project(tmp_path)
+    import_folder_project(str(tmp_path)).close()
+    with pytest.raises(ValueError):
+        import_folder_project(str(tmp_path))
+
+
+# --- 正文解码缓存 ---
+def _text_project(root, chapters=("第一章",), **kwargs):
+    project = NovelProject(str(root), **kwargs)
+    project.add_volume("第一卷")
+    for name in chapters:
+        project.add_chapter(0, name)
+    return project
+
+
+def _write_externally(project, chap_name, content, mtime_ns=None):
+    path = project.storage.path("第一卷", chap_name)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(content)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_cache_hit_after_first_read(tmp_path):
+    project = _text_project(tmp_path)
+    _write_externally(project, "第一章", "正文")
+    assert project.read_chapter_content("第一卷", "第一章") == "正文"
+    assert project.read_chapter_content("第一卷", "第一章") == "正文"
+    stats = project.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_save_writes_through_cache(tmp_path):
+    project = _text_project(tmp_path)
+    project.save_chapter_content("第一卷", "第一章", "刚保存的正文")
+    assert project.read_chapter_content("第一卷", "第一章") == "刚保存的正文"
+    assert project.cache_stats()["misses"] == 0
+
+
+def test_cache_invalidated_when_size_changes(tmp_path):
+    project = _text_project(tmp_path)
+    _write_externally(project, "第一章", "旧正文")
+    project.read_chapter_content("第一卷", "第一章")
+    _write_externally(project, "第一章", "外部编辑后更长的正文")
+    assert project.read_chapter_content("第一卷", "第一章") == "外部编辑后更长的正文"
+    assert project.cache_stats()["misses"] == 2
+
+
+def test_cache_invalidated_when_only_mtime_changes(tmp_path):
+    project = _text_project(tmp_path)
+    _write_externally(project, "第一章", "甲乙丙", mtime_ns=1_000_000_000_000_000_000)
+    project.read_chapter_content("第一卷", "第一章")
+    # 同样长度、不同内容，只有修改时间不同
+    _write_externally(project, "第一章", "丁戊己", mtime_ns=1_000_000_001_000_000_000)
+    assert project.read_chapter_content("第一卷", "第一章") == "丁戊己"
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    project = _text_project(tmp_path, chapters=("一", "二", "三"), cache_size=2)
+    for name in ("一", "二", "三"):
+        _write_externally(project, name, f"第{name}章正文")
+    project.read_chapter_content("第一卷", "一")
+    project.read_chapter_content("第一卷", "二")
+    project.read_chapter_content("第一卷", "一")  # 命中，“一”变为最近使用
+    project.read_chapter_content("第一卷", "三")  # 挤掉最久未用的“二”
+    assert project.cache_stats()["size"] == 2
+
+    project.read_chapter_content("第一卷", "一")
+    project.read_chapter_content("第一卷", "二")
+    stats = project.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (2, 4)
+
+
+def test_cache_stats(tmp_path):
+    project = _text_project(tmp_path, cache_size=8)
+    assert project.cache_stats() == {"hits": 0, "misses": 0, "size": 0, "capacity": 8, "hit_rate": 0.0}
+    _write_externally(project, "第一章", "正文")
+    for _ in range(4):
+        project.read_chapter_content("第一卷", "第一章")
+    assert project.cache_stats() == {"hits": 3, "misses": 1, "size": 1, "capacity": 8, "hit_rate": 0.75}
+
+
+def test_rename_drops_cached_entry(tmp_path):
+    project = _text_project(tmp_path)
+    project.save_chapter_content("第一卷", "第一章", "正文")
+    project.rename_chapter(0, 0, "序章")
+    assert project.cache_stats()["size"] == 0
+    assert project.read_chapter_content("第一卷", "序章") == "正文"
+
+
+# --- meta 变更日志与原子落盘 ---
+def _journaled_project(root):
+    NovelProject(str(root)).close()  # 先建好项目，之后的日志里只有测试做的修改
+    project = NovelProject(str(root), journal=True)
+    project.on_meta_dirty = lambda: None  # 模拟界面的防抖定时器一直没来得及触发
+    return project
+
+
+def _mutate(project):
+    project.update_meta(global_synopsis="全书梗概")
+    project.add_volume("第一卷", synopsis="卷一梗概")
+    project.add_chapter(0, "第一章", synopsis="细纲一")
+    project.add_chapter(0, "第二章", synopsis="细纲二")
+    project.update_chapter(0, 0, ai_synopsis="AI 概要")
+    project.rename_chapter(0, 1, "第二章·改")
+    project.add_volume("第二卷")
+    project.delete_volume(1)
+
+
+def _without_seq(meta):
+    return {k: v for k, v in meta.items() if k != "journal_seq"}
+
+
+def _meta_on_disk(root):
+    with open(os.path.join(str(root), "meta.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_journal_replayed_after_crash(tmp_path):
+    project = _journaled_project(tmp_path)
+    _mutate(project)
+    assert _meta_on_disk(tmp_path)["volumes"] == []  # 一次都没落盘，只有日志
+
+    reopened = NovelProject(str(tmp_path), journal=True)
+    assert _without_seq(reopened.meta) == _without_seq(project.meta)
+    # 重放后立即压缩：meta.json 已是最新，日志清空
+    assert _meta_on_disk(tmp_path)["volumes"] == project.meta["volumes"]
+    assert os.path.getsize(tmp_path / "meta.journal") == 0
+
+
+def test_replay_ignores_torn_last_line(tmp_path):
+    project = _journaled_project(tmp_path)
+    _mutate(project)
+    with open(tmp_path / "meta.journal", "a", encoding="utf-8") as f:
+        f.write('{"op": "add_volume", "name": "写了一半')
+
+    assert _without_seq(NovelProject(str(tmp_path), journal=True).meta) == _without_seq(project.meta)
+
+
+def test_replay_skips_ops_already_in_meta(tmp_path):
+    project = _journaled_project(tmp_path)
+    _mutate(project)
+    stale_lines = (tmp_path / "meta.journal").read_text(encoding="utf-8")
+    project.flush_meta()
+    project.add_chapter(0, "第三章")
+    # 模拟 meta.json 替换成功、日志还没清空就崩溃：已压缩的旧记录仍在日志开头
+    newer_lines = (tmp_path / "meta.journal").read_text(encoding="utf-8")
+    (tmp_path / "meta.journal").write_text(stale_lines + newer_lines, encoding="utf-8")
+
+    reopened = NovelProject(str(tmp_path), journal=True)
+    assert reopened.meta["volumes"] == project.meta["volumes"]
+    assert [c["name"] for c in reopened.meta["volumes"][0]["chapters"]] == ["第一章", "第二章·改", "第三章"]
+
+    # 序号继续递增，之后的变更不会被当作已压缩的旧记录丢掉
+    reopened.on_meta_dirty = lambda: None
+    reopened.add_chapter(0, "第四章")
+    assert _without_seq(NovelProject(str(tmp_path), journal=True).meta) == _without_seq(reopened.meta)
+
+
+def test_journal_compacts_periodically(tmp_path, monkeypatch):
+    monkeypatch.setattr(NovelProject, "JOURNAL_COMPACT_EVERY", 3)
+    project = _journaled_project(tmp_path)
+    project.add_volume("第一卷")
+    project.add_chapter(0, "第一章")
+    assert _meta_on_disk(tmp_path)["volumes"] == []
+    project.add_chapter(0, "第二章")
+    assert _meta_on_disk(tmp_path)["volumes"] == project.meta["volumes"]
+    assert os.path.getsize(tmp_path / "meta.journal") == 0
+
+
+def test_flush_meta_is_atomic(tmp_path, monkeypatch):
+    project = NovelProject(str(tmp_path))
+    project.add_volume("第一卷")
+    before = (tmp_path / "meta.json").read_bytes()
+
+    project.on_meta_dirty = lambda: None
+    project.add_volume("第二卷")
+
+    def failing_replace(src, dst):
+        raise OSError("磁盘已满")
+
+    monkeypatch.setattr(data_manager.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        project.flush_meta()
+    monkeypatch.undo()
+
+    assert (tmp_path / "meta.json").read_bytes() == before
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    assert project.is_dirty()
+    assert project.flush_meta()
+    assert [v["name"] for v in _meta_on_disk(tmp_path)["volumes"]] == ["第一卷", "第二卷"]
+
+
+def test_batch_flushes_once(tmp_path, monkeypatch):
+    project = NovelProject(str(tmp_path))
+    flushes = []
+    flush = NovelProject.flush_meta
+    monkeypatch.setattr(NovelProject, "flush_meta", lambda self: flushes.append(1) or flush(self))
+    with project.batch():
+        project.add_volume("第一卷")
+        for i in range(50):
+            project.add_chapter(0, f"第{i}章")
+    assert len(flushes) == 1
+    assert len(_meta_on_disk(tmp_path)["volumes"][0]["chapters"]) == 50
@@ -0,0 +1,72 @@
+# tests/test_entity_index.py
+import pytest
+
+import entity_index
+from data_manager import NovelProject
+from entity_index import EntityIndex, scan_mentions
+
+
+def test_homophone_spelling_is_flagged():
+    mentions, near_misses = scan_mentions("萧炎握紧拳头。潇焰冷笑一声。", ["萧炎"])
+    assert mentions == {"萧炎": 1}
+    assert near_misses == {"潇焰": ["萧炎", 1]}
+
+
+def test_one_character_typo_is_flagged():
+    _, near_misses = scan_mentions("萧炎回头，萧言却已走远。", ["萧炎"])
+    assert near_misses == {"萧言": ["萧炎", 1]}
+
+
+@pytest.mark.parametrize("name, text", [
+    ("紫涵", "紫涵笑了。孩子含着糖，不肯说话。"),
+    ("月清", "月清推开窗。越轻的脚步越难察觉。"),
+    ("青月", "青月抚琴，琴声清越。"),
+])
+def test_ordinary_words_are_not_flagged(name, text):
+    mentions, near_misses = scan_mentions(text, [name])
+    assert mentions == {name: 1}
+    assert near_misses == {}
+
+
+def test_homophone_groups_skip_common_characters():
+    grouped = "".join(entity_index._HOMOPHONE_GROUPS)
+    for ch in "子言风月云雨语玉师灵清青轻夜业王李张章临尘亭含寒梦离越":
+        assert ch not in grouped
+    assert len(grouped) == len(set(grouped))
+
+
+def test_suspicious_chapters_report_rare_variant(tmp_path):
+    project = NovelProject(str(tmp_path))
+    project.update_meta(characters=[{"name": "萧炎"}, {"name": "紫涵"}])
+    project.add_volume("第一卷")
+    for c in range(4):
+        project.add_chapter(0, f"第{c + 1}章")
+        project.save_chapter_content("第一卷", f"第{c + 1}章", "萧炎与紫涵并肩而行。萧炎道：走吧。孩子含着笑。")
+    project.add_chapter(0, "第5章")
+    project.save_chapter_content("第一卷", "第5章", "萧炎拔剑。潇焰身形一闪。紫涵惊呼。")
+
+    index = EntityIndex(project)
+    index.refresh()
+    try:
+        assert list(index.suspicious_chapters()) == [(0, 4)]
+        assert "潇焰" in index.suspicious_chapters()[(0, 4)][0]
+    finally:
+        index.close()
+
+
+def test_old_scan_version_is_rescanned(tmp_path):
+    project = NovelProject(str(tmp_path))
+    project.add_volume("第一卷")
+    project.add_chapter(0, "第一章")
+    project.save_chapter_content("第一卷", "第一章", "正文")
+    index = EntityIndex(project)
+    index.refresh()
+    index.close()
+
+    with open(index.path, encoding="utf-8") as f:
+        stale = f.read().replace(f'"version": {entity_index.SCAN_VERSION}', '"version": 2')
+    with open(index.path, "w", encoding="utf-8") as f:
+        f.write(stale)
+    reopened = EntityIndex(project)
+    assert reopened.content_digest("第一卷", "第一章") is None
+    reopened.close()
@@ -0,0 +1,142 @@
+# tests/test_job_queue.py
+import pytest
+
+from data_manager import NovelProject
+from job_queue import (KIND_CHAPTER, KIND_PLAN, STATE_DONE, STATE_GENERATED, STATE_PENDING, STATE_STREAMING,
+                       STATE_SUMMARISED, JobQueue)
+
+LONG_TEXT = "正文" * 60
+
+
+@pytest.fixture
+def project(tmp_path):
+    project = NovelProject(str(tmp_path))
+    project.add_volume("第一卷")
+    project.add_chapter(0, "第一章")
+    project.add_chapter(0, "第二章")
+    project.add_volume("第二卷")
+    project.add_chapter(1, "第三章")
+    return project
+
+
+@pytest.fixture
+def queue(project):
+    queue = JobQueue(project.root_path)
+    queue.attach(project)
+    yield queue
+    queue.close()
+
+
+def test_chapter_state_transitions(queue):
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") is None
+    for state, buffer in [(STATE_PENDING, None), (STATE_STREAMING, "已收到的部分"),
+                          (STATE_GENERATED, "正文[AI_SUMMARY]概要"), (STATE_SUMMARISED, "正文"), (STATE_DONE, None)]:
+        queue.set_state(KIND_CHAPTER, "第一卷", "第一章", state, buffer)
+        assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (state, buffer)
+
+
+def test_states_and_unfinished_count(queue):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_DONE)
+    queue.set_state(KIND_CHAPTER, "第一卷", "第二章", STATE_STREAMING, "写到一半")
+    queue.set_state(KIND_CHAPTER, "第二卷", "第三章", STATE_PENDING)
+    queue.mark_plan_done("第一卷")
+
+    assert queue.states(KIND_CHAPTER) == {
+        ("第一卷", "第一章"): (STATE_DONE, None),
+        ("第一卷", "第二章"): (STATE_STREAMING, "写到一半"),
+        ("第二卷", "第三章"): (STATE_PENDING, None),
+    }
+    assert queue.states(KIND_PLAN) == {("第一卷", ""): (STATE_DONE, None)}
+    assert queue.is_plan_done("第一卷") and not queue.is_plan_done("第二卷")
+    assert queue.unfinished_count() == (2, 1)
+
+    queue.clear()
+    assert queue.states(KIND_CHAPTER) == {} and queue.unfinished_count() == (0, 0)
+
+
+def test_rename_follows_project(queue, project):
+    queue.mark_plan_done("第一卷")
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_STREAMING, "写到一半")
+    project.rename_chapter(0, 0, "序章")
+    project.rename_volume(0, "上卷")
+
+    assert queue.state(KIND_CHAPTER, "上卷", "序章") == (STATE_STREAMING, "写到一半")
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") is None
+    assert queue.is_plan_done("上卷")
+
+
+def test_rename_replaces_stale_unit_under_new_name(queue, project):
+    # 新名字下残留着之前删掉的同名章节的记录，改名后以改名的章节为准
+    queue.set_state(KIND_CHAPTER, "第一卷", "第二章", STATE_DONE)
+    queue.set_state(KIND_CHAPTER, "第一卷", "旧章", STATE_PENDING)
+    project.rename_chapter(0, 1, "旧章")
+    assert queue.state(KIND_CHAPTER, "第一卷", "旧章") == (STATE_DONE, None)
+    assert len(queue.states(KIND_CHAPTER)) == 1
+
+
+def test_delete_follows_project(queue, project):
+    queue.mark_plan_done("第二卷")
+    queue.set_state(KIND_CHAPTER, "第一卷", "第二章", STATE_PENDING)
+    queue.set_state(KIND_CHAPTER, "第二卷", "第三章", STATE_PENDING)
+    project.delete_chapter(0, 1)
+    project.delete_volume(1)
+    assert queue.states(KIND_CHAPTER) == {}
+    assert not queue.is_plan_done("第二卷")
+
+
+def test_manual_save_moves_pending_to_done(queue, project):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_PENDING)
+    project.save_chapter_content("第一卷", "第一章", "太短")
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_PENDING, None)
+    project.save_chapter_content("第一卷", "第一章", LONG_TEXT)
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_DONE, None)
+
+
+def test_clearing_done_chapter_moves_it_back_to_pending(queue, project):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_DONE, "残留的输出")
+    project.save_chapter_content("第一卷", "第一章", LONG_TEXT)
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章")[0] == STATE_DONE
+    project.save_chapter_content("第一卷", "第一章", "  \n")
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_PENDING, None)
+
+
+def test_save_leaves_units_owned_by_autopilot(queue, project):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_STREAMING, "写到一半")
+    queue.set_state(KIND_CHAPTER, "第一卷", "第二章", STATE_SUMMARISED, "正文")
+    project.save_chapter_content("第一卷", "第一章", "")
+    project.save_chapter_content("第一卷", "第二章", LONG_TEXT)
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_STREAMING, "写到一半")
+    assert queue.state(KIND_CHAPTER, "第一卷", "第二章") == (STATE_SUMMARISED, "正文")
+
+
+def test_detach_stops_following_project(queue, project):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_PENDING)
+    queue.detach()
+    project.rename_chapter(0, 0, "序章")
+    project.save_chapter_content("第一卷", "序章", LONG_TEXT)
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_PENDING, None)
+
+
+def test_state_persists_across_reopen(queue, project):
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_STREAMING, "写到一半")
+    reopened = JobQueue(project.root_path)
+    try:
+        assert reopened.state(KIND_CHAPTER, "第一卷", "第一章") == (STATE_STREAMING, "写到一半")
+    finally:
+        reopened.close()
+
+
+def test_closed_queue_ignores_late_calls(project):
+    queue = JobQueue(project.root_path)
+    queue.attach(project)
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_PENDING)
+    queue.close()
+
+    assert queue.state(KIND_CHAPTER, "第一卷", "第一章") is None
+    assert queue.states(KIND_CHAPTER) == {}
+    assert queue.unfinished_count() == (0, 0)
+    assert not queue.is_plan_done("第一卷")
+    queue.set_state(KIND_CHAPTER, "第一卷", "第一章", STATE_DONE)
+    queue.on_content_saved("第一卷", "第一章", LONG_TEXT)
+    queue.clear()
+    project.rename_chapter(0, 0, "序章")  # 关闭时已退订，不再回调
@@ -0,0 +1,227 @@
+# tests/test_llm_client.py
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import llm_client
+from llm_client import LLMSession, RetryPolicy, TruncatedResponseError, is_retryable_error, retry_after_seconds
+from usage_ledger import UsageLedger
+
+NOW = 1_700_000_000.0
+_REQUEST = httpx.Request("POST", "https://api.example.com/v1/chat/completions")
+
+
+def _status_error(status, headers=None, cls=openai.APIStatusError):
+    response = httpx.Response(status, headers=headers or {}, request=_REQUEST)
+    return cls(f"HTTP {status}", response=response, body=None)
+
+
+@pytest.fixture
+def now(monkeypatch):
+    monkeypatch.setattr(llm_client.time, "time", lambda: NOW)
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (_status_error(429, cls=openai.RateLimitError), True),
+    (_status_error(500, cls=openai.InternalServerError), True),
+    (_status_error(502), True),
+    (_status_error(503), True),
+    (_status_error(408), True),
+    (_status_error(409, cls=openai.ConflictError), True),
+    (_status_error(400, cls=openai.BadRequestError), False),
+    (_status_error(401, cls=openai.AuthenticationError), False),
+    (_status_error(402), False),
+    (_status_error(403, cls=openai.PermissionDeniedError), False),
+    (_status_error(404, cls=openai.NotFoundError), False),
+    (_status_error(422, cls=openai.UnprocessableEntityError), False),
+    (openai.APIConnectionError(request=_REQUEST), True),
+    (openai.APITimeoutError(request=_REQUEST), True),
+    (httpx.ReadTimeout("读超时", request=_REQUEST), True),
+    (httpx.RemoteProtocolError("连接中途断开", request=_REQUEST), True),
+    (TruncatedResponseError("JSON 被截断"), True),
+    (ValueError("本地错误"), False),
+    (KeyError("choices"), False),
+])
+def test_is_retryable_error(error, retryable):
+    assert is_retryable_error(error) is retryable
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({}, None),
+    ({"retry-after": "7"}, 7.0),
+    ({"retry-after": "1.5"}, 1.5),
+    ({"retry-after": "-3"}, 0.0),
+    ({"retry-after-ms": "250"}, 0.25),
+    ({"retry-after-ms": "250", "retry-after": "9"}, 0.25),  # 毫秒头更精确，优先使用
+    ({"retry-after-ms": "soon", "retry-after": "9"}, 9.0),
+    ({"retry-after": formatdate(NOW + 30, usegmt=True)}, 30.0),
+    ({"retry-after": formatdate(NOW - 30, usegmt=True)}, 0.0),
+    ({"retry-after": "tomorrow"}, None),
+])
+def test_retry_after_seconds(now, headers, expected):
+    assert retry_after_seconds(_status_error(429, headers, cls=openai.RateLimitError)) == expected
+
+
+def test_retry_after_without_response():
+    assert retry_after_seconds(openai.APIConnectionError(request=_REQUEST)) is None
+    assert retry_after_seconds(ValueError()) is None
+
+
+@pytest.mark.parametrize("attempt, low, high", [
+    (0, 1.0, 2.0),
+    (1, 2.0, 4.0),
+    (2, 4.0, 8.0),
+    (3, 8.0, 16.0),
+    (5, 30.0, 60.0),  # 2 * 2**5 = 64，封顶 60
+    (9, 30.0, 60.0),
+])
+def test_backoff_bounds(monkeypatch, attempt, low, high):
+    error = _status_error(503)
+    policy = RetryPolicy(max_attempts=20)
+    monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: a)
+    assert policy.next_delay(attempt, error) == low
+    monkeypatch.setattr(llm_client.random, "uniform", lambda a, b: b)
+    assert policy.next_delay(attempt, error) == high
+
+
+def test_backoff_jitter_stays_in_bounds():
+    policy = RetryPolicy(max_attempts=20, job_budget=1000)
+    delays = [policy.next_delay(2, _status_error(503)) for _ in range(200)]
+    assert all(4.0 <= d <= 8.0 for d in delays)
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after": "12"}, 12.0),
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "600"}, 600.0),
+    ({"retry-after": "601"}, None),  # 要求等待太久，放弃重试
+])
+def test_retry_after_overrides_backoff(headers, expected):
+    policy = RetryPolicy()
+    assert policy.next_delay(0, _status_error(429, headers, cls=openai.RateLimitError)) == expected
+
+
+def test_http_date_retry_after(now):
+    error = _status_error(503, {"retry-after": formatdate(NOW + 45, usegmt=True)})
+    assert RetryPolicy().next_delay(0, error) == 45.0
+
+
+@pytest.mark.parametrize("max_attempts, retries", [(1, 0), (2, 1), (5, 4)])
+def test_max_attempts_per_call(max_attempts, retries):
+    policy = RetryPolicy(max_attempts=max_attempts, base_delay=0)
+    delays = [policy.next_delay(attempt, _status_error(503)) for attempt in range(10)]
+    assert sum(d is not None for d in delays) == retries
+    assert all(d is None for d in delays[retries:])
+    # 调用方可以为单次调用另给上限
+    assert RetryPolicy(max_attempts=max_attempts).next_delay(1, _status_error(503), max_attempts=3) is not None
+
+
+def test_non_retryable_error_does_not_spend_budget():
+    policy = RetryPolicy(job_budget=1)
+    assert policy.next_delay(0, _status_error(400, cls=openai.BadRequestError)) is None
+    assert policy.retries == 0
+    assert policy.next_delay(0, _status_error(503)) is not None
+
+
+def test_job_budget_is_shared_across_calls():
+    policy = RetryPolicy(max_attempts=3, base_delay=0, job_budget=5)
+    granted = 0
+    for _call in range(10):
+        for attempt in range(3):
+            if policy.next_delay(attempt, _status_error(503)) is None:
+                break
+            granted += 1
+    assert granted == 5 and policy.retries == 5
+
+
+def test_refused_retry_after_does_not_spend_budget():
+    policy = RetryPolicy(job_budget=1)
+    assert policy.next_delay(0, _status_error(429, {"retry-after": "3600"}, cls=openai.RateLimitError)) is None
+    assert policy.retries == 0
+
+
+# --- stream_options 不受支持时的回退 ---
+class _FakeStream:
+    def __init__(self, text):
+        delta = SimpleNamespace(content=text, reasoning_content=None)
+        self._chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)]
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        pass
+
+
+class _FakeCompletions:
+    """不认识 stream_options 的 OpenAI 兼容接口"""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        if "stream_options" in kwargs:
+            response = httpx.Response(400, request=_REQUEST, json={"error": {
+                "message": "Unrecognized request argument supplied: stream_options"}})
+            raise openai.BadRequestError("Unrecognized request argument supplied: stream_options",
+                                         response=response, body=None)
+        return _FakeStream("正文")
+
+
+def _session(completions, base_url="https://compat.example.com/v1"):
+    session = LLMSession("sk-test", base_url, "local-model", 0.7, worker="test")
+    session.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return session
+
+
+@pytest.fixture
+def no_stream_options(monkeypatch):
+    monkeypatch.setattr(llm_client, "_no_stream_options", set())
+    monkeypatch.setattr(llm_client, "_response_cache", None)
+    return llm_client._no_stream_options
+
+
+def test_rejected_stream_options_is_dropped_and_remembered(no_stream_options):
+    completions = _FakeCompletions()
+    assert _session(completions).complete([{"role": "user", "content": "写"}]) == "正文"
+    assert ["stream_options" in call for call in completions.calls] == [True, False]
+    assert no_stream_options == {"https://compat.example.com/v1"}
+
+    # 同一接口之后的会话直接不带该参数，也不占用重试预算
+    session = _session(completions)
+    assert "".join(c.choices[0].delta.content for c in session.stream_chat([{"role": "user", "content": "写"}])) == "正文"
+    assert "stream_options" not in completions.calls[-1]
+    assert session.retry_policy.retries == 0
+
+
+def test_usage_is_estimated_without_stream_options(no_stream_options, tmp_path, monkeypatch):
+    ledger = UsageLedger(str(tmp_path))
+    monkeypatch.setattr(llm_client, "_usage_ledger", ledger)
+    _session(_FakeCompletions()).complete([{"role": "user", "content": "写一章"}])
+    row = ledger.conn.execute("SELECT prompt_tokens, completion_tokens, estimated FROM calls").fetchone()
+    ledger.close()
+    assert row == (3, 2, 1)
+
+
+def test_other_bad_requests_are_not_retried(no_stream_options):
+    error = _status_error(400, cls=openai.BadRequestError)
+    completions = _FakeCompletions(error=error)
+    with pytest.raises(openai.BadRequestError):
+        _session(completions).complete([{"role": "user", "content": "写"}])
+    assert len(completions.calls) == 1
+    assert no_stream_options == set()
+
+
+def test_explicit_stream_options_are_left_to_the_caller(no_stream_options):
+    completions = _FakeCompletions()
+    with pytest.raises(openai.BadRequestError):
+        _session(completions).complete([{"role": "user", "content": "写"}], stream_options={"include_usage": True})
+    assert len(completions.calls) == 1
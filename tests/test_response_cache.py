@@ -0,0 +1,109 @@
+# tests/test_response_cache.py
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, make_key
+
+BASE = dict(base_url="https://api.example.com/v1", model="deepseek-chat", temperature=0.7,
+            messages=[{"role": "system", "content": "你是小说家"}, {"role": "user", "content": "写第一章"}],
+            options={"max_tokens": 4096})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    yield cache
+    cache.close()
+
+
+class _Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock)
+    return clock
+
+
+def test_key_is_stable():
+    assert make_key(**BASE) == make_key(**dict(BASE, messages=[dict(m) for m in BASE["messages"]]))
+    assert make_key(**dict(BASE, options=None)) == make_key(**dict(BASE, options={}))
+
+
+@pytest.mark.parametrize("field, value", [
+    ("base_url", "https://other.example.com/v1"),
+    ("model", "deepseek-reasoner"),
+    ("temperature", 0.8),
+    ("messages", [{"role": "system", "content": "你是小说家"}, {"role": "user", "content": "写第二章"}]),
+    ("messages", [{"role": "user", "content": "写第一章"}]),
+    ("options", {"max_tokens": 2048}),
+    ("options", {"max_tokens": 4096, "top_p": 0.9}),
+])
+def test_key_changes_with_every_input(field, value):
+    assert make_key(**dict(BASE, **{field: value})) != make_key(**BASE)
+
+
+def test_round_trip_and_stats(cache):
+    key = make_key(**BASE)
+    assert cache.get(key) is None
+    cache.put(key, "第一章正文")
+    assert cache.get(key) == "第一章正文"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_expire_after_max_age(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), max_age_days=1)
+    cache.put("old", "旧结果")
+    clock.now += 86400 - 1
+    assert cache.get("old") == "旧结果"
+    clock.now += 2
+    assert cache.get("old") is None
+
+    # 淘汰时顺带把过期条目从库里删掉
+    cache._evict(clock.now)
+    assert cache.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 0
+    cache.close()
+
+
+def test_size_eviction_drops_least_recently_used(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(response_cache, "EVICT_EVERY", 1)
+    cache = ResponseCache(str(tmp_path), max_bytes=1000)
+    for key in ("a", "b", "c"):
+        cache.put(key, "x" * 300)
+        clock.now += 1
+    assert cache.get("a") is not None  # “a”最近用过，淘汰时排到最后
+    clock.now += 1
+
+    cache.put("d", "x" * 300)  # 总量 1200 超限，淘汰到 800 以内
+    assert cache.get("b") is None and cache.get("c") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+    total = cache.conn.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+    assert total <= 1000 * 0.8
+    cache.close()
+
+
+def test_size_counts_utf8_bytes(cache):
+    cache.put("k", "中文")
+    assert cache.conn.execute("SELECT size FROM responses WHERE key = 'k'").fetchone()[0] == 6
+
+
+def test_closed_cache_ignores_late_calls(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put("k", "结果")
+    cache.close()
+    assert cache.conn is None
+    assert cache.get("k") is None
+    cache.put("k2", "迟到的结果")
+    cache.clear()
+
+
+def test_clear(cache):
+    cache.put("k", "结果")
+    cache.clear()
+    assert cache.get("k") is None
@@ -0,0 +1,151 @@
+# tests/test_search_index.py
+import os
+
+import pytest
+
+import search_index
+from data_manager import NovelProject
+from search_index import SNIPPET_CONTEXT, SearchIndex
+
+CHAPTERS = {
+    ("第一卷", "第一章"): "萧炎站在山门前。\n他抬头望去，云雾缭绕，萧炎萧炎。",
+    ("第一卷", "第二章"): "药老说：炎字拆开是两把火。\n火火火火",
+    ("第二卷", "第三章"): "山门外，风雪正紧。萧炎独自下山。",
+}
+
+
+@pytest.fixture
+def project(tmp_path):
+    project = NovelProject(str(tmp_path))
+    for (vol_name, chap_name), content in CHAPTERS.items():
+        names = [v["name"] for v in project.meta["volumes"]]
+        if vol_name not in names:
+            project.add_volume(vol_name)
+            names.append(vol_name)
+        project.add_chapter(names.index(vol_name), chap_name)
+        project.save_chapter_content(vol_name, chap_name, content)
+    return project
+
+
+@pytest.fixture
+def index(project):
+    index = SearchIndex(project)
+    index.sync()
+    yield index
+    index.close()
+
+
+def _expected(project, query):
+    """逐章用 str.find 查找的结果，索引检索必须与之完全一致"""
+    hits = []
+    for vol in project.meta["volumes"]:
+        for chap in vol["chapters"]:
+            content = project.read_chapter_content(vol["name"], chap["name"])
+            pos = content.find(query)
+            while pos != -1:
+                hits.append((vol["name"], chap["name"], pos))
+                pos = content.find(query, pos + len(query))
+    return hits
+
+
+def _positions(hits):
+    return [(vol, chap, pos) for vol, chap, pos, _ in hits]
+
+
+@pytest.mark.parametrize("query", ["萧炎", "山门", "火", "火火", "炎", "。", "萧炎萧炎", "云雾缭绕，萧炎", "不存在的词"])
+def test_hits_match_str_find(project, index, query):
+    assert _positions(index.search(query)) == _expected(project, query)
+
+
+def test_snippet_surrounds_hit(project, index):
+    vol, chap, pos, snippet = index.search("云雾")[0]
+    content = project.read_chapter_content(vol, chap)
+    start = max(0, pos - SNIPPET_CONTEXT)
+    assert snippet == content[start:pos + 2 + SNIPPET_CONTEXT].replace("\n", " ")
+
+
+def test_single_character_query(project, index):
+    hits = index.search("炎")
+    assert _positions(hits) == _expected(project, "炎")
+    assert {(vol, chap) for vol, chap, _ in _positions(hits)} == set(CHAPTERS)
+
+
+def test_query_does_not_cross_lines(index):
+    assert index.search("。他") == []
+    assert index.search("山门前。\n他") == []
+    assert index.search("   ") == []
+
+
+def test_query_longer_than_token_limit(project, index, monkeypatch):
+    monkeypatch.setattr(search_index, "MAX_QUERY_TOKENS", 4)
+    long_text = "".join(chr(0x4e00 + i) for i in range(200))
+    project.add_chapter(1, "第四章")
+    project.save_chapter_content("第二卷", "第四章", "开头" + long_text + "结尾")
+    # 与长查询共享很多二元组、但并不包含整个查询的章节，必须在 str.find 复核时排除
+    project.add_chapter(1, "第五章")
+    project.save_chapter_content("第二卷", "第五章", long_text[:150] + "，" + long_text[150:])
+
+    assert _positions(index.search(long_text)) == [("第二卷", "第四章", 2)]
+    assert _positions(index.search(long_text[:150])) == _expected(project, long_text[:150])
+
+
+def test_max_hits(index):
+    assert len(index.search("火", max_hits=3)) == 3
+
+
+def test_incremental_reindex_on_save(project, index):
+    project.save_chapter_content("第一卷", "第二章", "药老说：火莲在此。")
+    assert index.search("两把火") == []
+    assert _positions(index.search("火莲")) == [("第一卷", "第二章", 4)]
+    assert _positions(index.search("药老")) == _expected(project, "药老")
+    # 删掉的二元组不再留在倒排表里
+    stale = search_index.bigrams("两把火")
+    rows = index.conn.execute(f"SELECT COUNT(*) FROM postings WHERE token IN ({','.join('?' * len(stale))})",
+                              tuple(stale)).fetchone()
+    assert rows[0] == 0
+
+
+def test_sync_picks_up_external_edits(project, index):
+    assert index.sync() == 0
+    path = project.storage.path("第二卷", "第三章")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("外部编辑器改写的正文，风雪更紧了")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert index.sync() == 1
+    assert _positions(index.search("外部编辑器")) == [("第二卷", "第三章", 0)]
+    assert _positions(index.search("萧炎独自")) == []
+
+
+def test_rename_volume_and_chapter(project, index):
+    project.rename_volume(0, "序卷")
+    project.rename_chapter(1, 0, "终章")
+    assert _positions(index.search("萧炎")) == _expected(project, "萧炎")
+    assert {vol for vol, _, _, _ in index.search("萧炎")} == {"序卷", "第二卷"}
+    assert [chap for _, chap, _, _ in index.search("风雪")] == ["终章"]
+    # 改名后不需要重建
+    assert index.sync() == 0
+
+
+def test_delete_volume_and_chapter(project, index):
+    project.delete_chapter(0, 1)
+    assert index.search("药老") == []
+    project.delete_volume(1)
+    assert index.search("风雪") == []
+    assert _positions(index.search("萧炎")) == _expected(project, "萧炎")
+    assert index.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] == 1
+
+
+def test_sync_drops_chapters_removed_while_closed(project):
+    index = SearchIndex(project)
+    index.sync()
+    index.close()
+    project.delete_volume(1)
+    index = SearchIndex(project)
+    try:
+        index.sync()
+        assert _positions(index.search("萧炎")) == _expected(project, "萧炎")
+        assert set(index.body_lengths()) == {("第一卷", "第一章"), ("第一卷", "第二章")}
+    finally:
+        index.close()
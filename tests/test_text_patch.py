@@ -0,0 +1,28 @@
+# tests/test_text_patch.py
+from text_patch import apply_snippet_edits, revert_patches
+
+
+def test_fuzzy_match_keeps_trailing_punctuation():
+    # 模型把全角句号抄成了半角逗号：匹配区间要包含原文的句号，替换后不能多出一个标点
+    text = "前文。他走进了房间。后文很长很长。"
+    edits = [{"original": "他走进了房间,", "replacement": "他走进了房间，"}]
+    new_text, patches, failed = apply_snippet_edits(text, edits)
+    assert new_text == "前文。他走进了房间，后文很长很长。"
+    assert not failed
+    assert revert_patches(new_text, patches) == text
+
+
+def test_fuzzy_match_refused_when_region_drops_shared_suffix():
+    text = "他慢慢地走进了房间里"
+    edits = [{"original": "他慢慢地走进了房间里面", "replacement": "他缓缓地走进了房间里面"}]
+    new_text, patches, failed = apply_snippet_edits(text, edits)
+    assert new_text == text
+    assert patches == []
+    assert failed == edits
+
+
+def test_exact_match():
+    text = "甲乙丙丁。戊己庚辛。"
+    new_text, patches, failed = apply_snippet_edits(text, [{"original": "戊己", "replacement": "戊戌"}])
+    assert new_text == "甲乙丙丁。戊戌庚辛。"
+    assert len(patches) == 1 and not failed
@@ -0,0 +1,243 @@
+# text_patch.py
+# 纠错结果的局部合并：模型只返回需要修改的片段（原文片段 → 替换文字），由本地定位并合并回原文
+import os
+import difflib
+import unicodedata
+
+# 单个校对窗口的目标字数（不含上下文段落）
+DEFAULT_WINDOW_CHARS = 1500
+# 窗口前后各附带几段只读上下文，保证跨段的语病也能被看出来
+DEFAULT_CONTEXT_PARAGRAPHS = 1
+# 片段模糊定位时可接受的最低相似度
+FUZZY_THRESHOLD = 0.8
+FUZZY_MIN_LENGTH = 4
+# 模糊定位时起止位置的最大微调幅度（字数），限制长片段的匹配开销
+FUZZY_MAX_SLACK = 8
+
+
+def split_paragraphs(text):
+    """按行拆分正文；与章节存储一致，一行即一段（空行也保留，保证合并后排版不变）"""
+    return text.split("\n")
+
+
+def join_paragraphs(paragraphs):
+    return "\n".join(paragraphs)
+
+
+def make_windows(paragraphs, window_chars=DEFAULT_WINDOW_CHARS, context=DEFAULT_CONTEXT_PARAGRAPHS):
+    """
+    把段落切成若干校对窗口，返回 [(core_start, core_end, ctx_start, ctx_end), ...]。
+    core 区间互不重叠、合起来覆盖全文，只有 core 内的段落允许被修改；
+    ctx 区间在 core 两侧各多带 context 段，相邻窗口的上下文因此互相重叠。
+    """
+    windows = []
+    start = 0
+    size = 0
+    for i, para in enumerate(paragraphs):
+        size += len(para)
+        if size >= window_chars:
+            windows.append((start, i + 1))
+            start = i + 1
+            size = 0
+    if start < len(paragraphs):
+        windows.append((start, len(paragraphs)))
+
+    result = []
+    for core_start, core_end in windows:
+        # 全是空行的窗口没必要送去校对
+        if not any(p.strip() for p in paragraphs[core_start:core_end]):
+            continue
+        ctx_start = max(0, core_start - context)
+        ctx_end = min(len(paragraphs), core_end + context)
+        result.append((core_start, core_end, ctx_start, ctx_end))
+    return result
+
+
+def number_paragraphs(paragraphs, start=0, end=None, editable=None):
+    """
+    生成带段号的正文供模型引用，空行不显示。
+    editable 为 (core_start, core_end) 时，区间外的段落标为只读上下文。
+    """
+    end = len(paragraphs) if end is None else end
+    lines = []
+    for i in range(start, end):
+        para = paragraphs[i]
+        if not para.strip():
+            continue
+        if editable and not (editable[0] <= i < editable[1]):
+            lines.append(f"[{i}](仅供参考，勿改) {para}")
+        else:
+            lines.append(f"[{i}] {para}")
+    return "\n".join(lines)
+
+
+def paragraph_offsets(paragraphs):
+    """每段在全文中的起始字符偏移，最后额外附带全文长度，便于取第 i 段的区间 [offsets[i], offsets[i+1])"""
+    offsets = [0]
+    for para in paragraphs:
+        offsets.append(offsets[-1] + len(para) + 1)
+    offsets[-1] -= 1
+    return offsets
+
+
+def parse_snippet_edits(raw_edits, offsets, allowed=None):
+    """
+    整理模型返回的 [{"p": 段号, "original": 原文片段, "replacement": 替换文字}, ...]。
+    段号只作定位提示：hint 为该段的字符区间，span 为允许修改的整体区间（allowed 段号区间对应的字符范围）。
+    original 为空或与 replacement 相同的条目直接丢弃。
+    """
+    para_count = len(offsets) - 1
+    allowed = allowed or (0, para_count)
+    span = (offsets[allowed[0]], offsets[allowed[1]])
+    edits = []
+    if not isinstance(raw_edits, list):
+        return edits
+    for item in raw_edits:
+        if not isinstance(item, dict):
+            continue
+        original = item.get("original")
+        replacement = item.get("replacement")
+        if not isinstance(original, str) or not isinstance(replacement, str):
+            continue
+        if not original or original == replacement:
+            continue
+        hint = None
+        try:
+            idx = int(item.get("p"))
+            if allowed[0] <= idx < allowed[1]:
+                hint = (offsets[idx], offsets[idx + 1])
+        except (TypeError, ValueError):
+            pass
+        edits.append({"original": original, "replacement": replacement, "hint": hint, "span": span})
+    return edits
+
+
+def _fuzzy_find(text, snippet, lo, hi):
+    """在 text[lo:hi] 中找与 snippet 最相似的一段，相似度不足时返回 None"""
+    region = text[lo:hi]
+    # 太短的片段模糊匹配极易误中，只接受精确匹配
+    if not region or len(snippet) < FUZZY_MIN_LENGTH:
+        return None
+    matcher = difflib.SequenceMatcher(None, region, snippet, autojunk=False)
+    anchor = matcher.find_longest_match(0, len(region), 0, len(snippet))
+    if anchor.size == 0:
+        return None
+    # 以最长公共子串为锚点，在其附近微调起止位置，取相似度最高的一段
+    guess = anchor.a - anchor.b
+    slack = min(FUZZY_MAX_SLACK, max(2, len(snippet) // 10))
+    best, best_ratio = None, FUZZY_THRESHOLD
+    for start in range(max(0, guess - slack), min(len(region), guess + slack) + 1):
+        for length in range(max(1, len(snippet) - slack), len(snippet) + slack + 1):
+            end = min(len(region), start + length)
+            ratio = difflib.SequenceMatcher(None, region[start:end], snippet, autojunk=False).ratio()
+            if ratio > best_ratio:
+                best, best_ratio = (lo + start, lo + end), ratio
+    if best is not None:
+        best = _align_end(text, snippet, best[0], best[1], lo + len(region))
+    return best
+
+
+def _char_class(ch):
+    """标点与空白算一类，其余（汉字、字母、数字）算一类"""
+    return "punct" if ch.isspace() or unicodedata.category(ch).startswith("P") else "word"
+
+
+def _align_end(text, snippet, start, end, hi):
+    """
+    模糊匹配可能挑中比片段短一截的区间（比如恰好丢掉了片段末尾那个写错的标点），
+    整条替换写上去就会多出一个字。区间末尾与片段末尾的字符类别不一致、紧随其后的字符又与片段末尾同类时，把它补进区间。
+    """
+    want = _char_class(snippet[-1])
+    if end > start and _char_class(text[end - 1]) != want and end < hi and _char_class(text[end]) == want:
+        end += 1
+    return start, end
+
+
+def _keeps_shared_affixes(region, original, replacement):
+    """
+    模糊匹配的区间必须保留 original 与 replacement 共有的开头和结尾，
+    否则把整条 replacement 写上去会重复或吞掉这部分文字。
+    """
+    prefix = os.path.commonprefix([original, replacement])
+    suffix = os.path.commonprefix([original[::-1], replacement[::-1]])[::-1]
+    return region.startswith(prefix) and region.endswith(suffix)
+
+
+def locate_snippet(text, snippet, hint=None, span=None):
+    """
+    在原文中定位片段，返回 (start, end) 或 None。
+    依次尝试：提示段落内精确匹配 → 允许区间内精确匹配 → 提示段落内模糊匹配 → 允许区间内模糊匹配。
+    模型抄原文时常会改动个别标点或空白，模糊匹配用来兜住这类偏差。
+    """
+    span = span or (0, len(text))
+    scopes = [hint, span] if hint else [span]
+    for lo, hi in scopes:
+        pos = text.find(snippet, lo, hi)
+        if pos != -1:
+            return pos, pos + len(snippet)
+    for lo, hi in scopes:
+        found = _fuzzy_find(text, snippet, lo, hi)
+        if found:
+            return found
+    return None
+
+
+def apply_snippet_edits(text, edits):
+    """
+    把片段替换应用到原文，返回 (新正文, patches, 未能定位的 edits)。
+    patches 为按位置排序的 [{"start": 原文偏移, "original": 实际被替换的原文, "replacement": ...}]，
+    可直接写入补丁日志，也可交给 revert_patches 撤销。互相重叠的修改只保留靠前的一条。
+    """
+    located = []
+    failed = []
+    for edit in edits:
+        found = locate_snippet(text, edit["original"], edit.get("hint"), edit.get("span"))
+        if found is not None and text[found[0]:found[1]] != edit["original"] and \
+                not _keeps_shared_affixes(text[found[0]:found[1]], edit["original"], edit["replacement"]):
+            found = None  # 模糊匹配的区间与修改意图对不上，宁可放弃这处修改
+        if found is None:
+            failed.append(edit)
+        else:
+            located.append((found[0], found[1], edit["replacement"]))
+    located.sort(key=lambda item: item[0])
+
+    patches = []
+    pieces = []
+    cursor = 0
+    for start, end, replacement in located:
+        if start < cursor:
+            continue
+        pieces.append(text[cursor:start])
+        pieces.append(replacement)
+        patches.append({"start": start, "original": text[start:end], "replacement": replacement})
+        cursor = end
+    pieces.append(text[cursor:])
+    return "".join(pieces), patches, failed
+
+
+def revert_patches(text, patches):
+    """撤销 apply_snippet_edits 产生的补丁（text 须是打补丁后的正文）"""
+    pieces = []
+    cursor = 0
+    shift = 0
+    for patch in sorted(patches, key=lambda p: p["start"]):
+        start = patch["start"] + shift
+        end = start + len(patch["replacement"])
+        pieces.append(text[cursor:start])
+        pieces.append(patch["original"])
+        cursor = end
+        shift += len(patch["replacement"]) - len(patch["original"])
+    pieces.append(text[cursor:])
+    return "".join(pieces)
+
+
+def diff_paragraphs(old_text, new_text):
+    """
+    按段比较新旧正文，返回需要替换的段落区间 [(i1, i2, new_lines), ...]，按位置从后往前排列，
+    调用方依次替换 old 的第 i1~i2 段即可得到新正文，且前面的段号不受后面替换的影响。
+    """
+    old_lines = split_paragraphs(old_text)
+    new_lines = split_paragraphs(new_text)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    ops = [(i1, i2, new_lines[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+    return list(reversed(ops))
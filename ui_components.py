@@ -3,8 +3,13 @@ import os
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
                              QTextEdit, QPushButton, QDialog, QMessageBox, QFileDialog,
                              QListWidget, QFormLayout, QDialogButtonBox, QSpinBox,
-                             QDoubleSpinBox, QCheckBox, QInputDialog, QGroupBox)
+                             QDoubleSpinBox, QCheckBox, QInputDialog, QGroupBox, QTableWidget,
+                             QTableWidgetItem, QHeaderView)
 from PyQt6.QtCore import Qt, QSettings
+import llm_client
+import context_builder
+import response_cache
+from usage_ledger import WORKER_LABELS, DEFAULT_PRICES, call_cost
 
 class WelcomeDialog(QDialog):
     def __init__(self, parent=None):
@@ -85,7 +90,7 @@ class SettingsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("⚙️ 全局设置 & 模型参数")
-        self.setFixedSize(450, 320)
+        self.setFixedSize(450, 510)
         self.settings = QSettings("AIWriter", "Settings")
 
         layout = QFormLayout(self)
@@ -107,6 +112,34 @@ class SettingsDialog(QDialog):
         self.tokens_input.setSingleStep(500)
         self.tokens_input.setValue(int(self.settings.value("max_tokens", 4000)))
 
+        self.pool_size_input = QSpinBox()
+        self.pool_size_input.setRange(1, 64)
+        self.pool_size_input.setValue(int(self.settings.value("pool_size", llm_client.DEFAULT_MAX_CONNECTIONS)))
+
+        self.timeout_input = QSpinBox()
+        self.timeout_input.setRange(30, 3600)
+        self.timeout_input.setSingleStep(30)
+        self.timeout_input.setSuffix(" 秒")
+        self.timeout_input.setValue(int(float(self.settings.value("request_timeout", llm_client.DEFAULT_TIMEOUT))))
+
+        self.concurrency_input = QSpinBox()
+        self.concurrency_input.setRange(1, 16)
+        self.concurrency_input.setToolTip("批量总结、全书纠错等可并行任务同时在途的请求数，遇到限流会自动降低")
+        self.concurrency_input.setValue(int(self.settings.value("max_concurrency", 4)))
+
+        self.history_budget_input = QSpinBox()
+        self.history_budget_input.setRange(2000, 200000)
+        self.history_budget_input.setSingleStep(1000)
+        self.history_budget_input.setToolTip("“过往剧情轨迹”的 token 上限，超出后较早的章节和卷会被逐级压缩")
+        self.history_budget_input.setValue(
+            int(self.settings.value("history_token_budget", context_builder.DEFAULT_HISTORY_BUDGET)))
+
+        self.response_cache_cb = QCheckBox("相同的请求直接复用上次的结果")
+        self.response_cache_cb.setToolTip("总结、规划、纠错等请求按完整 prompt 缓存在项目目录下，重复请求不再消耗 token。\n"
+                                          "想让 AI 针对同样的内容重新作答时请关闭")
+        self.response_cache_cb.setChecked(
+            self.settings.value("response_cache", response_cache.DEFAULT_ENABLED, type=bool))
+
         self.confirm_delete_cb = QCheckBox("删除卷/章时进行二次确认")
         self.confirm_delete_cb.setChecked(self.settings.value("confirm_delete", True, type=bool))
         layout.addRow("🗑️ 删除确认:", self.confirm_delete_cb)
@@ -115,6 +148,11 @@ class SettingsDialog(QDialog):
         layout.addRow("🤖 模型名称:", self.model_input)
         layout.addRow("🌡️ Temperature:", self.temp_input)
         layout.addRow("📝 Max Tokens:", self.tokens_input)
+        layout.addRow("🔌 连接池上限:", self.pool_size_input)
+        layout.addRow("⏱️ 请求超时:", self.timeout_input)
+        layout.addRow("⚡ 并发请求数:", self.concurrency_input)
+        layout.addRow("📚 剧情轨迹上限:", self.history_budget_input)
+        layout.addRow("🗃️ 响应缓存:", self.response_cache_cb)
 
         buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
         buttons.accepted.connect(self.save_and_accept)
@@ -128,8 +166,150 @@ class SettingsDialog(QDialog):
         self.settings.setValue("temperature", self.temp_input.value())
         self.settings.setValue("max_tokens", self.tokens_input.value())
         self.settings.setValue("confirm_delete", self.confirm_delete_cb.isChecked())
+        self.settings.setValue("pool_size", self.pool_size_input.value())
+        self.settings.setValue("request_timeout", self.timeout_input.value())
+        self.settings.setValue("max_concurrency", self.concurrency_input.value())
+        self.settings.setValue("history_token_budget", self.history_budget_input.value())
+        self.settings.setValue("response_cache", self.response_cache_cb.isChecked())
+        llm_client.configure_pool(max_connections=self.pool_size_input.value(), timeout=self.timeout_input.value())
         self.accept()
 
+class UsageStatsDialog(QDialog):
+    """
+    token 用量统计面板：按卷、按任务类型汇总台账里的调用，并按起草一章的平均消耗预估剩余章节的费用。
+    单价保存在全局设置里，修改后立即重算。
+    """
+    COLUMNS = ["调用次数", "输入 tokens", "其中缓存命中", "输出 tokens", "其中思考", "耗时", "费用(元)"]
+
+    def __init__(self, ledger, volume_names, remaining_chapters, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("📊 Token 用量统计")
+        self.resize(860, 620)
+        self.settings = QSettings("AIWriter", "Settings")
+        self.ledger = ledger
+        self.volume_names = volume_names
+        self.remaining_chapters = remaining_chapters
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(20, 20, 20, 20)
+        layout.setSpacing(12)
+
+        price_row = QHBoxLayout()
+        price_row.addWidget(QLabel("💰 单价（元/百万 tokens）"))
+        self.price_inputs = {}
+        for key, label in (("input", "输入"), ("cached", "缓存命中"), ("output", "输出")):
+            spin = QDoubleSpinBox()
+            spin.setRange(0.0, 1000.0)
+            spin.setDecimals(2)
+            spin.setSingleStep(0.1)
+            spin.setValue(float(self.settings.value(f"price_{key}", DEFAULT_PRICES[key])))
+            spin.valueChanged.connect(self.refresh)
+            self.price_inputs[key] = spin
+            price_row.addWidget(QLabel(label))
+            price_row.addWidget(spin)
+        price_row.addStretch()
+        layout.addLayout(price_row)
+
+        layout.addWidget(QLabel("📚 按卷汇总"))
+        self.volume_table = self._make_table("卷")
+        layout.addWidget(self.volume_table, 3)
+        layout.addWidget(QLabel("🧰 按任务汇总"))
+        self.worker_table = self._make_table("任务")
+        layout.addWidget(self.worker_table, 2)
+
+        self.projection_label = QLabel()
+        self.projection_label.setWordWrap(True)
+        self.projection_label.setStyleSheet("color: #409EFF; font-weight: bold;")
+        layout.addWidget(self.projection_label)
+
+        bottom_row = QHBoxLayout()
+        btn_clear = QPushButton("🗑️ 清空统计记录")
+        btn_clear.clicked.connect(self.clear_records)
+        bottom_row.addWidget(btn_clear)
+        bottom_row.addStretch()
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.reject)
+        bottom_row.addWidget(buttons)
+        layout.addLayout(bottom_row)
+
+        self.refresh()
+
+    def _make_table(self, first_column):
+        table = QTableWidget(0, len(self.COLUMNS) + 1)
+        table.setHorizontalHeaderLabels([first_column] + self.COLUMNS)
+        table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        table.verticalHeader().setVisible(False)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        return table
+
+    def prices(self):
+        return {key: spin.value() for key, spin in self.price_inputs.items()}
+
+    def _fill_table(self, table, rows, prices):
+        table.setRowCount(len(rows))
+        for r, (label, totals) in enumerate(rows):
+            cost = call_cost(totals["prompt_tokens"], totals["cached_tokens"], totals["completion_tokens"], prices)
+            calls = str(totals["calls"])
+            if totals["local_hits"]:
+                calls += f"（本地缓存 {totals['local_hits']}）"
+            values = [label, calls, f"{totals['prompt_tokens']:,}", f"{totals['cached_tokens']:,}",
+                      f"{totals['completion_tokens']:,}", f"{totals['reasoning_tokens']:,}",
+                      f"{totals['latency'] / 60:.1f} 分钟", f"{cost:.2f}"]
+            if totals["estimated"]:
+                values[-1] += " (含估算)"
+            for c, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if c:
+                    item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                table.setItem(r, c, item)
+
+    @staticmethod
+    def _sum_totals(totals_list):
+        total = {}
+        for totals in totals_list:
+            for key, value in totals.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def refresh(self):
+        prices = self.prices()
+        for key, value in prices.items():
+            self.settings.setValue(f"price_{key}", value)
+
+        by_volume = self.ledger.totals_by_volume()
+        rows = [(name, by_volume.pop(name)) for name in self.volume_names if name in by_volume]
+        # 已删除/改名的卷和不属于任何卷的调用（如规划全书卷宗）合并成一行
+        if by_volume:
+            rows.append(("（其他/已删除的卷）", self._sum_totals(by_volume.values())))
+        if rows:
+            rows.append(("合计", self._sum_totals(totals for _, totals in rows)))
+        self._fill_table(self.volume_table, rows, prices)
+
+        by_worker = self.ledger.totals_by_worker()
+        self._fill_table(self.worker_table, [(WORKER_LABELS.get(worker, worker), totals)
+                                             for worker, totals in sorted(by_worker.items())], prices)
+
+        average = self.ledger.chapter_average()
+        if not self.remaining_chapters:
+            self.projection_label.setText("🔮 已规划的章节都已写完，暂无待写章节。")
+        elif average is None:
+            self.projection_label.setText(f"🔮 还有 {self.remaining_chapters} 个已规划的章节未写；"
+                                          f"暂无起草记录，写完一章后即可预估剩余费用。")
+        else:
+            per_chapter = call_cost(average["prompt_tokens"], average["cached_tokens"],
+                                    average["completion_tokens"], prices)
+            self.projection_label.setText(
+                f"🔮 还有 {self.remaining_chapters} 个已规划的章节未写。按已起草的 {average['chapters']} 章平均"
+                f"每章输入 {average['prompt_tokens']:,.0f} / 输出 {average['completion_tokens']:,.0f} tokens 计，"
+                f"预计还需约 {per_chapter * self.remaining_chapters:.2f} 元（尚未规划出来的章节不计在内）。")
+
+    def clear_records(self):
+        reply = QMessageBox.question(self, "清空统计", "确定清空本项目的全部用量记录吗？此操作不可恢复。")
+        if reply == QMessageBox.StandardButton.Yes:
+            self.ledger.clear()
+            self.refresh()
+
+
 class CharacterWidget(QGroupBox):
     def __init__(self, parent_remove_func, init_data=None):
         super().__init__("人物卡片")
@@ -0,0 +1,125 @@
+# usage_ledger.py
+import os
+import time
+import sqlite3
+import threading
+
+# 各类任务在统计面板里的显示名
+WORKER_LABELS = {
+    "write": "手动撰写",
+    "autopilot": "自动挂机",
+    "correction": "纠错",
+    "summary": "补全总结",
+    "modify": "片段修改",
+}
+# 估算费用用的默认单价（元 / 百万 tokens）：未命中缓存的输入、命中缓存的输入、输出；可在统计面板里修改
+DEFAULT_PRICES = {"input": 2.0, "cached": 0.2, "output": 3.0}
+# 预估剩余章节费用时，用于计算单章平均消耗的任务类型
+DRAFT_WORKERS = ("autopilot", "write")
+
+
+def call_cost(prompt_tokens, cached_tokens, completion_tokens, prices):
+    """按单价估算费用（元）。思考过程的 token 已计入 completion_tokens，不再单独计费"""
+    return ((prompt_tokens - cached_tokens) * prices["input"] + cached_tokens * prices["cached"] +
+            completion_tokens * prices["output"]) / 1_000_000
+
+
+class UsageLedger:
+    """
+    项目级的 token 用量台账，存放在项目目录下的 usage_ledger.db。
+    每次模型调用记一行：任务类型、所属卷章、prompt/缓存命中/输出/思考 token 数和耗时。
+    服务端没有返回 usage 时按字数估算并标记 estimated；命中本地响应缓存的调用记为 local_hit，token 数为 0。
+    """
+    FILENAME = "usage_ledger.db"
+
+    def __init__(self, root_path):
+        self.db_path = os.path.join(root_path, self.FILENAME)
+        self._lock = threading.Lock()
+        # 多个工作线程共用一个连接，由锁串行化
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS calls (
+                    id INTEGER PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    worker TEXT NOT NULL,
+                    volume TEXT,
+                    chapter TEXT,
+                    model TEXT,
+                    prompt_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    reasoning_tokens INTEGER NOT NULL,
+                    latency REAL NOT NULL,
+                    local_hit INTEGER NOT NULL DEFAULT 0,
+                    estimated INTEGER NOT NULL DEFAULT 0
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_calls_chapter ON calls (volume, chapter)")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+            self.conn = None
+
+    def record(self, worker, volume, chapter, model, prompt_tokens=0, cached_tokens=0, completion_tokens=0,
+               reasoning_tokens=0, latency=0.0, local_hit=False, estimated=False):
+        with self._lock:
+            if self.conn is None:
+                return  # 项目已关闭，后台线程里迟到的记录直接丢弃
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO calls (ts, worker, volume, chapter, model, prompt_tokens, cached_tokens, "
+                    "completion_tokens, reasoning_tokens, latency, local_hit, estimated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), worker, volume, chapter, model, prompt_tokens, cached_tokens, completion_tokens,
+                     reasoning_tokens, latency, int(local_hit), int(estimated)))
+
+    def clear(self):
+        with self._lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM calls")
+            self.conn.execute("VACUUM")
+
+    # --- 统计 ---
+    _TOTALS = ("COUNT(*), SUM(local_hit), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(cached_tokens), 0), "
+               "COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(reasoning_tokens), 0), "
+               "COALESCE(SUM(latency), 0), SUM(estimated)")
+
+    def _totals_by(self, column):
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {column}, {self._TOTALS} FROM calls GROUP BY {column}").fetchall()
+        return {row[0]: self._totals_dict(row[1:]) for row in rows}
+
+    @staticmethod
+    def _totals_dict(row):
+        keys = ("calls", "local_hits", "prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens",
+                "latency", "estimated")
+        return {key: value or 0 for key, value in zip(keys, row)}
+
+    def totals_by_volume(self):
+        """{卷名: 合计}，不属于任何卷的调用（如规划全书卷宗）归在 None 下"""
+        return self._totals_by("volume")
+
+    def totals_by_worker(self):
+        """{任务类型: 合计}"""
+        return self._totals_by("worker")
+
+    def chapter_average(self, workers=DRAFT_WORKERS):
+        """
+        起草一章的平均消耗 {"chapters", "prompt_tokens", "cached_tokens", "completion_tokens"}，没有记录时返回 None。
+        同一章重写多次的，各次调用都算在这一章头上。
+        """
+        placeholders = ",".join("?" * len(workers))
+        with self._lock:
+            row = self.conn.execute(f"""
+                SELECT COUNT(*), AVG(p), AVG(c), AVG(o) FROM (
+                    SELECT SUM(prompt_tokens) AS p, SUM(cached_tokens) AS c, SUM(completion_tokens) AS o
+                    FROM calls WHERE worker IN ({placeholders}) AND chapter IS NOT NULL AND local_hit = 0
+                    GROUP BY volume, chapter
+                )""", workers).fetchone()
+        if not row[0]:
+            return None
+        return {"chapters": row[0], "prompt_tokens": row[1], "cached_tokens": row[2], "completion_tokens": row[3]}